@@ -36,7 +36,10 @@ function [d, v, P] = Integration_KF_Chatzi(a,Ts, Q, R, d0, v0, P0)
 end
 """
 
+import functools
 import numpy as np
+import scipy.linalg
+import scipy.signal
 
 
 def Integration_KF_Chatzi(a, Ts, Q, R, d0=0, v0=0, P0=np.eye(2)):
@@ -85,6 +88,227 @@ def Integration_KF_Chatzi(a, Ts, Q, R, d0=0, v0=0, P0=np.eye(2)):
 
     return d, v, P
 
+
+# Relative tolerance on P used to decide that the Riccati recursion has settled
+STEADY_STATE_RTOL = 1e-9
+
+
+@functools.lru_cache(maxsize=None)
+def steady_state_filter(Ts, Q, R):
+    """
+    Solves the discrete Riccati equation for the integration KF once and returns
+    the steady-state quantities. The result is cached per (Ts, Q, R), so all the
+    channels with the same settings share one design.
+
+    Parameters:
+    Ts: The sampling time
+    Q: The process noise covariance
+    R: The measurement noise covariance
+
+    Returns:
+    P_ss: The steady-state (a posteriori) error covariance matrix
+    F: The closed-loop state matrix, x_k = F x_{k-1} + G a_{k-1}
+    G: The closed-loop input vector
+    b: The numerator coefficients for [d, v] (2 x 3), used by lfilter
+    den: The common denominator coefficients, used by lfilter
+    """
+    A = np.array([[1, Ts], [0, 1]])
+    B = np.array([0.5 * Ts**2, Ts])
+    C = np.array([1, 0])
+    # A priori steady-state covariance (filter form of the DARE: transpose A, use C' as "B")
+    P_minus = scipy.linalg.solve_discrete_are(A.T, C.reshape(2, 1), np.outer(B, B) * Q, np.array([[R]]))
+    K = (P_minus @ C) / (C @ P_minus @ C + R)
+    IKC = np.eye(2) - np.outer(K, C)
+    P_ss = IKC @ P_minus
+    # Since Y = 0, the correction is x_k = (I-KC) x_minus_hat, i.e. a linear time-invariant system
+    F = IKC @ A
+    G = IKC @ B
+    # With s_k = x_{k-1}: s_{k+1} = F s_k + G u_k, x_k = F s_k + G u_k, where u_k = a_{k-1}
+    b, den = scipy.signal.ss2tf(F, G.reshape(2, 1), F, G.reshape(2, 1))
+    for arr in (P_ss, F, G, b, den):
+        arr.setflags(write=False)  # shared between the channels, keep it read-only
+    return P_ss, F, G, b, den
+
+
+def _state_to_zi(x, F, den):
+    """
+    Maps the KF state x = [d, v] (the last estimate) onto the initial conditions of
+    lfilter (direct form II transposed) for the d and v outputs.
+    """
+    Fx = F @ x
+    FFx = F @ Fx
+    # zero-input response: y_0 = zi[0], y_1 = zi[1] - den[1]*y_0
+    return np.stack((Fx, FFx + den[1] * Fx), axis=-1)
+
+
+def Integration_KF_SteadyState(a, Ts, Q, R, d0=0, v0=0, P0=np.eye(2), rtol=STEADY_STATE_RTOL):
+    """
+    Same as Integration_KF_Chatzi, but once P has converged to the steady state
+    (solution of the discrete Riccati equation), the recursion is run as a linear
+    IIR filter (scipy.signal.lfilter) with the state carried in the initial
+    conditions. The exact time-varying recursion is used only while P is still
+    converging, i.e. typically only for the first block of a stream.
+
+    The output matches Integration_KF_Chatzi to within about 1e-9 relative to the
+    signal magnitude (governed by rtol) for the default settings.
+
+    Parameters:
+    a: The acceleration input
+    Ts: The sampling time
+    Q: The process noise covariance
+    R: The measurement noise covariance
+    d0: The initial displacement (default is 0)
+    v0: The initial velocity (default is 0)
+    P0: The initial error covariance matrix (default is identity matrix)
+    rtol: Relative tolerance on P to switch to the steady-state filter
+
+    Returns:
+    d: The displacement estimates
+    v: The velocity estimates
+    P: The final error covariance matrix
+    """
+    N = len(a)
+    P_ss, F, G, b, den = steady_state_filter(float(Ts), float(Q), float(R))
+    atol = rtol * np.abs(P_ss).max()
+
+    d = np.empty(N)
+    v = np.empty(N)
+    d[0] = d0
+    v[0] = v0
+    P = P0
+    k = 1
+    if np.abs(P - P_ss).max() > atol:
+        # P is still converging: run the exact recursion until it settles
+        A = np.array([[1, Ts], [0, 1]])
+        B = np.array([0.5 * Ts**2, Ts])
+        C = np.array([1, 0])
+        BBQ = np.outer(B, B) * Q
+        I2 = np.eye(2)
+        x_hat = np.array([d0, v0], dtype=float)
+        while k < N:
+            x_minus_hat = A @ x_hat + B * a[k-1]
+            P_minus = A @ P @ A.T + BBQ
+            K = (P_minus @ C) / (C @ P_minus @ C + R)
+            x_hat = x_minus_hat - K * (C @ x_minus_hat)  # Y = 0
+            P = (I2 - np.outer(K, C)) @ P_minus
+            d[k], v[k] = x_hat
+            k += 1
+            if np.abs(P - P_ss).max() <= atol:
+                break
+        if np.abs(P - P_ss).max() > atol:
+            return d, v, P
+
+    if k < N:
+        # Steady state: the rest is a linear IIR filter driven by a[k-1:N-1]
+        zi = _state_to_zi(np.array([d[k-1], v[k-1]]), F, den)
+        u = a[k-1:N-1]
+        d[k:], _ = scipy.signal.lfilter(b[0], den, u, zi=zi[0])
+        v[k:], _ = scipy.signal.lfilter(b[1], den, u, zi=zi[1])
+    return d, v, P_ss
+
+
+def Integration_KF_Batch(a, Ts, Q, R, d0=0, v0=0, P0=None, rtol=STEADY_STATE_RTOL):
+    """
+    Multi-channel version of Integration_KF_SteadyState: advances all the channels
+    of a (channels x samples) block together in vectorized NumPy. Channels whose P
+    is still converging run the exact recursion (vectorized across the channels),
+    converged channels sharing the same (Ts, Q, R) are filtered in one lfilter call.
+
+    Parameters:
+    a: The acceleration input, (channels x samples)
+    Ts: The sampling time, scalar or per channel
+    Q: The process noise covariance, scalar or per channel
+    R: The measurement noise covariance, scalar or per channel
+    d0: The initial displacements, scalar or per channel (default is 0)
+    v0: The initial velocities, scalar or per channel (default is 0)
+    P0: The initial error covariance matrices, (channels x 2 x 2) (default is identity matrices)
+    rtol: Relative tolerance on P to switch to the steady-state filter
+
+    Returns:
+    d: The displacement estimates, (channels x samples)
+    v: The velocity estimates, (channels x samples)
+    P: The final error covariance matrices, (channels x 2 x 2)
+    """
+    a = np.asarray(a, dtype=float)
+    M, N = a.shape
+    Ts = np.broadcast_to(np.asarray(Ts, dtype=float), (M,))
+    Q = np.broadcast_to(np.asarray(Q, dtype=float), (M,))
+    R = np.broadcast_to(np.asarray(R, dtype=float), (M,))
+    if P0 is None:
+        P = np.tile(np.eye(2), (M, 1, 1))
+    else:
+        P = np.array(np.broadcast_to(P0, (M, 2, 2)), dtype=float)
+
+    d = np.empty((M, N))
+    v = np.empty((M, N))
+    if N == 0:
+        # an empty frame (variable-length streams): nothing to advance
+        return d, v, P
+    d[:, 0] = d0
+    v[:, 0] = v0
+
+    # One steady-state design per distinct (Ts, Q, R)
+    designs, iDesign = np.unique(np.stack((Ts, Q, R), axis=1), axis=0, return_inverse=True)
+    iDesign = iDesign.reshape(-1)
+    filters = [steady_state_filter(*map(float, design)) for design in designs]
+    P_ss = np.stack([filters[i][0] for i in iDesign])
+    atol = rtol * np.abs(P_ss).max(axis=(1, 2))
+
+    # Index of the first sample computed by the steady-state filter, per channel
+    kStart = np.ones(M, dtype=np.int64)
+    bConverged = np.abs(P - P_ss).max(axis=(1, 2)) <= atol
+    iTransient = np.flatnonzero(~bConverged)
+    if iTransient.size > 0:
+        # Exact time-varying recursion, vectorized across the still converging channels
+        TsT = Ts[iTransient]
+        A = np.zeros((iTransient.size, 2, 2))
+        A[:, 0, 0] = 1
+        A[:, 0, 1] = TsT
+        A[:, 1, 1] = 1
+        B = np.stack((0.5 * TsT**2, TsT), axis=1)
+        BBQ = B[:, :, None] * B[:, None, :] * Q[iTransient, None, None]
+        RT = R[iTransient]
+        x_hat = np.stack((d[iTransient, 0], v[iTransient, 0]), axis=1)
+        PT = P[iTransient]
+        k = 1
+        while k < N and iTransient.size > 0:
+            x_minus_hat = np.einsum('mij,mj->mi', A, x_hat) + B * a[iTransient, k-1, None]
+            P_minus = A @ PT @ A.transpose(0, 2, 1) + BBQ
+            K = P_minus[:, :, 0] / (P_minus[:, 0, 0] + RT)[:, None]
+            x_hat = x_minus_hat - K * x_minus_hat[:, 0:1]  # Y = 0
+            PT = P_minus - K[:, :, None] * P_minus[:, None, 0, :]
+            d[iTransient, k] = x_hat[:, 0]
+            v[iTransient, k] = x_hat[:, 1]
+            k += 1
+            bDone = np.abs(PT - P_ss[iTransient]).max(axis=(1, 2)) <= atol[iTransient]
+            if bDone.any():
+                # Converged: these channels continue with the steady-state filter from k on
+                kStart[iTransient[bDone]] = k
+                P[iTransient[bDone]] = PT[bDone]
+                bKeep = ~bDone
+                iTransient = iTransient[bKeep]
+                A, B, BBQ, RT, x_hat, PT = A[bKeep], B[bKeep], BBQ[bKeep], RT[bKeep], x_hat[bKeep], PT[bKeep]
+        # Channels that did not settle within the block keep their exact P
+        P[iTransient] = PT
+        kStart[iTransient] = N
+        bConverged[:] = True
+        bConverged[iTransient] = False
+
+    # Steady state: one lfilter call per (design, start index)
+    iSteady = np.flatnonzero(bConverged & (kStart < N))
+    if iSteady.size > 0:
+        groups = np.unique(np.stack((iDesign[iSteady], kStart[iSteady]), axis=1), axis=0)
+        for iD, k in groups:
+            _, F, _, b, den = filters[iD]
+            idx = iSteady[(iDesign[iSteady] == iD) & (kStart[iSteady] == k)]
+            x = np.stack((d[idx, k-1], v[idx, k-1]), axis=1)
+            zi = _state_to_zi(x.T, F, den)  # (2 outputs, channels, 2)
+            u = a[idx, k-1:N-1]
+            d[idx, k:], _ = scipy.signal.lfilter(b[0], den, u, axis=-1, zi=zi[0])
+            v[idx, k:], _ = scipy.signal.lfilter(b[1], den, u, axis=-1, zi=zi[1])
+    P[bConverged] = P_ss[bConverged]
+    return d, v, P
+
 """```
 This Python function does the same thing as your MATLAB function. 
 It implements a Kalman Filter for integration, which is used to estimate the displacement and velocity from acceleration data. 
@@ -0,0 +1,61 @@
+"""
+The fixtures shared by the tests: a Host fed the way paho feeds it and publishing into a list
+instead of MQTT_OUT, and the messages of the DAQ streams.
+"""
+import json
+import struct
+import pytest
+import cpsns_Framework as fw
+
+
+class Message:
+    # What on_message gets from paho, as far as the Host is concerned
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class HostHarness:
+    """
+    A Host (without worker threads) and what it published.
+    """
+    def __init__(self, blocks, **kwargs):
+        self.host = fw.Host(blocks, nWorkerThreads=0, **kwargs)
+        self.host.mqttc_out = self.host.outbound.mqttc_out = self
+        self.msgs = []   # (topic, payload)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.msgs.append((topic, payload if isinstance(payload, str) else bytes(payload)))
+
+    def send(self, topic, payload):
+        self.host.on_message(None, None, Message(topic, payload))
+
+    def data(self):
+        # The published data frames, in order
+        return [(topic, payload) for topic, payload in self.msgs if topic.endswith("/data")]
+
+
+def daq_metadata(nSamples=100, strType="float", Fs=1000, strUnit="m/s^2"):
+    # The metadata of a DAQ stream (bytes, as from MQTT)
+    return json.dumps({"Data": {"Samples": nSamples, "Type": strType, "Unit": strUnit},
+                       "Analysis chain": [{"Name": "DAQ", "Sampling": Fs}]}).encode()
+
+
+def daq_frame(t, samples):
+    # The frame of the time step t (metadataVer 2: it says where it starts)
+    return struct.pack('=HHQQQ', 28, 2, 1000 + t, 0, t * len(samples)) + samples.tobytes()
+
+
+@pytest.fixture
+def harness():
+    return HostHarness
+
+
+@pytest.fixture
+def metadata():
+    return daq_metadata
+
+
+@pytest.fixture
+def frame():
+    return daq_frame
@@ -0,0 +1,243 @@
+"""
+Assembly of the frames of a channel set into one (channels x samples) block.
+
+The frames of the channels of a set with the same time stamp (secFromEpoch, nanosec) are one
+time step. The host waits for all the channels of the set (at most --gather_timeout s) and runs
+the step through the blocks at once: the samples are decoded into the rows of a preallocated
+(channels x samples) float64 block, reused from step to step, the channels in a fixed order
+(their keys, sorted). The batched blocks get the rows as a FrameBlock: a list of the rows that
+also has the whole block, so a multi-channel block can work on it in one vectorized call
+(and returns a FrameBlock for the next block).
+
+The channel sets are the nodes (the first levels of the topic, e.g. cpsens/<DAQ>/<module>), or
+the streams matching MQTT patterns (--assemble cpsens/d1/+/+/acc/raw: one set per pattern, the
+streams matching none of them by their node).
+
+When the wait is over and some channels have not delivered, the missing policy says what to do:
+    partial: process the channels that came (the block has fewer rows)
+    drop:    drop the time step
+    zero:    run zeros through the blocks of the missing channels (not published)
+    hold:    run their last sample, repeated (not published)
+A frame that comes after its step was processed without it is dropped, whatever the policy
+(with partial too: its step is gone, it is not processed as a step of its own).
+
+The Gatherer is the part of the host that does all this: the waiting steps, the channel sets
+and their Assemblies, and the counters.
+"""
+import collections
+import numpy as np
+import cpsns_BufferPool as bufferpool
+import cpsns_Codec as codec
+
+MISSING_POLICIES = ("partial", "drop", "zero", "hold")
+MISSING_POLICY_DEFAULT = "partial"
+SKIPPED_STEPS_MAX = 16   # per stream, the steps processed without it that are remembered
+
+
+class FrameBlock(list):
+    """
+    The frames of a time step: a list of the rows of block, a (channels x samples) array.
+    """
+    def __init__(self, block):
+        super().__init__(block)
+        self.block = block
+
+
+def rows_block(datas, dtype=np.float64):
+    """
+    Returns the (len(datas) x samples) array of datas (FrameBlock or list of same-length rows)
+    in dtype: the block of a FrameBlock itself (no copy) if it is of dtype, else a new array.
+    """
+    block = getattr(datas, "block", None)
+    if block is not None and block.dtype == dtype:
+        return block
+    result = np.empty((len(datas), len(datas[0])), dtype=dtype)
+    for j, data in enumerate(datas):
+        result[j] = data
+    return result
+
+
+def matches(pattern, key):
+    # MQTT wildcards: + is one level, # the rest
+    for i, level in enumerate(pattern):
+        if level == '#':
+            return True
+        if i >= len(key) or (level != '+' and level != key[i]):
+            return False
+    return len(pattern) == len(key)
+
+
+class ChannelSets:
+    """
+    Maps the streams to their channel set.
+    """
+    def __init__(self, patterns=None, nodeLevels=3):
+        """
+        Parameters:
+        patterns: MQTT patterns of the stream keys (the topic without data/metadata), one set per pattern
+        nodeLevels: The streams matching none of the patterns are grouped by the first nodeLevels levels
+        """
+        self.patterns = [tuple(pattern.rstrip('/').split('/')) for pattern in patterns or ()]
+        self.nodeLevels = nodeLevels
+
+    def group_key(self, myKey):
+        """
+        Returns the key of the channel set of the stream (a tuple of strings).
+        """
+        for pattern in self.patterns:
+            if matches(pattern, myKey):
+                return pattern
+        return myKey[:self.nodeLevels]
+
+
+class Assembly:
+    """
+    The channels of a set, in their fixed order, and the block their steps are decoded into.
+    """
+    __slots__ = ("members", "block")
+
+    def __init__(self, streams):
+        self.members = sorted(streams, key=lambda stream: stream.key)   # StreamStates
+        self.block = None   # the memory of the block (1D, of a size class), reused from step to step
+
+    def buffer(self, nChannels, nSamples, pool=None):
+        """
+        Returns the (nChannels x nSamples) block (C-contiguous), in the preallocated memory if
+        the size of a step of all the members is in its size class, else in memory of that class
+        from the BufferPool pool (the old one goes back).
+        """
+        nSize = max(len(self.members), nChannels) * nSamples
+        if pool is not None:
+            self.block = pool.fit_array(self.block, nSize)
+        elif self.block is None or len(self.block) != bufferpool.size_class(nSize):
+            self.block = np.empty(bufferpool.size_class(nSize))
+        return self.block[:nChannels * nSamples].reshape(nChannels, nSamples)
+
+
+class Gatherer:
+    """
+    The gathering of a host: the frames wait (per shard) for the rest of the time step of their
+    channel set. The streams are its StreamStates. Must be used with the lock of the host held.
+    """
+    def __init__(self, gather_timeout, channelSets, missing_policy=MISSING_POLICY_DEFAULT, pool=None, nShards=1):
+        """
+        Parameters:
+        gather_timeout: Max time (in s) a time step waits for the missing channels
+        channelSets: The ChannelSets of the streams
+        missing_policy: What to do with the channels still missing after gather_timeout, see MISSING_POLICIES
+        pool: The BufferPool of the blocks of the sets
+        nShards: The number of the shards of the host
+        """
+        if missing_policy not in MISSING_POLICIES:
+            raise ValueError(f"Unknown missing policy {missing_policy}, use one of {MISSING_POLICIES}")
+        self.gather_timeout = gather_timeout
+        self.channelSets = channelSets
+        self.missing_policy = missing_policy
+        self.pool = pool
+        self.assemblies = {}     # nodeKey (the channel set) -> Assembly, rebuilt when the set changes
+        self.setStreams = {}     # nodeKey (the channel set) -> {myKey: StreamState} with known metadata
+        # Per shard: (nodeKey, secFromEpoch, nanosec) -> [arrival time, {StreamState: payload}]
+        self.pendingFrames = [{} for _ in range(nShards)]
+        # Per shard: the channels missing from the processed time steps, the frames dropped (by the missing policy, or late)
+        self.nMissingChannels = [0] * nShards
+        self.nDropped = [0] * nShards
+
+    def add_stream(self, stream):
+        self.setStreams.setdefault(stream.nodeKey, {})[stream.key] = stream
+        self.drop_assembly(stream.nodeKey)
+
+    def remove_stream(self, stream):
+        # (if its key has a new stream already, e.g. rebuilt from new metadata, that one stays)
+        setStreams = self.setStreams.get(stream.nodeKey)
+        if setStreams is not None and setStreams.get(stream.key) is stream:
+            del setStreams[stream.key]
+            if not setStreams:
+                del self.setStreams[stream.nodeKey]
+        self.drop_assembly(stream.nodeKey)
+
+    def drop_assembly(self, nodeKey):
+        # The channel set has changed: its Assembly is rebuilt on the next step, the block goes back to the pool
+        assembly = self.assemblies.pop(nodeKey, None)
+        if assembly is not None and self.pool is not None:
+            self.pool.give(assembly.block)
+            assembly.block = None
+
+    def gather(self, stream, payload, now=0.0, iShard=0):
+        """
+        Keeps the frame until the other channels of the set have delivered the same time step.
+
+        Returns:
+        The steps to process now, in time order: a list of (frames, Assembly), see step
+        """
+        pendingFrames = self.pendingFrames[iShard]
+        header = codec.decode_header(payload)
+        if stream.skippedSteps is not None and (header.secFromEpoch, header.nanosec) in stream.skippedSteps:
+            # its step has been processed without it
+            self.nDropped[iShard] += 1
+            return []
+        nodeKey = stream.nodeKey
+        groupKey = (nodeKey, header.secFromEpoch, header.nanosec)
+        group = pendingFrames.setdefault(groupKey, [now, {}])
+        group[1][stream] = payload
+        # all the sensors of the node delivered this time step?
+        if len(group[1]) < len(self.setStreams.get(nodeKey, ())):
+            return []
+        # it goes, together with the older incomplete steps of the node, in time order
+        steps = [self.step(key, pendingFrames.pop(key)[1], iShard) for key in sorted(key for key in pendingFrames if key[0] == nodeKey and key[1:] <= groupKey[1:])]
+        return [step for step in steps if step is not None]
+
+    def expire(self, now, iShard=0, bAll=False):
+        """
+        Returns the steps (of the shard) that have waited longer than gather_timeout for the rest
+        of the channels of their set (all of them with bAll, e.g. when stopping), see gather.
+        """
+        pendingFrames = self.pendingFrames[iShard]
+        steps = [self.step(groupKey, pendingFrames.pop(groupKey)[1], iShard)
+                 for groupKey in sorted(key for key, group in pendingFrames.items() if bAll or now - group[0] >= self.gather_timeout)]
+        return [step for step in steps if step is not None]
+
+    def step(self, groupKey, frames, iShard=0):
+        """
+        Returns the frames of a time step of a channel set (frames: StreamState -> payload) in the
+        order of the set, the missing channels by the missing policy (payload None: to fill, see
+        fill_missing), and the Assembly of the set; None if the step is dropped.
+        """
+        nodeKey = groupKey[0]
+        assembly = self.assemblies.get(nodeKey)
+        if assembly is None:
+            assembly = self.assemblies[nodeKey] = Assembly(self.setStreams.get(nodeKey, {}).values())
+        if len(frames) < len(assembly.members):
+            missing = [stream for stream in assembly.members if stream not in frames]
+            self.nMissingChannels[iShard] += len(missing)
+            # their frames of this step are dropped if they come (whatever the policy: a late
+            # frame would start a step of its own, behind the states of the set)
+            for stream in missing:
+                if stream.skippedSteps is None:
+                    stream.skippedSteps = collections.deque(maxlen=SKIPPED_STEPS_MAX)
+                stream.skippedSteps.append(groupKey[1:])
+            if self.missing_policy == "drop":
+                self.nDropped[iShard] += len(frames)
+                return None
+        # in the order of the set, the missing channels without a payload (filled) or left out
+        ordered = {}
+        for stream in assembly.members:
+            if stream in frames:
+                ordered[stream] = frames[stream]
+            elif self.missing_policy != "partial":
+                ordered[stream] = None
+        if len(ordered) < len(frames):
+            # (a stream the set does not know yet)
+            ordered.update(frames)
+        return ordered, assembly
+
+    def fill_missing(self, stream, data):
+        """
+        Fills data with the samples of a channel missing from its time step (zero or hold).
+        """
+        data[:] = 0.0 if self.missing_policy == "zero" else stream.sequence.lastSample
+        if stream.sequence.expected is not None:
+            # the frame of the step is not a gap when the next one comes
+            stream.sequence.expected += len(data)
+
+    def add_metrics(self, exposition):
+        exposition.metric("cpsns_missing_channels_total", "counter", "Channels missing from the time steps of their set after --gather_timeout", sum(self.nMissingChannels))
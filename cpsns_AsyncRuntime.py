@@ -0,0 +1,208 @@
+"""
+Asyncio runtime of the services (--runtime asyncio).
+
+All the MQTT connections (one or more MQTT_IN and MQTT_OUT brokers) run on one event loop,
+with the aiomqtt client (pip install aiomqtt, it is in requirements.txt), instead of a paho
+network thread per client.
+The DSP runs on a thread pool (the executor): the messages are sharded as with the worker
+threads, and each shard hands its pending messages to the executor in one call, so the
+streams are processed in order and the per-stream state needs no locking.
+
+Backpressure: the processed frames go into a bounded outbound queue. When the publishing
+falls behind, the processing waits for room, the shard queues fill up and the readers stop
+taking messages from the clients. aiomqtt keeps up to queue_size more messages per broker
+and drops the rest (with a warning): the memory stays bounded.
+
+SIGTERM/SIGINT: stop reading, process what is queued, flush the gathered and the coalesced
+frames, publish everything (and write the checkpoint) and disconnect.
+
+In private_config.json MQTT_IN and MQTT_OUT can be a broker or a list of brokers: the topics
+of the public configuration are subscribed on every MQTT_IN broker, and the results are
+published to every MQTT_OUT broker.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import signal
+import sys
+import threading
+import traceback
+import time
+import aiomqtt
+import cpsns_Sharding as shard
+
+OUT_QUEUE_SIZE_DEFAULT = 1000  # messages waiting to be published
+
+
+def brokers_of(json_config):
+    # One broker, or a list of brokers
+    return json_config if isinstance(json_config, list) else [json_config]
+
+
+def create_client(broker, max_queued=None):
+    return aiomqtt.Client(broker["host"], broker["port"], username=broker["userId"] or None,
+                          password=broker["password"] or None, max_queued_incoming_messages=max_queued)
+
+
+class AsyncPublisher:
+    """
+    What the Host publishes to (its outbound.mqttc_out): called from the executor threads, hands
+    the messages over to the event loop. Blocks when out_queue_size messages are waiting.
+    """
+    def __init__(self, loop, out_queue_size=OUT_QUEUE_SIZE_DEFAULT):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.room = threading.BoundedSemaphore(out_queue_size)
+        self.nWaited = 0   # how many times a publish had to wait for room (backpressure)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        # The payload may be a reused buffer: copy it before it is handed over
+        if isinstance(payload, (bytearray, memoryview)):
+            payload = bytes(payload)
+        if not self.room.acquire(blocking=False):
+            self.nWaited += 1
+            self.room.acquire()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (topic, payload, qos, retain))
+
+
+class AsyncRuntime:
+    def __init__(self, host, nExecutorThreads, queue_size, out_queue_size=OUT_QUEUE_SIZE_DEFAULT, stats_interval=0):
+        """
+        Parameters:
+        host: The Host, created with nExecutorThreads worker threads (its shards); its work
+              queue is not started, the runtime feeds the shards
+        nExecutorThreads: The number of the DSP threads (= the number of shards)
+        queue_size: The capacity of every shard queue (messages)
+        out_queue_size: The max number of messages waiting to be published
+        stats_interval: Print the counters every that many seconds, 0 for never
+        """
+        self.host = host
+        self.nShards = nExecutorThreads
+        self.queue_size = queue_size
+        self.out_queue_size = out_queue_size
+        self.stats_interval = stats_interval
+        self.nReceived = 0
+        self.nProcessed = 0
+
+    async def read(self, client, shardQueues):
+        async for message in client.messages:
+            msg = shard.RingMessage(message.topic.value, message.payload)
+            iShard = self.host.workQueue.shard_of(self.host.shard_key(msg.topic))
+            # waits when the shard is full: backpressure to the broker
+            await shardQueues[iShard].put(msg)
+            self.nReceived += 1
+
+    def process(self, msgs, iShard, bPeriodic):
+        # On an executor thread
+        for msg in msgs:
+            try:
+                self.host.handle_message(msg, iShard)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+        if bPeriodic:
+            self.host.periodic(iShard)
+
+    async def run_shard(self, iShard, shardQueue, executor):
+        loop = asyncio.get_running_loop()
+        tick = self.host.tick
+        lastPeriodic = time.monotonic()
+        while True:
+            try:
+                msgs = [await asyncio.wait_for(shardQueue.get(), tick)]
+            except asyncio.TimeoutError:
+                msgs = []
+            # Take everything that is pending
+            while not shardQueue.empty():
+                msgs.append(shardQueue.get_nowait())
+            bPeriodic = tick is not None and time.monotonic() - lastPeriodic >= tick
+            if bPeriodic:
+                lastPeriodic = time.monotonic()
+            try:
+                if msgs or bPeriodic:
+                    await loop.run_in_executor(executor, self.process, msgs, iShard, bPeriodic)
+            except Exception:
+                # (e.g. from the periodic duties) the shard goes on with the next messages
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                # always, or join() at the shutdown would wait forever
+                self.nProcessed += len(msgs)
+                for _ in msgs:
+                    shardQueue.task_done()
+
+    async def publish(self, clients, publisher):
+        while True:
+            topic, payload, qos, retain = await publisher.queue.get()
+            for client in clients:
+                await client.publish(topic, payload, qos=qos, retain=retain)
+            publisher.room.release()
+            publisher.queue.task_done()
+
+    async def print_stats(self, publisher, shardQueues):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            print(f"Received: {self.nReceived}, processed: {self.nProcessed}, queued: {sum(q.qsize() for q in shardQueues)}, "
+                  f"to publish: {publisher.queue.qsize()}, publish waits: {publisher.nWaited}")
+            print(f"Streams: {self.host.memory_report()}")
+            print(f"Published: {self.host.outbound.stats()}")
+
+    async def run(self, json_config_private, json_config_public):
+        loop = asyncio.get_running_loop()
+        stopEvent = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stopEvent.set)
+
+        publisher = AsyncPublisher(loop, self.out_queue_size)
+        self.host.outbound.mqttc_out = publisher
+        executor = concurrent.futures.ThreadPoolExecutor(self.nShards, thread_name_prefix="dsp")
+        shardQueues = [asyncio.Queue(self.queue_size) for _ in range(self.nShards)]
+        # for /metrics: the work queue of the host is not used here
+        self.host.gauges["cpsns_queue_depth"] = ("Messages waiting in the shard queues", lambda: sum(q.qsize() for q in shardQueues))
+        self.host.gauges["cpsns_publish_queue_depth"] = ("Messages waiting to be published", lambda: publisher.queue.qsize())
+        topicsToSubscribe = json_config_public["MQTT_IN"]["TopicsToSubscribe"]
+        qos = json_config_public["MQTT_IN"]["QoS"]
+
+        async with contextlib.AsyncExitStack() as outStack:
+            # MQTT_OUT first, so that it is there when the first message arrives
+            outClients = [await outStack.enter_async_context(create_client(broker)) for broker in brokers_of(json_config_private["MQTT_OUT"])]
+            publishTask = asyncio.create_task(self.publish(outClients, publisher))
+            if self.host.checkpointer is not None:
+                await loop.run_in_executor(executor, self.host.restore_checkpoint)
+            shardTasks = [asyncio.create_task(self.run_shard(i, q, executor)) for i, q in enumerate(shardQueues)]
+            async with contextlib.AsyncExitStack() as inStack:
+                inClients = [await inStack.enter_async_context(create_client(broker, self.queue_size)) for broker in brokers_of(json_config_private["MQTT_IN"])]
+                print(f"Connected to {len(inClients)} MQTT_IN and {len(outClients)} MQTT_OUT brokers")
+                for client in inClients:
+                    for topic in topicsToSubscribe:
+                        print(f"MQTT_IN: Subscribing to the topic {topic}...")
+                        await client.subscribe(topic, qos=qos)
+                readTasks = [asyncio.create_task(self.read(client, shardQueues)) for client in inClients]
+                otherTasks = [asyncio.create_task(self.print_stats(publisher, shardQueues))] if self.stats_interval > 0 else []
+
+                # Run until a signal (or a reader fails)
+                stopTask = asyncio.create_task(stopEvent.wait())
+                await asyncio.wait(readTasks + [stopTask], return_when=asyncio.FIRST_COMPLETED)
+                print("Stopping...")
+                for task in readTasks:
+                    if task.done() and task.exception() is not None:
+                        print(f"MQTT_IN: {task.exception()!r}", file=sys.stderr)
+                for task in readTasks + otherTasks + [stopTask]:
+                    task.cancel()
+            # Drain: the queued messages, then the gathered and the coalesced frames, then the outbound queue
+            for q in shardQueues:
+                await q.join()
+            for task in shardTasks:
+                task.cancel()
+            for iShard in range(self.nShards):
+                await loop.run_in_executor(executor, self.host.flush_reordered, iShard, True)
+                await loop.run_in_executor(executor, self.host.flush_pending, iShard, True)
+            await loop.run_in_executor(executor, self.host.outbound.flush_all)
+            if self.host.checkpointer is not None:
+                await loop.run_in_executor(executor, self.host.write_checkpoint)
+            await publisher.queue.join()
+            publishTask.cancel()
+        executor.shutdown()
+        print("Stopped")
+
+
+def run(host, nExecutorThreads, queue_size, json_config_private, json_config_public, stats_interval=0):
+    asyncio.run(AsyncRuntime(host, nExecutorThreads, queue_size, stats_interval=stats_interval).run(json_config_private, json_config_public))
@@ -0,0 +1,257 @@
+"""
+Microbenchmarks of the DSP kernels, with equivalence checks and regression tracking.
+
+For every kernel (the KF integration, the running-mean detrending, the high-pass filter), frame
+size, sample type and channel count, the kernel is run the way the services run it: a few
+consecutive frames of all the channels, with the state carried between the frames. The median
+time per frame is measured (repeating for at least --min_time seconds).
+
+Equivalence: the output of channel 0 is compared with the reference algorithm:
+    kf:      the original per-sample Integration_KF_Chatzi, frame by frame
+    detrend: the original per-sample running-mean loop of cpsns_Detrend
+    hpf:     sosfilt over the whole signal, in float64
+and, with --reference FILE.npz, with the outputs stored in the file (--update_reference stores
+the outputs of the current implementations).
+
+Regressions: --output writes the results as JSON, --compare OLD.json flags the cases that got
+slower by more than --threshold. The exit code is 1 if there is a regression or an output is
+not equivalent, so that it can run between commits.
+
+    python cpsns_Bench_Kernels.py --output new.json --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import Integration_KF_Chatzi as intgr
+import simpleDetrend as dtr
+import simpleHPF as hpf
+
+KERNELS = ("kf", "detrend", "hpf")
+FRAMES_DEFAULT = [64, 256, 1024, 4096, 16384, 65536]
+DTYPES_DEFAULT = ['f', 'd']
+CHANNELS_DEFAULT = [1, 16, 128]
+N_FRAMES = 3                   # consecutive frames per run (the state is carried)
+MAX_BLOCK_DEFAULT = 1 << 21    # samples per frame (all the channels), the larger cases are skipped
+MIN_TIME_DEFAULT = 0.2         # s per case
+THRESHOLD_DEFAULT = 0.10       # slower by more than 10%: a regression
+
+# The parameters of the services
+Fs = 1000.0
+KF_Q = 1.e-6
+KF_R = 1.e-10
+HPF_CUTOFF = 0.5
+HPF_ORDER = 5
+
+# Max relative error (max |out - ref| / max |ref|) for (kernel, dtype)
+TOLERANCES = {
+    ("kf", 'f'): 1e-6, ("kf", 'd'): 1e-6,
+    ("detrend", 'f'): 1e-9, ("detrend", 'd'): 1e-9,
+    ("hpf", 'f'): 1e-3, ("hpf", 'd'): 1e-9,
+}
+
+
+def make_signal(nChannels, nSamples, cType):
+    # Channel i is the same in every case (its own seed): the reference is computed once
+    return np.array([(np.random.default_rng(i).standard_normal(nSamples) + 0.3) for i in range(nChannels)]).astype(cType)
+
+
+# Kernels: (x: channels x samples, cType) -> the outputs, frame by frame, as the services call them
+
+def run_kf(x, nFrame, cType):
+    nChannels = len(x)
+    d0 = np.zeros(nChannels)
+    v0 = np.zeros(nChannels)
+    P0 = np.tile(np.eye(2), (nChannels, 1, 1))
+    Ts = np.full(nChannels, 1 / Fs)
+    outputs = []
+    for start in range(0, x.shape[1], nFrame):
+        d, v, P0 = intgr.Integration_KF_Batch(x[:, start:start + nFrame].astype(float), Ts, KF_Q, KF_R, d0, v0, P0)
+        d0 = d[:, -1]
+        v0 = v[:, -1]
+        outputs.append(d)
+    return outputs
+
+
+def run_detrend(x, nFrame, cType):
+    detrenders = [dtr.RealTimeDetrender() for _ in range(len(x))]
+    outputs = []
+    for start in range(0, x.shape[1], nFrame):
+        outputs.append([detrender.apply_filter(row[start:start + nFrame]) for detrender, row in zip(detrenders, x)])
+    return outputs
+
+
+def run_hpf(x, nFrame, cType):
+    filters = [hpf.RealTimeHighPassFilter(HPF_CUTOFF, Fs, HPF_ORDER, cType) for _ in range(len(x))]
+    outputs = []
+    for start in range(0, x.shape[1], nFrame):
+        outputs.append(hpf.apply_filter_batch(filters, [row[start:start + nFrame] for row in x]))
+    return outputs
+
+
+KERNEL_FUNCTIONS = {"kf": run_kf, "detrend": run_detrend, "hpf": run_hpf}
+
+
+# References (channel 0, the whole signal)
+
+def reference_kf(x0, nFrame):
+    d0, v0, P0 = 0, 0, np.eye(2)
+    ds = []
+    for start in range(0, len(x0), nFrame):
+        d, v, P0 = intgr.Integration_KF_Chatzi(x0[start:start + nFrame].astype(float), 1 / Fs, KF_Q, KF_R, d0, v0, P0)
+        d0, v0 = d[-1], v[-1]
+        ds.append(d)
+    return np.concatenate(ds)
+
+
+def reference_detrend(x0, nFrame):
+    data = x0.astype(float)
+    xMean = data[0]
+    K = 2
+    for i in range(1, len(data)):
+        xMean = xMean + (data[i] - xMean) / K
+        data[i] -= xMean
+        K += 1
+    return data
+
+
+def reference_hpf(x0, nFrame):
+    import scipy.signal
+    sos = scipy.signal.butter(HPF_ORDER, HPF_CUTOFF, btype="highpass", output="sos", fs=Fs)
+    zi = scipy.signal.sosfilt_zi(sos) * float(x0[0])
+    return scipy.signal.sosfilt(sos, x0.astype(float), zi=zi)[0]
+
+
+REFERENCE_FUNCTIONS = {"kf": reference_kf, "detrend": reference_detrend, "hpf": reference_hpf}
+
+
+def channel0(outputs):
+    return np.concatenate([np.asarray(frame[0], dtype=float) for frame in outputs])
+
+
+def relative_error(out, ref):
+    return float(np.max(np.abs(out - ref)) / max(np.max(np.abs(ref)), np.finfo(float).tiny))
+
+
+def time_case(kernel, x, nFrame, cType, dMinTime):
+    """
+    Returns (the median and the min time per frame, the outputs of the first run).
+    """
+    function = KERNEL_FUNCTIONS[kernel]
+    times = []
+    outputs = None
+    tStart = time.perf_counter()
+    while len(times) < 3 or time.perf_counter() - tStart < dMinTime:
+        t = time.perf_counter()
+        result = function(x, nFrame, cType)
+        times.append((time.perf_counter() - t) / N_FRAMES)
+        if outputs is None:
+            outputs = result
+    return float(np.median(times)), float(np.min(times)), outputs
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(args):
+    storedReference = {}
+    if args.reference is not None and os.path.exists(args.reference) and not args.update_reference:
+        storedReference = dict(np.load(args.reference))
+    newReference = {}
+    references = {}   # (kernel, frame, dtype) -> the reference of channel 0
+    results = []
+    bFailed = False
+    print(f"{'kernel':<8} {'frame':>6} {'type':>4} {'ch':>4} {'median us':>11} {'Msamples/s':>11} {'rel. error':>11}")
+    for kernel in args.kernels:
+        for nFrame in args.frames:
+            for cType in args.dtypes:
+                for nChannels in args.channels:
+                    if nChannels * nFrame > args.max_block:
+                        print(f"{kernel:<8} {nFrame:>6} {cType:>4} {nChannels:>4}   skipped (more than --max_block samples per frame)")
+                        continue
+                    x = make_signal(nChannels, N_FRAMES * nFrame, cType)
+                    dMedian, dMin, outputs = time_case(kernel, x, nFrame, cType, args.min_time)
+                    out = channel0(outputs)
+                    caseKey = (kernel, nFrame, cType)
+                    if caseKey not in references:
+                        references[caseKey] = REFERENCE_FUNCTIONS[kernel](x[0], nFrame)
+                    error = relative_error(out, references[caseKey])
+                    bEquivalent = error <= TOLERANCES[(kernel, cType)]
+                    strKey = f"{kernel}_{nFrame}_{cType}"
+                    storedError = None
+                    if strKey in storedReference:
+                        storedError = relative_error(out, storedReference[strKey])
+                        bEquivalent = bEquivalent and storedError <= TOLERANCES[(kernel, cType)]
+                    newReference[strKey] = out
+                    bFailed = bFailed or not bEquivalent
+                    results.append({
+                        "kernel": kernel, "frame": nFrame, "dtype": cType, "channels": nChannels,
+                        "median_s": dMedian, "min_s": dMin, "samples_per_s": nChannels * nFrame / dMedian,
+                        "rel_error": error, "stored_rel_error": storedError, "equivalent": bEquivalent,
+                    })
+                    print(f"{kernel:<8} {nFrame:>6} {cType:>4} {nChannels:>4} {1e6 * dMedian:>11.1f} {nChannels * nFrame / dMedian / 1e6:>11.2f} {error:>11.2e}"
+                          + ("" if bEquivalent else "  NOT EQUIVALENT"))
+    if args.reference is not None and (args.update_reference or not os.path.exists(args.reference)):
+        np.savez_compressed(args.reference, **newReference)
+        print(f"Stored the reference outputs in {args.reference}")
+    return results, bFailed
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the cases that are slower than in baseline by more than threshold (relative).
+    """
+    old = {(r["kernel"], r["frame"], r["dtype"], r["channels"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        previous = old.get((r["kernel"], r["frame"], r["dtype"], r["channels"]))
+        if previous is not None and r["median_s"] > previous["median_s"] * (1 + threshold):
+            regressions.append((r, previous))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the DSP kernels.")
+    parser.add_argument('--kernels', nargs='+', choices=KERNELS, help='Defaults to all', default=list(KERNELS))
+    parser.add_argument('--frames', type=int, nargs='+', help='Frame sizes (samples). Defaults to ' + ' '.join(map(str, FRAMES_DEFAULT)), default=FRAMES_DEFAULT)
+    parser.add_argument('--dtypes', nargs='+', choices=['f', 'd'], help='Sample types. Defaults to f d', default=DTYPES_DEFAULT)
+    parser.add_argument('--channels', type=int, nargs='+', help='Channel counts. Defaults to ' + ' '.join(map(str, CHANNELS_DEFAULT)), default=CHANNELS_DEFAULT)
+    parser.add_argument('--max_block', type=int, help='Skip the cases with more samples per frame (channels x frame). Defaults to ' + str(MAX_BLOCK_DEFAULT), default=MAX_BLOCK_DEFAULT)
+    parser.add_argument('--min_time', type=float, help='Time spent on every case (s). Defaults to ' + str(MIN_TIME_DEFAULT), default=MIN_TIME_DEFAULT)
+    parser.add_argument('--reference', type=str, help='.npz file with the reference outputs: compared with, or created if it does not exist')
+    parser.add_argument('--update_reference', action='store_true', help='Store the current outputs in --reference')
+    parser.add_argument('--output', type=str, help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, help='JSON results of an earlier run: flag the regressions')
+    parser.add_argument('--threshold', type=float, help='Slower by more than this (relative) is a regression. Defaults to ' + str(THRESHOLD_DEFAULT), default=THRESHOLD_DEFAULT)
+    args = parser.parse_args()
+
+    results, bFailed = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({"commit": git_commit(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+                       "numpy": np.__version__, "machine": platform.node(), "results": results}, file, indent=4)
+        print(f"The results are in {args.output}")
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        for r, previous in regressions:
+            print(f"REGRESSION {r['kernel']} frame {r['frame']} {r['dtype']} {r['channels']} ch: "
+                  f"{1e6 * previous['median_s']:.1f} us -> {1e6 * r['median_s']:.1f} us (commit {baseline.get('commit', '?')})")
+        if not regressions:
+            print(f"No regressions against {args.compare} (threshold {100 * args.threshold:.0f}%)")
+        bFailed = bFailed or bool(regressions)
+    sys.exit(1 if bFailed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Size-class pool of the frame buffers, for the streams of variable-length frames (Data.Samples
+-1: irregular DAQ frames, coalesced or resampled frames).
+
+A stream of fixed-length frames keeps its preallocated buffers. A frame of another length gets
+a buffer of its size class instead of a new one: the classes are CLASS_STEPS per octave (e.g.
+1024, 1280, 1536, 1792, 2048), so at most a quarter of a buffer is unused. A buffer serves every
+length of its class (a NumPy array as a view of its first n elements, a bytearray resized in
+place, within its allocation) and goes back to the pool when its owner needs another class or
+goes away. The frames of arbitrary length so reuse a few buffers: the RSS stays flat and the
+allocator is not churned. The pool keeps at most max_bytes of free buffers, the rest is let go.
+"""
+import threading
+import numpy as np
+
+CLASS_STEPS = 4                          # size classes per octave
+MIN_CLASS = 64                           # the smallest class (elements or bytes)
+POOL_BYTES_DEFAULT = 64 * 1024 * 1024    # max bytes of free buffers kept
+
+# to grow a bytearray in place (bytearray += memoryview does not allocate within its allocation)
+ZEROS = memoryview(bytes(65536))
+
+
+def size_class(n):
+    """
+    Returns the capacity of the size class of n (elements or bytes).
+    """
+    if n <= MIN_CLASS:
+        return MIN_CLASS
+    step = (1 << ((n - 1).bit_length() - 1)) // CLASS_STEPS   # the octave below n, in CLASS_STEPS
+    return -(-n // step) * step
+
+
+def resize_bytearray(buffer, n):
+    # In place: no reallocation while n stays between half and all of the allocation
+    if n < len(buffer):
+        del buffer[n:]
+    while len(buffer) < n:
+        buffer += ZEROS[:n - len(buffer)]
+
+
+class BufferPool:
+    def __init__(self, max_bytes=POOL_BYTES_DEFAULT):
+        """
+        Parameters:
+        max_bytes: The max number of bytes of the free buffers kept
+        """
+        self.max_bytes = max_bytes
+        self.free = {}          # (dtype char or "bytes", capacity) -> the free buffers
+        self.nFreeBytes = 0
+        self.lock = threading.Lock()
+        # Counters
+        self.nTaken = 0         # buffers taken
+        self.nAllocated = 0     # of them newly allocated (the pool had none of the class)
+        self.nDropped = 0       # buffers given back but not kept (over max_bytes)
+
+    def take(self, kind, capacity):
+        # A free buffer of the class, else a new one
+        with self.lock:
+            self.nTaken += 1
+            buffers = self.free.get((kind, capacity))
+            if buffers:
+                buffer = buffers.pop()
+                self.nFreeBytes -= capacity if kind == "bytes" else buffer.nbytes
+                return buffer
+            self.nAllocated += 1
+        return bytearray(capacity) if kind == "bytes" else np.empty(capacity, dtype=kind)
+
+    def give(self, buffer):
+        """
+        Gives a buffer (taken from the pool) back, None is ignored. It may be handed out again
+        right away: only its owner gives it back, once nothing uses it any more, and drops it.
+        """
+        if buffer is None:
+            return
+        if isinstance(buffer, bytearray):
+            kind, capacity, nBytes = "bytes", size_class(len(buffer)), size_class(len(buffer))
+        else:
+            if buffer.base is not None or len(buffer) != size_class(len(buffer)):
+                # not a buffer of the pool (e.g. the preallocated one of a fixed-length stream)
+                return
+            kind, capacity, nBytes = buffer.dtype.char, len(buffer), buffer.nbytes
+        with self.lock:
+            if self.nFreeBytes + nBytes > self.max_bytes:
+                self.nDropped += 1
+                return
+            self.free.setdefault((kind, capacity), []).append(buffer)
+            self.nFreeBytes += nBytes
+
+    def fit_array(self, buffer, n, dtype=np.float64):
+        """
+        Returns an array of the size class of n (its first n elements are the ones to use):
+        buffer if it is one (or None), else one from the pool (and buffer goes back).
+        """
+        capacity = size_class(n)
+        if buffer is not None and len(buffer) == capacity and buffer.dtype == dtype:
+            return buffer
+        self.give(buffer)
+        return self.take(np.dtype(dtype).char, capacity)
+
+    def fit_bytearray(self, buffer, n):
+        """
+        Returns a bytearray of n bytes: buffer resized in place if n is in its size class,
+        else one from the pool (and buffer goes back).
+        """
+        if buffer is not None:
+            if len(buffer) == n:
+                return buffer
+            if size_class(len(buffer)) == size_class(n):
+                try:
+                    resize_bytearray(buffer, n)
+                    return buffer
+                except BufferError:
+                    # still exported (e.g. a view on it is alive): leave it
+                    buffer = None
+        self.give(buffer)
+        buffer = self.take("bytes", size_class(n))
+        resize_bytearray(buffer, n)
+        return buffer
+
+    def stats(self):
+        with self.lock:
+            return {"taken": self.nTaken, "allocated": self.nAllocated, "dropped": self.nDropped,
+                    "free_bytes": self.nFreeBytes, "free_buffers": sum(len(buffers) for buffers in self.free.values())}
@@ -0,0 +1,115 @@
+"""
+Capture files: recorded CP-SENS MQTT traffic (the data and the metadata messages, with their
+topics and arrival times), for the offline processing and the replay.
+
+File layout:
+    offset 0: b"CPSNSCAP", version (uint32), reserved (uint32)
+    then the records, back to back:
+        arrival time (float64, s since the epoch), topic length (uint16), payload length (uint32)
+        the topic (UTF-8), the payload
+
+The reader maps the file into memory (mmap): the payloads are memoryviews on the mapping, no
+copy and no read() per message, so hours of traffic can be scanned at the speed of the disk.
+"""
+import mmap
+import struct
+
+FILE_MAGIC = b"CPSNSCAP"
+FILE_VERSION = 1
+FILE_HEADER_FORMAT = '=8sII'
+FILE_HEADER_SIZE = struct.calcsize(FILE_HEADER_FORMAT)
+RECORD_HEADER_FORMAT = '=dHI'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+
+class CaptureWriter:
+    def __init__(self, strFile):
+        self.file = open(strFile, 'wb')
+        self.file.write(struct.pack(FILE_HEADER_FORMAT, FILE_MAGIC, FILE_VERSION, 0))
+        self.nRecords = 0
+
+    def write(self, t, topic, payload):
+        """
+        Appends one message.
+
+        Parameters:
+        t: The arrival time (s since the epoch)
+        topic: The MQTT topic
+        payload: The MQTT payload (str, bytes, bytearray or memoryview)
+        """
+        topicBytes = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.file.write(struct.pack(RECORD_HEADER_FORMAT, t, len(topicBytes), len(payload)))
+        self.file.write(topicBytes)
+        self.file.write(payload)
+        self.nRecords += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    def __init__(self, strFile):
+        self.file = open(strFile, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version, _ = struct.unpack_from(FILE_HEADER_FORMAT, self.map)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            self.close()
+            raise ValueError(f"{strFile} is not a CP-SENS capture file (version {FILE_VERSION})")
+        self.topics = {}   # topic bytes -> str, decoded once
+
+    def record_at(self, offset):
+        """
+        Returns (t, topic, payload, the offset of the next record) of the record at offset, None
+        at the end of the file (or at a truncated last record, e.g. the recorder was killed).
+        The payload is a memoryview on the file: do not keep it after close().
+        """
+        view = self.view
+        start = offset + RECORD_HEADER_SIZE
+        if start > len(view):
+            return None
+        t, topicLength, payloadLength = struct.unpack_from(RECORD_HEADER_FORMAT, view, offset)
+        topicBytes = bytes(view[start:start + topicLength])
+        topic = self.topics.get(topicBytes)
+        if topic is None:
+            topic = self.topics[topicBytes] = topicBytes.decode()
+        start += topicLength
+        if start + payloadLength > len(view):
+            return None
+        return t, topic, view[start:start + payloadLength], start + payloadLength
+
+    def records(self):
+        """
+        Yields (offset, t, topic, payload) for every record, see record_at.
+        """
+        offset = FILE_HEADER_SIZE
+        while True:
+            record = self.record_at(offset)
+            if record is None:
+                return
+            t, topic, payload, nextOffset = record
+            yield offset, t, topic, payload
+            offset = nextOffset
+
+    def __iter__(self):
+        for _, t, topic, payload in self.records():
+            yield t, topic, payload
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
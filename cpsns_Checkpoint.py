@@ -0,0 +1,220 @@
+"""
+Checkpoints of the stream states (--checkpoint FILE): the block states (the KF d0/v0/P, the
+filter zi, the running means...) and the metadata of every stream, written periodically and
+read on startup, so that a restarted service goes on from the warm states instead of
+converging again.
+
+File layout (little-endian):
+    b"CPSNSCKP", version (uint32), the number of streams (uint32)
+    then per stream:
+        the key (uint16 length + UTF-8), e.g. cpsens/d1/m1/1/acc/raw
+        the input metadata (uint32 length + bytes)
+        nSamplesFromDAQStart of the next frame (int64, -1 if unknown)
+        when the record was saved (float64, s since the epoch)
+        the number of blocks (uint16), then per block the number of arrays (uint16, 0 if the
+        block saved nothing) and per array:
+            the name (uint8 length + ASCII), the type (NumPy type char), ndim (uint8),
+            the shape (uint32 each), the data
+    CRC32 of everything above (uint32)
+
+The file is written to a temporary file next to it, synced and renamed over it (atomic: a
+crash leaves the previous checkpoint). The states are saved by the state objects themselves
+(get_state/set_state, dicts of NumPy arrays), see ProcessingBlock.save_state.
+
+With --workers every process writes its own file. A stream can then be in several files (e.g.
+a file of an earlier run with more workers, never written again): the newest record wins.
+
+The Checkpointer is the part of the host that takes the snapshots and writes and reads the files.
+"""
+import os
+import struct
+import sys
+import time
+import zlib
+import numpy as np
+
+CHECKPOINT_INTERVAL_DEFAULT = 60.0  # s
+FILE_MAGIC = b"CPSNSCKP"
+FILE_VERSION = 2
+FILE_HEADER_FORMAT = '<8sII'
+FILE_HEADER_SIZE = struct.calcsize(FILE_HEADER_FORMAT)
+
+
+def encode_stream(strKey, metadata, nextSample, blockStates, savedAt=None):
+    """
+    Returns the record of one stream (bytes).
+
+    Parameters:
+    strKey: The key of the stream (the topic without data/metadata)
+    metadata: The input metadata (str or bytes)
+    nextSample: nSamplesFromDAQStart of the next frame, None if unknown
+    blockStates: Per block, a dict name -> NumPy array, or None
+    savedAt: When the states were taken (time.time()), now if None
+    """
+    if isinstance(metadata, str):
+        metadata = metadata.encode()
+    keyBytes = strKey.encode()
+    parts = [struct.pack('<H', len(keyBytes)), keyBytes, struct.pack('<I', len(metadata)), metadata,
+             struct.pack('<qdH', -1 if nextSample is None else nextSample, time.time() if savedAt is None else savedAt, len(blockStates))]
+    for arrays in blockStates:
+        arrays = arrays or {}
+        parts.append(struct.pack('<H', len(arrays)))
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if array.dtype.char not in "bhilqBHILQefdg?":
+                raise ValueError(f"Cannot checkpoint the array {name} of type {array.dtype}")
+            array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+            nameBytes = name.encode('ascii')
+            parts.append(struct.pack('<B', len(nameBytes)) + nameBytes)
+            parts.append(struct.pack(f'<cB{array.ndim}I', array.dtype.char.encode(), array.ndim, *array.shape))
+            parts.append(array.tobytes())
+    return b"".join(parts)
+
+
+def write(strFile, records):
+    """
+    Writes the records (from encode_stream) atomically.
+    """
+    body = struct.pack(FILE_HEADER_FORMAT, FILE_MAGIC, FILE_VERSION, len(records)) + b"".join(records)
+    strTemp = f"{strFile}.tmp{os.getpid()}"
+    with open(strTemp, 'wb') as file:
+        file.write(body)
+        file.write(struct.pack('<I', zlib.crc32(body)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(strTemp, strFile)
+
+
+def read(strFile):
+    """
+    Returns the streams of a checkpoint file: a list of (key, metadata bytes, nextSample or
+    None, [dict name -> array per block], savedAt). Raises ValueError if the file is not a valid
+    checkpoint.
+    """
+    with open(strFile, 'rb') as file:
+        content = file.read()
+    if len(content) < FILE_HEADER_SIZE + 4:
+        raise ValueError(f"{strFile} is too short for a checkpoint")
+    body = memoryview(content)[:-4]
+    if struct.unpack_from('<I', content, len(body))[0] != zlib.crc32(body):
+        raise ValueError(f"{strFile}: the checksum does not match")
+    magic, version, nStreams = struct.unpack_from(FILE_HEADER_FORMAT, body)
+    if magic != FILE_MAGIC or version != FILE_VERSION:
+        raise ValueError(f"{strFile} is not a CP-SENS checkpoint (version {FILE_VERSION})")
+    offset = FILE_HEADER_SIZE
+    streams = []
+    for _ in range(nStreams):
+        keyLength, = struct.unpack_from('<H', body, offset)
+        offset += 2
+        strKey = bytes(body[offset:offset + keyLength]).decode()
+        offset += keyLength
+        metadataLength, = struct.unpack_from('<I', body, offset)
+        offset += 4
+        metadata = bytes(body[offset:offset + metadataLength])
+        offset += metadataLength
+        nextSample, savedAt, nBlocks = struct.unpack_from('<qdH', body, offset)
+        offset += 18
+        blockStates = []
+        for _ in range(nBlocks):
+            nArrays, = struct.unpack_from('<H', body, offset)
+            offset += 2
+            arrays = {}
+            for _ in range(nArrays):
+                nameLength = body[offset]
+                name = bytes(body[offset + 1:offset + 1 + nameLength]).decode('ascii')
+                offset += 1 + nameLength
+                cType, ndim = struct.unpack_from('<cB', body, offset)
+                offset += 2
+                shape = struct.unpack_from(f'<{ndim}I', body, offset)
+                offset += 4 * ndim
+                dtype = np.dtype(cType.decode()).newbyteorder('<')
+                count = int(np.prod(shape))
+                arrays[name] = np.reshape(np.frombuffer(body, dtype=dtype, count=count, offset=offset), shape).astype(dtype.newbyteorder('='))
+                offset += count * dtype.itemsize
+            blockStates.append(arrays if nArrays > 0 else None)
+        streams.append((strKey, metadata, None if nextSample < 0 else nextSample, blockStates, savedAt))
+    return streams
+
+
+def read_newest(strFiles):
+    """
+    Returns the newest record (as from read) of every stream in the checkpoint files, as a dict
+    key -> record. The missing files are skipped, the invalid ones reported and skipped.
+    """
+    newest = {}
+    for strFile in strFiles:
+        if not os.path.exists(strFile):
+            continue
+        try:
+            streams = read(strFile)
+        except (OSError, ValueError) as e:
+            print(f"Error: could not read the checkpoint {strFile}: {e}", file=sys.stderr)
+            continue
+        for record in streams:
+            if record[0] not in newest or record[4] > newest[record[0]][4]:
+                newest[record[0]] = record
+    return newest
+
+
+def stream_record(stream, blocks):
+    """
+    Returns the record of a stream of the host (StreamState) with the states of the blocks.
+    """
+    blockStates = [block.save_state(state) for block, state in zip(blocks, stream.blockStates)]
+    return encode_stream('/'.join(stream.key), stream.metadataIn, stream.sequence.expected, blockStates)
+
+
+def restore_stream(stream, blocks, blockStates, nextSample):
+    """
+    Puts the saved states (blockStates and nextSample, from read) into the new stream of the
+    host. Returns False if they are of another chain (the stream starts from scratch).
+    """
+    strKey = '/'.join(stream.key)
+    if len(blockStates) != len(blocks):
+        print(f"The checkpoint of {strKey} is of another chain, starting it from scratch")
+        return False
+    for i, (block, arrays) in enumerate(zip(blocks, blockStates)):
+        if arrays is not None and not block.restore_state(stream.blockStates[i], arrays):
+            print(f"The state of block {i} of {strKey} does not fit, starting it from scratch")
+    stream.sequence.expected = nextSample
+    return True
+
+
+class Checkpointer:
+    """
+    The checkpoints of a host: every shard takes the snapshot of its own streams (on its worker,
+    so that the states are not changing meanwhile) and shard 0 writes them all to strFile.
+    """
+    def __init__(self, strFile, interval=CHECKPOINT_INTERVAL_DEFAULT, nShards=1):
+        self.strFile = strFile
+        self.interval = interval
+        # restored from restoreFiles (more than one with --workers), the streams owns(key) accepts
+        self.restoreFiles = [strFile]
+        self.owns = None
+        # Per shard: the last snapshot of its streams (records) and when it was taken
+        self.parts = [None] * nShards
+        self.lastSnapshot = [time.monotonic()] * nShards
+
+    def periodic(self, snapshot, iShard=0):
+        """
+        Takes the snapshot of the shard (snapshot() returns its records) every interval s; shard 0
+        then writes the file, with the latest snapshots of all the shards.
+        """
+        if time.monotonic() - self.lastSnapshot[iShard] < self.interval:
+            return
+        self.lastSnapshot[iShard] = time.monotonic()
+        self.parts[iShard] = snapshot()
+        if iShard == 0:
+            self.write([record for part in self.parts if part is not None for record in part])
+
+    def write(self, records):
+        try:
+            write(self.strFile, records)
+        except OSError as e:
+            print(f"Error: could not write the checkpoint {self.strFile}: {e}", file=sys.stderr)
+
+    def saved_streams(self):
+        """
+        Returns the records (from read) to restore: the newest one of every stream owns accepts.
+        """
+        return [record for strKey, record in read_newest(self.restoreFiles).items() if self.owns is None or self.owns(strKey)]
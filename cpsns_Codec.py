@@ -0,0 +1,91 @@
+"""
+Decoding/encoding of the CP-SENS binary data frames.
+
+A data frame is a descriptor (header) followed by the samples:
+    offset  0: descriptorLength (uint16)
+    offset  2: metadataVer (uint16)
+    offset  4: secFromEpoch (uint64)
+    offset 12: nanosec (uint64)
+    offset 20: nSamplesFromDAQStart (uint64), only if metadataVer >= 2
+    offset descriptorLength: the samples, 'f' (float32) or 'd' (float64), see Data.Type in the metadata
+
+The samples are exposed as a NumPy view on the payload (no copy, no boxing of the samples
+into Python floats). The output frames are written into preallocated bytearrays: the header
+is copied once and the samples are written (and cast, if needed) straight into the buffer.
+"""
+import struct
+from collections import namedtuple
+import numpy as np
+
+HEADER_FORMAT = '=HHQQ'
+HEADER_FORMAT_V2 = '=HHQQQ'
+SAMPLE_INDEX_OFFSET = 20  # of nSamplesFromDAQStart
+
+FrameHeader = namedtuple("FrameHeader", ["descriptorLength", "metadataVer", "secFromEpoch", "nanosec", "nSamplesFromDAQStart"])
+
+
+def decode_header(payload):
+    """
+    Parses the descriptor of a data frame.
+
+    Returns:
+    FrameHeader (nSamplesFromDAQStart is None for metadataVer < 2)
+    """
+    descriptorLength, metadataVer = struct.unpack_from('=HH', payload)
+    if metadataVer >= 2:
+        return FrameHeader._make(struct.unpack_from(HEADER_FORMAT_V2, payload))
+    return FrameHeader._make(struct.unpack_from(HEADER_FORMAT, payload) + (None,))
+
+
+def decode_data(payload, cType, nSamples=-1, descriptorLength=None):
+    """
+    Returns the samples of a data frame as a NumPy view on the payload (read-only for bytes payloads).
+
+    Parameters:
+    payload: The MQTT payload (bytes, bytearray or memoryview)
+    cType: The sample type, 'f' or 'd' (Data.Type[0] in the metadata)
+    nSamples: The number of samples, -1 if unknown or variable (calculated from the payload length).
+              A payload of another length is taken as a variable-length frame
+    descriptorLength: The header length, read from the payload if not given
+    """
+    if descriptorLength is None:
+        descriptorLength = struct.unpack_from('=H', payload)[0]
+    dtype = np.dtype(cType)
+    if nSamples == -1 or descriptorLength + nSamples * dtype.itemsize != len(payload): # unknown or variable
+        nSamples = (len(payload) - descriptorLength) // dtype.itemsize
+    return np.frombuffer(payload, dtype=dtype, count=nSamples, offset=descriptorLength)
+
+
+def write_sample_index(out, nSamplesFromDAQStart):
+    """
+    Writes nSamplesFromDAQStart into the header of a frame (metadataVer >= 2), e.g. of an output
+    at another sampling rate than its input.
+    """
+    struct.pack_into('=Q', out, SAMPLE_INDEX_OFFSET, nSamplesFromDAQStart)
+
+
+def encode_data(payload, descriptorLength, data, cType, out=None, nSamplesFromDAQStart=None):
+    """
+    Forms an output data frame: the header of the input payload followed by data.
+
+    Parameters:
+    payload: The input payload, its first descriptorLength bytes (the header) are copied
+    descriptorLength: The header length
+    data: The samples, cast to cType when written
+    cType: The sample type of the output, 'f' or 'd'
+    out: A bytearray to write into, reused if it has the right size
+    nSamplesFromDAQStart: Written into the header instead of that of payload, if not None
+
+    Returns:
+    The bytearray with the frame (out, if it could be reused). The buffer is overwritten by
+    the next call with the same out, so publish it (QoS 0 copies it into the packet) before that.
+    """
+    dtype = np.dtype(cType)
+    frameLength = descriptorLength + len(data) * dtype.itemsize
+    if out is None or len(out) != frameLength:
+        out = bytearray(frameLength)
+    out[0:descriptorLength] = memoryview(payload)[0:descriptorLength]
+    if nSamplesFromDAQStart is not None:
+        write_sample_index(out, nSamplesFromDAQStart)
+    np.frombuffer(out, dtype=dtype, offset=descriptorLength)[:] = data
+    return out
@@ -0,0 +1,77 @@
+"""
+This program will
+1. read CP-SENS MQTT messages, both data and metadata
+2. decimate them (polyphase anti-alias filtering), by an integer or a rational factor:
+    --factor 10    1000 Hz --> 100 Hz
+    --factor 5/2   1000 Hz --> 400 Hz
+3. publish the MQTT messages (to the same broker), with modified ANALYSIS:
+    - /raw/ --> /dec/ (keeping the other parts of the topic identical)
+    - metadata will get extended the ANALYSIS CHAIN section, the sampling (the first element of
+      the ANALYSIS CHAIN) and Data.Samples are those of the output
+
+The frames of all the sensors under a node with the same time stamp are decimated in one batch,
+in the sample type of the stream (float32 or float64). nSamplesFromDAQStart of the published
+frames counts the output samples. If the frames are not a multiple of the factor the number of
+output samples varies and Data.Samples is -1.
+"""
+from fractions import Fraction
+import cpsns_Framework as fw
+import simpleDecimate as dec
+
+FACTOR_DEFAULT = "10"
+
+
+class DecimateBlock(fw.ProcessingBlock):
+    batched = True
+    resampling = True
+
+    def __init__(self, factor=FACTOR_DEFAULT):
+        """
+        Parameters:
+        factor: The decimation factor (input rate / output rate), e.g. 10, "5/2" or "2.5"
+        """
+        self.up, self.down = dec.parse_factor(factor)
+
+    def on_metadata(self, substrings, json_metadata):
+        Fs = json_metadata["Analysis chain"][0]["Sampling"]
+        newFs = Fs * self.up / self.down
+        # Instantiate the decimator
+        cType = json_metadata["Data"]["Type"][0]
+        decimator = dec.RealTimeDecimator(Fraction(self.down, self.up), cType)
+        # Modify the topic
+        substrings[5] = "dec"
+        # Modify the metadata: add to the analysis section, the blocks after this one and the
+        # subscribers get the output sampling
+        newAnalysis = {"Name": "Decimate", "Output": "decimated", "Factor": str(Fraction(self.down, self.up)),
+                       "Input sampling": Fs, "Sampling": newFs, "Delay": decimator.delay(Fs)}
+        json_metadata["Analysis chain"].append(newAnalysis)
+        json_metadata["Analysis chain"][0]["Sampling"] = newFs
+        nSamples = json_metadata["Data"]["Samples"]
+        if nSamples != -1:
+            json_metadata["Data"]["Samples"] = nSamples * self.up // self.down if nSamples * self.up % self.down == 0 else -1
+        return decimator
+
+    def output_sample(self, nSample, decimator):
+        return decimator.output_sample(nSample)
+
+    def process(self, data, decimator):
+        return decimator.apply_filter(data)
+
+    def process_batch(self, datas, decimators):
+        return dec.apply_filter_batch(decimators, datas)
+
+
+def add_arguments(parser):
+    parser.add_argument('--factor', type=str, help='Decimation factor (input rate / output rate), an integer or a fraction like 5/2. Defaults to ' + FACTOR_DEFAULT, default=FACTOR_DEFAULT)
+
+
+def create_block(args):
+    return DecimateBlock(args.factor)
+
+
+def main():
+    fw.main("Decimates the CP-SENS streams.", add_arguments, lambda args: [create_block(args)])
+
+
+if __name__ == "__main__":
+    main()
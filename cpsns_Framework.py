@@ -0,0 +1,868 @@
+"""
+Framework for the CP-SENS stream processing services.
+
+A service is a chain of processing blocks run by a host:
+1. the host subscribes to the CP-SENS MQTT messages, both data and metadata
+2. on the first metadata message of a stream every block of the chain modifies the topic and
+   the metadata (the ANALYSIS CHAIN section) and creates its per-stream state
+3. every data frame is decoded once, passed through all the blocks in memory and encoded once
+4. the results are published (MQTT_OUT), on the topic modified by the blocks
+
+Writing a block:
+    class MyBlock(ProcessingBlock):
+        def on_metadata(self, substrings, json_metadata):
+            substrings[5] = "myanalysis"                                 # modify the topic
+            json_metadata["Analysis chain"].append({"Name": "MyBlock"})  # modify the metadata
+            return MyState()                                             # per-stream state
+        def process(self, data, state):
+            return data * 2
+
+A block can also publish several outputs computed in one pass (e.g. displacement and velocity):
+it lists them in its outputs attribute, gets on_metadata_output called once per output (on
+copies of the topic and the metadata) and returns a tuple of arrays, one per output, from
+process. Such a block must be the last one of the chain.
+
+The host is run by main(), which reads the private/public JSON configuration files. The blocks
+get the public configuration (configure) and take their settings from their own section of it.
+"""
+import numpy as np
+from paho.mqtt.client import Client as MQTTClient
+from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.client import MQTTv311
+import argparse
+import collections
+import contextlib
+import copy
+import time
+import json
+import sys
+import os
+import signal
+import threading
+import cpsns_Assembler as assembler
+import cpsns_BufferPool as bufferpool
+import cpsns_Checkpoint as checkpoint
+import cpsns_Codec as codec
+import cpsns_Metrics as metrics
+import cpsns_Outbound as outbound
+import cpsns_Sequence as sequence
+import cpsns_Streams as streams
+import cpsns_WorkQueue as wq
+import cpsns_Sharding as shard
+
+# Default configuration files
+PRIVATE_CONFIG_FILE_DEFAULT = "private_config.json" # locate this file in the private folder and chmod 600 it.
+PUBLIC_CONFIG_FILE_DEFAULT = "public_config.json"   # this file can be located in a public folder
+
+MQTT_TOPIC_DEFAULT = "cpsens/+/+/+/+/raw/+"
+PORT_DEFAULT = 1883
+
+# Batched blocks get the frames of all the sensors under one node (the first NODE_KEY_LEVELS
+# levels of the topic, e.g. cpsens/<DAQ>/<module>), or of a channel set (--assemble), with the
+# same time stamp together, as one (channels x samples) block, see cpsns_Assembler
+NODE_KEY_LEVELS = 3
+GATHER_TIMEOUT_DEFAULT = 0.05 # s, how long to wait for the other sensors of the node
+
+# Processing is done on worker threads, the MQTT network thread only queues the messages
+WORKER_THREADS_DEFAULT = 1    # 0: process in the MQTT network thread
+QUEUE_SIZE_DEFAULT = 1000     # messages, per worker
+OVERFLOW_DEFAULT = "block"
+RUNTIMES = ("threads", "asyncio")
+OFFLINE_OUTPUT_DEFAULT = "offline_output"
+RUNTIME_DEFAULT = "threads"
+
+# Bounds of the stream registry
+STREAM_TTL_DEFAULT = 3600.0   # s, streams idle for longer are forgotten (0: never)
+MAX_STREAMS_DEFAULT = 0       # 0: unlimited
+SHARD_KEY_CACHE_MAX = 100000  # topics
+
+
+# Replaces the subtopics of the topic by the strings in the list
+def replace_subtopics(topic, replacements):
+    subtopics = topic.split('/')
+    for i in range(min(len(subtopics), len(replacements))):
+        if replacements[i]:
+            subtopics[i] = replacements[i]
+    return '/'.join(subtopics)
+
+
+class ProcessingBlock:
+    """
+    Base class of the processing blocks. A block modifies the topic and the metadata of a
+    stream once (on_metadata) and then processes its data frames (process).
+    """
+    # True if process_batch benefits from getting the frames of many streams at once
+    batched = False
+    # The names of the outputs if the block publishes several, None for one
+    outputs = None
+    # True if the block changes the sampling rate (output_sample maps the sample counter)
+    resampling = False
+
+    def configure(self, json_config_public):
+        """
+        Called once, before the first stream, with the public configuration (a dict, empty
+        offline without the file). Blocks take their settings from their own section of it.
+        """
+        pass
+
+    def on_metadata(self, substrings, json_metadata):
+        """
+        Called on the first metadata message of a stream.
+
+        Parameters:
+        substrings: The topic split on '/', modify it in place to change the output topic
+        json_metadata: The parsed metadata, modify it in place (e.g. extend the "Analysis chain")
+
+        Returns:
+        The per-stream state passed to process
+        """
+        return None
+
+    def process(self, data, state):
+        """
+        Processes one data frame.
+
+        Parameters:
+        data: The samples (float64 NumPy array, may be modified in place; float32 if the previous
+              block works in the type of the stream)
+        state: The per-stream state returned by on_metadata
+
+        Returns:
+        The processed samples
+        """
+        return data
+
+    def on_metadata_output(self, output, substrings, json_metadata):
+        """
+        Multi-output blocks: called after on_metadata, once for every name in outputs, with a copy
+        of the topic and the metadata for that output. Modify them in place.
+        """
+        pass
+
+    def process_batch(self, datas, states):
+        """
+        Processes the data frames of several streams (lists of the same length). By default
+        process is called for every frame; batched blocks override it with a vectorized version.
+        """
+        return [self.process(data, state) for data, state in zip(datas, states)]
+
+    def output_sample(self, nSample, state):
+        """
+        Resampling blocks: called before process with nSamplesFromDAQStart of the frame (in the
+        input of the block), returns that of the output of the frame.
+        """
+        return nSample
+
+    def save_state(self, state):
+        """
+        Returns the per-stream state as a dict of NumPy arrays (for the checkpoints), None if
+        there is nothing to save. By default the state saves itself (its get_state method).
+        """
+        return state.get_state() if hasattr(state, "get_state") else None
+
+    def restore_state(self, state, arrays):
+        """
+        Restores the arrays returned by save_state into the state just created by on_metadata.
+        Returns False if they do not fit (e.g. the block is configured differently now).
+        """
+        return state.set_state(arrays) if hasattr(state, "set_state") else False
+
+
+class Host:
+    """
+    Runs a chain of processing blocks on the CP-SENS streams: one decode, all the blocks in
+    memory, one encode and one publish per frame (or per batch of coalesced frames).
+
+    The host keeps the streams and runs the chain. The rest is done by its parts: the sequence
+    stage (cpsns_Sequence), the gathering of the channel sets (cpsns_Assembler), the
+    checkpoints (cpsns_Checkpoint), the stage times (cpsns_Metrics) and the outbound stage.
+    """
+    def __init__(self, blocks, gather_timeout=GATHER_TIMEOUT_DEFAULT, nWorkerThreads=WORKER_THREADS_DEFAULT, queue_size=QUEUE_SIZE_DEFAULT, overflow=OVERFLOW_DEFAULT, stats_interval=0,
+                 stream_ttl=STREAM_TTL_DEFAULT, max_streams=MAX_STREAMS_DEFAULT, coalesce_bytes=0, coalesce_delay=outbound.COALESCE_DELAY_DEFAULT, metrics_sample=0,
+                 gap_policy=sequence.GAP_POLICY_DEFAULT, reorder_frames=sequence.REORDER_FRAMES_DEFAULT, reorder_wait=sequence.REORDER_WAIT_DEFAULT,
+                 gap_fill_max=sequence.GAP_FILL_MAX_DEFAULT, checkpoint_file=None, checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL_DEFAULT,
+                 assemble=None, missing_policy=assembler.MISSING_POLICY_DEFAULT, pool_bytes=bufferpool.POOL_BYTES_DEFAULT):
+        self.blocks = list(blocks)
+        if any(block.outputs is not None for block in self.blocks[:-1]):
+            raise ValueError("Only the last block of the chain can have several outputs")
+        self.bMultiOutput = bool(self.blocks) and self.blocks[-1].outputs is not None
+        # the blocks that change the sampling rate renumber the samples of the output frames
+        self.bResampling = any(block.resampling for block in self.blocks)
+        nShards = self.nShards = max(1, nWorkerThreads)
+        self.myDict = streams.StreamRegistry(stream_ttl, max_streams, self.evict_stream)  # myKey -> StreamState
+        self.dataTopics = {}     # data topic -> StreamState, so that the hot path does no topic parsing
+        self.shardKeys = {}      # topic -> shard key of the work queue
+        # The messages are sharded by the stream (by the node when gathering): a shard is processed
+        # by one worker, in order, so the per-stream state needs no locking
+        self.workQueue = None
+        self.lock = threading.Lock()  # only used when processing in the MQTT network thread
+        self.stopEvent = threading.Event()
+        self.stats_interval = stats_interval
+        self.lastStats = time.monotonic()
+        self.sweep_interval = stream_ttl / 10
+        self.lastSweep = time.monotonic()
+        # the buffers of the frames of another length than the expected one (Data.Samples -1)
+        self.pool = bufferpool.BufferPool(pool_bytes)
+        # encodes and publishes the results, coalescing the frames if coalesce_bytes > 0
+        self.outbound = outbound.Outbound(None, coalesce_bytes, coalesce_delay, self.pool)
+        # gathers the frames of a channel set (a node, or the streams matching an --assemble
+        # pattern), only if some block can use them, see cpsns_Assembler
+        self.bGather = gather_timeout > 0 and (any(block.batched for block in self.blocks) or bool(assemble))
+        self.gatherer = assembler.Gatherer(gather_timeout, assembler.ChannelSets(assemble, NODE_KEY_LEVELS), missing_policy, self.pool, nShards)
+        # lost, repeated and reordered frames (nSamplesFromDAQStart), see cpsns_Sequence
+        self.sequencer = sequence.SequenceStage(gap_policy, reorder_frames, reorder_wait, gap_fill_max, nShards)
+        # saves the block states to checkpoint_file every checkpoint_interval s, restores them on startup
+        self.checkpointer = checkpoint.Checkpointer(checkpoint_file, checkpoint_interval, nShards) if checkpoint_file is not None else None
+        # the clock of the gathering and the reordering waits (the offline mode: the capture time)
+        self.clock = time.monotonic
+        # how often the periodic duties (flushing the gathered frames, the reordered frames and the
+        # coalesced frames, forgetting the idle streams, the checkpoints) run
+        self.tick = min(([gather_timeout] if self.bGather else []) + ([self.sweep_interval] if stream_ttl > 0 else [])
+                        + ([coalesce_delay] if self.outbound.bCoalesce else []) + ([reorder_wait] if reorder_frames > 0 else [])
+                        + ([checkpoint_interval] if checkpoint_file is not None else []), default=None)
+        if nWorkerThreads > 0:
+            # the workers wake up for the data, and for the periodic duties if there are any
+            intervals = ([self.tick] if self.tick is not None else []) + ([stats_interval] if stats_interval > 0 else [])
+            self.workQueue = wq.ShardedWorkQueue(self.handle_message, nWorkerThreads, queue_size, overflow,
+                                                 self.on_idle if intervals else None, min(intervals, default=None))
+            self.lock = contextlib.nullcontext()
+        # Per shard: the streams evicted from the registry (by any shard), forgotten by their own shard
+        self.evictedStreams = [collections.deque() for _ in range(nShards)]
+        # Metrics: time one processing call out of every metrics_sample (0: no timing)
+        self.timer = metrics.StageTimer(metrics_sample, nShards)
+        self.outbound.bTimed = metrics_sample > 0
+        self.nMetadata = [0] * nShards
+        self.nNoMetadata = [0] * nShards  # data frames dropped while waiting for the metadata
+        self.gauges = {}         # more gauges for /metrics: name -> (help, function), e.g. of the runtime
+        self.metricsServer = None
+        self.mqttc_in = None
+        self.mqttc_out = None
+        self.topicsToSubscribe = []
+        self.qos = 0
+
+    def on_connect_in(self, mqttc_in, userdata, flags, rc, properties=None):
+        print("MQTT_IN: Connected with response code %s" % rc)
+        for topic in self.topicsToSubscribe:
+            print(f"MQTT_IN: Subscribing to the topic {topic}...")
+            mqttc_in.subscribe(topic, qos=self.qos)
+
+    def on_connect_out(self, mqttc_out, userdata, flags, rc, properties=None):
+        print("MQTT_OUT: Connected with response code %s" % rc)
+
+    def on_subscribe(self, mqttc, userdata, mid, reason_codes, properties=None):
+        print("Subscribed. Message: " + str(mid))
+
+    def on_message(self, client, userdata, msg):
+        if self.workQueue is None:
+            self.handle_message(msg)
+            return
+        # Queue it, with the stream (or the node) as the shard key
+        self.workQueue.put(self.shard_key(msg.topic), msg)
+
+    def shard_key(self, topic):
+        shardKey = self.shardKeys.get(topic)
+        if shardKey is None:
+            if len(self.shardKeys) >= SHARD_KEY_CACHE_MAX:
+                self.shardKeys.clear()
+            myKey = tuple(topic.split('/')[:-1])
+            shardKey = self.shardKeys[topic] = self.gatherer.channelSets.group_key(myKey) if self.bGather else myKey
+        return shardKey
+
+    def handle_message(self, msg, iShard=0):
+        if self.evictedStreams[iShard]:
+            self.forget_evicted(iShard)
+        # Hot path: a data topic that is already known
+        stream = self.dataTopics.get(msg.topic)
+        if stream is not None:
+            stream.lastSeen = time.monotonic()
+            self.on_data(stream, msg.payload, iShard)
+            return
+
+        topic = msg.topic
+        substrings = topic.split('/')
+        if substrings[-1] == "data":
+            bIsMetadata = False
+        elif substrings[-1] == "metadata":
+            bIsMetadata = True
+        else:
+            raise Exception("Unknown topic" + substrings[-1])
+
+        # Create a tuple made of the topic string without the last element (data/metadata)
+        myKey = tuple(substrings[:-1])
+
+        if bIsMetadata:
+            self.nMetadata[iShard] += 1
+            self.on_metadata(myKey, substrings, msg.payload)
+        elif myKey in self.myDict:
+            stream = self.dataTopics[topic] = self.myDict[myKey]
+            self.on_data(stream, msg.payload, iShard)
+        else:
+            self.nNoMetadata[iShard] += 1
+            print("Waiting for the metadata...")
+
+    def on_metadata(self, myKey, substrings, payload):
+        with self.lock:
+            stream = self.myDict.get(myKey)
+            if stream is not None:
+                if stream.metadataIn == payload:
+                    # Nothing new: the outputs have already got it
+                    stream.lastSeen = time.monotonic()
+                    return
+                # The metadata has changed: start the stream again
+                print(f"The metadata of {'/'.join(myKey)} has changed")
+                self.myDict.remove(myKey)
+                stream = None
+            if stream is None:
+                # Parse the payload
+                json_metadata = json.loads(payload)
+                nSamples = json_metadata['Data']['Samples']
+                cType = json_metadata['Data']['Type'][0]
+                # Every block modifies the topic and the metadata and creates its state
+                blockStates = [block.on_metadata(substrings, json_metadata) for block in self.blocks]
+                if self.bMultiOutput:
+                    outputs = []
+                    for name in self.blocks[-1].outputs:
+                        # every output modifies its own copy
+                        outputSubstrings = list(substrings)
+                        outputMetadata = copy.deepcopy(json_metadata)
+                        self.blocks[-1].on_metadata_output(name, outputSubstrings, outputMetadata)
+                        outputs.append(self.create_output(name, myKey, outputSubstrings, outputMetadata))
+                else:
+                    outputs = [self.create_output(None, myKey, substrings, json_metadata)]
+                nodeKey = self.gatherer.channelSets.group_key(myKey)
+                stream = streams.StreamState(myKey, nodeKey, nSamples, cType, outputs, blockStates)
+                stream.metadataIn = payload
+                stream.sequence = self.sequencer.tracker(stream.dtype.itemsize)
+                self.gatherer.add_stream(stream)
+                self.myDict.add(stream)
+            stream.lastSeen = time.monotonic()
+        # Publish it!
+        for output in stream.outputs:
+            print(f"Publish {output.metadataTopic}...")
+            self.outbound.publish_metadata(output)
+
+    def create_output(self, name, myKey, substrings, json_metadata):
+        newMetadataTopic = '/'.join(substrings[:-1] + ["metadata"])
+        newDataTopic = '/'.join(substrings[:-1] + ["data"])
+        if tuple(substrings[:-1]) == myKey:
+            # e.g. a passthrough output of a chain that does not change the topic
+            print(f"Warning: the output {name} of {'/'.join(myKey)} would be published on the input topic", file=sys.stderr)
+        if self.outbound.bCoalesce:
+            # the coalesced frames have a variable number of samples
+            json_metadata["Data"]["Samples"] = -1
+        # Serialized once, compactly
+        return streams.StreamOutput(name, json.dumps(json_metadata, separators=(',', ':')), newMetadataTopic, newDataTopic)
+
+    def on_data(self, stream, payload, iShard=0):
+        stream.nFrames += 1
+        stream.nBytes += len(payload)
+        with self.lock:
+            # in sequence: the frame (and the frames it was missing for), or nothing
+            for payload in self.sequencer.push(stream, payload, self.clock() if self.sequencer.reorder_frames > 0 else 0.0, iShard):
+                self.gather_frame(stream, payload, iShard)
+
+    def gather_frame(self, stream, payload, iShard=0):
+        """
+        Processes the frame, or keeps it until the other sensors of the channel set have
+        delivered the same time step. Must be called with the lock held.
+        """
+        if not self.bGather:
+            self.process_frames({stream: payload}, iShard)
+            return
+        for frames, assembly in self.gatherer.gather(stream, payload, self.clock(), iShard):
+            self.process_frames(frames, iShard, assembly)
+
+    def process_frames(self, frames, iShard=0, assembly=None):
+        """
+        Runs the frames (a dict StreamState -> payload) through the chain and publishes the
+        results. Must be called with the lock held.
+
+        With the Assembly of a channel set, the frames (of the same length) are decoded into its
+        block and the missing channels (payload None) are filled by the missing policy.
+        """
+        t0 = self.timer.start(iShard)
+        headers = []
+        datas = []
+        for stream, payload in frames.items():
+            if payload is None:
+                # a missing channel, filled below
+                headers.append(None)
+                datas.append(None)
+                continue
+            header = codec.decode_header(payload)
+            headers.append(header)
+            if stream.sequence.gaps:
+                # samples are missing before this frame
+                self.handle_gap(stream, header)
+            # one decode per frame
+            samples = codec.decode_data(payload, stream.cType, stream.nSamples, header.descriptorLength)
+            datas.append(samples)
+            if len(samples) > 0:
+                stream.sequence.lastSample = samples[-1]
+            if self.bResampling and header.nSamplesFromDAQStart is not None:
+                # nSamplesFromDAQStart of the output
+                nSample = header.nSamplesFromDAQStart
+                for i, block in enumerate(self.blocks):
+                    if block.resampling:
+                        nSample = block.output_sample(nSample, stream.blockStates[i])
+                headers[-1] = header._replace(nSamplesFromDAQStart=nSample)
+        # into the float64 working buffers: the rows of the block of the channel set, or of every stream
+        nSamples = next((len(samples) for samples in datas if samples is not None), 0)
+        if assembly is not None and all(samples is None or len(samples) == nSamples for samples in datas):
+            block = assembly.buffer(len(datas), nSamples, self.pool)
+            for j, (stream, samples) in enumerate(zip(frames, datas)):
+                if samples is not None:
+                    np.copyto(block[j], samples)
+                else:
+                    self.gatherer.fill_missing(stream, block[j])
+            datas = assembler.FrameBlock(block)
+        else:
+            for j, (stream, samples) in enumerate(zip(frames, datas)):
+                data = stream.input_buffer(nSamples if samples is None else len(samples), self.pool)
+                if samples is not None:
+                    np.copyto(data, samples)
+                else:
+                    self.gatherer.fill_missing(stream, data)
+                datas[j] = data
+        bTimed = t0 is not None
+        if bTimed:
+            t1 = self.timer.record("decode", t0, iShard)
+        for i, block in enumerate(self.blocks):
+            datas = block.process_batch(datas, [stream.blockStates[i] for stream in frames])
+        if bTimed:
+            self.timer.record("compute", t1, iShard)
+        for (stream, payload), header, data in zip(frames.items(), headers, datas):
+            if payload is None:
+                # a filled channel is not published
+                continue
+            for output, samples in zip(stream.outputs, data if self.bMultiOutput else (data,)):
+                if self.bResampling and len(samples) == 0:
+                    # no output for this frame (e.g. shorter than the decimation factor, no spectrum due)
+                    continue
+                # Form the payload (the header of the input frame) and publish it
+                self.outbound.send(output, payload, header, samples, stream.cType, bTimed)
+
+    def handle_gap(self, stream, header):
+        """
+        Applies the gap policy to the samples missing before the frame (of the header).
+        Must be called with the lock held.
+        """
+        nGap = self.sequencer.take_gap(stream.sequence, header.nSamplesFromDAQStart)
+        if nGap is None:
+            return
+        if nGap == sequence.RESET:
+            self.reset_stream(stream)
+            return
+        # Run the filling through the blocks, so that their states skip the gap; nothing is published
+        data = self.sequencer.filling(stream.sequence, nGap)
+        for i, block in enumerate(self.blocks):
+            data = block.process_batch([data], [stream.blockStates[i]])[0]
+
+    def reset_stream(self, stream):
+        """
+        Starts the block states of the stream again, as from its metadata (the topics and the
+        published metadata do not change).
+        """
+        json_metadata = json.loads(stream.metadataIn)
+        substrings = list(stream.key) + ["metadata"]
+        stream.blockStates = [block.on_metadata(substrings, json_metadata) for block in self.blocks]
+
+    def flush_reordered(self, iShard=0, bAll=False):
+        """
+        Processes the frames that have waited longer than reorder_wait for the missing frames of
+        their stream (all of them with bAll, e.g. when stopping).
+        """
+        now = self.clock()
+        with self.lock:
+            for stream, payload in self.sequencer.expire(now, iShard, bAll):
+                self.gather_frame(stream, payload, iShard)
+
+    def sequence_stats(self):
+        """
+        Returns the totals of the sequence counters of the streams.
+        """
+        return self.sequencer.stats(list(self.myDict.streams.values()))
+
+    def flush_pending(self, iShard=0, bAll=False):
+        """
+        Processes the time steps (of the shard) that have waited longer than gather_timeout for
+        the rest of the sensors of the node (all of them with bAll, e.g. when stopping).
+        """
+        now = self.clock()
+        with self.lock:
+            for frames, assembly in self.gatherer.expire(now, iShard, bAll):
+                self.process_frames(frames, iShard, assembly)
+
+    def evict_stream(self, stream):
+        """
+        Called when the stream is evicted from the registry (by the shard that added a stream or
+        swept them): its own shard forgets it, before its next message or periodic duties, so
+        that no shard changes what another one is working on.
+        """
+        if self.workQueue is None:
+            # one thread (the lock is held)
+            self.forget_stream(stream)
+            return
+        self.evictedStreams[self.shard_of_stream(stream)].append(stream)
+
+    def forget_evicted(self, iShard=0):
+        # On the worker of the shard
+        evictedStreams = self.evictedStreams[iShard]
+        with self.lock:
+            while evictedStreams:
+                self.forget_stream(evictedStreams.popleft(), iShard)
+
+    def forget_stream(self, stream, iShard=0):
+        """
+        Drops everything that refers to the evicted stream, on its own shard. Its next metadata
+        message creates it again, from scratch (maybe already done: then the new stream is kept).
+        """
+        bRecreated = self.myDict.get(stream.key) is not None
+        dataTopic = '/'.join(stream.key + ("data",))
+        if self.dataTopics.get(dataTopic) is stream:
+            del self.dataTopics[dataTopic]
+        if not bRecreated:
+            self.shardKeys.pop(dataTopic, None)
+            self.shardKeys.pop('/'.join(stream.key + ("metadata",)), None)
+        self.sequencer.forget(stream, iShard)
+        self.gatherer.remove_stream(stream)
+        # its buffers go back to the pool (on its shard, so nothing is decoding into them) once its
+        # pending batch is published; a frame of it still waiting somewhere takes new ones
+        for output in stream.outputs:
+            self.outbound.close(output)
+            self.pool.give(output.outBuffer)
+            output.outBuffer = None
+        self.pool.give(stream.poolBuffer)
+        stream.poolBuffer = None
+        print(f"Forgot the stream {'/'.join(stream.key)}")
+
+    def sweep_streams(self):
+        if self.myDict.ttl > 0 and time.monotonic() - self.lastSweep >= self.sweep_interval:
+            self.lastSweep = time.monotonic()
+            with self.lock:
+                self.myDict.sweep()
+
+    def memory_report(self):
+        """
+        Returns the total number of bytes held by the streams and the largest streams.
+        """
+        report = self.myDict.memory_report()
+        largest = sorted(report.items(), key=lambda item: item[1], reverse=True)[:5]
+        return f"{len(report)} streams, {sum(report.values())} bytes, {self.myDict.nEvicted} evicted, largest: {largest}"
+
+    def collect_metrics(self):
+        """
+        Returns the metrics in the Prometheus text format (called by the /metrics endpoint).
+        """
+        exposition = metrics.Exposition()
+        streamList = list(self.myDict.streams.values())
+        exposition.metric("cpsns_messages_total", "counter", "Data frames received, per input topic",
+                          [({"topic": '/'.join(stream.key + ("data",))}, stream.nFrames) for stream in streamList])
+        exposition.metric("cpsns_received_bytes_total", "counter", "Data bytes received, per input topic",
+                          [({"topic": '/'.join(stream.key + ("data",))}, stream.nBytes) for stream in streamList])
+        exposition.metric("cpsns_metadata_messages_total", "counter", "Metadata messages received", sum(self.nMetadata))
+        exposition.metric("cpsns_streams", "gauge", "Streams with known metadata", len(streamList))
+        exposition.metric("cpsns_streams_evicted_total", "counter", "Streams forgotten (idle or over --max_streams)", self.myDict.nEvicted)
+        dropped = [({"reason": "no_metadata"}, sum(self.nNoMetadata))]
+        if self.workQueue is not None and self.workQueue.bRunning:
+            # (the asyncio runtime feeds the shards itself, it adds its own gauges)
+            queueStats = self.workQueue.stats()
+            exposition.metric("cpsns_queue_depth", "gauge", "Messages waiting in the work queue", queueStats["depth"])
+            exposition.metric("cpsns_queue_max_depth", "gauge", "The highest depth of a work queue shard", queueStats["max_depth"])
+            exposition.metric("cpsns_queue_blocked_total", "counter", "Times the MQTT thread waited for room in the work queue", queueStats["blocked"])
+            exposition.metric("cpsns_processing_errors_total", "counter", "Messages that raised an exception", queueStats["errors"])
+            dropped += [({"reason": "drop_oldest"}, queueStats["dropped_oldest"]), ({"reason": "drop_newest"}, queueStats["dropped_newest"])]
+            exposition.histogram("cpsns_handoff_seconds", "Time from the MQTT thread to the processing", [({}, self.workQueue.latency_histogram())])
+        dropped.append(({"reason": "missing_policy"}, sum(self.gatherer.nDropped)))
+        exposition.metric("cpsns_frames_dropped_total", "counter", "Data frames dropped", dropped)
+        if self.bGather:
+            self.gatherer.add_metrics(exposition)
+        self.sequencer.add_metrics(exposition, streamList)
+        for name, (strHelp, function) in self.gauges.items():
+            exposition.metric(name, "gauge", strHelp, function())
+        poolStats = self.pool.stats()
+        exposition.metric("cpsns_buffer_pool_taken_total", "counter", "Buffers taken from the pool (frames of another length than Data.Samples)", poolStats["taken"])
+        exposition.metric("cpsns_buffer_pool_allocated_total", "counter", "Of them newly allocated (none free in their size class)", poolStats["allocated"])
+        exposition.metric("cpsns_buffer_pool_free_bytes", "gauge", "Bytes of the free buffers in the pool", poolStats["free_bytes"])
+        outboundStats = self.outbound.stats()
+        exposition.metric("cpsns_published_frames_total", "counter", "Processed frames published", outboundStats["frames"])
+        exposition.metric("cpsns_published_messages_total", "counter", "Data messages published (coalesced frames count once)", outboundStats["published"])
+        exposition.metric("cpsns_published_bytes_total", "counter", "Data bytes published", outboundStats["bytes"])
+        with self.outbound.lock:
+            encodeTime = metrics.merged([self.outbound.encodeTime])
+            publishTime = metrics.merged([self.outbound.publishTime])
+            lag = metrics.merged([self.outbound.lag])
+        exposition.histogram("cpsns_stage_seconds", f"Time per processing call (one of every {self.timer.nSample}), per stage", [
+            ({"stage": "decode"}, self.timer.merged("decode")),
+            ({"stage": "compute"}, self.timer.merged("compute")),
+            ({"stage": "encode"}, encodeTime),
+            ({"stage": "publish"}, publishTime),
+        ])
+        exposition.histogram("cpsns_frame_lag_seconds", "Publish time minus the time stamp of the frame", [({}, lag)])
+        return exposition.text()
+
+    def serve_metrics(self, port, addr=metrics.METRICS_ADDR_DEFAULT):
+        self.metricsServer = metrics.MetricsServer(port, self.collect_metrics, addr)
+
+    def shard_of_stream(self, stream):
+        if self.workQueue is None:
+            return 0
+        return self.workQueue.shard_of(stream.nodeKey if self.bGather else stream.key)
+
+    def snapshot_streams(self, iShard=None):
+        """
+        Returns the checkpoint records of the streams of the shard (all the streams if iShard is
+        None). Called on the worker of the shard, so that the states are not changing meanwhile.
+        """
+        with self.lock:
+            return [checkpoint.stream_record(stream, self.blocks) for stream in list(self.myDict.streams.values())
+                    if iShard is None or self.shard_of_stream(stream) == iShard]
+
+    def write_checkpoint(self):
+        """
+        Writes the checkpoint file with a snapshot of all the streams now (e.g. when stopping).
+        """
+        self.checkpointer.write(self.snapshot_streams())
+
+    def restore_checkpoint(self):
+        """
+        Creates the streams saved in the checkpoint files (their metadata is published again)
+        with the saved block states. Call it when MQTT_OUT is there, before the first message.
+        """
+        savedStreams = self.checkpointer.saved_streams()
+        nRestored = 0
+        for strKey, metadata, nextSample, blockStates, _ in savedStreams:
+            myKey = tuple(strKey.split('/'))
+            if myKey in self.myDict:
+                continue
+            self.on_metadata(myKey, list(myKey) + ["metadata"], metadata)
+            if checkpoint.restore_stream(self.myDict[myKey], self.blocks, blockStates, nextSample):
+                nRestored += 1
+        if savedStreams:
+            print(f"Restored {nRestored} streams from {', '.join(self.checkpointer.restoreFiles)}")
+
+    def periodic(self, iShard=0):
+        """
+        The periodic duties (every tick seconds) of a shard.
+        """
+        if self.evictedStreams[iShard]:
+            self.forget_evicted(iShard)
+        if self.sequencer.reorder_frames > 0:
+            # Process the frames that waited too long for the missing ones
+            self.flush_reordered(iShard)
+        if self.bGather:
+            # Process the time steps for which some of the sensors did not deliver
+            self.flush_pending(iShard)
+        if self.checkpointer is not None:
+            # (one shard: the snapshot of all the streams)
+            self.checkpointer.periodic(lambda: self.snapshot_streams(iShard if self.nShards > 1 else None), iShard)
+        if iShard == 0:
+            self.sweep_streams()
+            self.outbound.flush_expired()
+
+    def on_idle(self, iShard):
+        """
+        Periodic duties of the workers.
+        """
+        self.periodic(iShard)
+        if iShard == 0 and self.stats_interval > 0 and time.monotonic() - self.lastStats >= self.stats_interval:
+            self.lastStats = time.monotonic()
+            print(f"Work queue: {self.workQueue.stats()}")
+            print(f"Hand-off latency: {self.workQueue.latency_histogram().summary()}")
+            print(f"Streams: {self.memory_report()}")
+            print(f"Published: {self.outbound.stats()}")
+            print(f"Sequence: {self.sequence_stats()}")
+
+    def connect_out(self, json_config_private):
+        # MQTT_OUT stuff
+        self.mqttc_out = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
+        # Set username and password
+        if json_config_private["MQTT_OUT"]["userId"] != "":
+            self.mqttc_out.username_pw_set(json_config_private["MQTT_OUT"]["userId"], json_config_private["MQTT_OUT"]["password"])
+        self.mqttc_out.on_connect = self.on_connect_out
+        self.mqttc_out.connect(json_config_private["MQTT_OUT"]["host"], json_config_private["MQTT_OUT"]["port"], 60)
+        self.mqttc_out.loop_start()
+        self.outbound.mqttc_out = self.mqttc_out
+        # MQTT_OUT done
+
+    def connect_in(self, json_config_private, json_config_public):
+        self.topicsToSubscribe = json_config_public["MQTT_IN"]["TopicsToSubscribe"]
+        self.qos = json_config_public["MQTT_IN"]["QoS"]
+        # MQTT_IN stuff
+        self.mqttc_in = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
+        # Set username and password
+        if json_config_private["MQTT_IN"]["userId"] != "":
+            self.mqttc_in.username_pw_set(json_config_private["MQTT_IN"]["userId"], json_config_private["MQTT_IN"]["password"])
+        self.mqttc_in.on_connect = self.on_connect_in
+        self.mqttc_in.on_message = self.on_message
+        self.mqttc_in.on_subscribe = self.on_subscribe
+        self.mqttc_in.connect(json_config_private["MQTT_IN"]["host"], json_config_private["MQTT_IN"]["port"], 60) # we subscribe to the topics in on_connect callback
+        self.mqttc_in.loop_start()
+        # MQTT_IN done
+
+    def run(self, json_config_private, json_config_public):
+        if self.workQueue is not None:
+            # the main thread is the worker of shard 0
+            self.workQueue.start(bMainThreadWorker=True)
+        # MQTT_OUT first, so that it is there when the first message arrives
+        self.connect_out(json_config_private)
+        if self.checkpointer is not None:
+            self.restore_checkpoint()
+            # SIGTERM (e.g. a rolling upgrade) exits through the finally below
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.connect_in(json_config_private, json_config_public)
+
+        try:
+            if self.workQueue is not None:
+                # Wakes up exactly when data arrives, and processes all the pending frames at once
+                self.workQueue.run_worker(0)
+            elif self.tick is not None:
+                # Processing in the MQTT thread: only the periodic duties are done here
+                while not self.stopEvent.wait(self.tick):
+                    self.periodic()
+            else:
+                self.stopEvent.wait()
+        finally:
+            if self.checkpointer is not None:
+                self.write_checkpoint()
+
+
+def read_config(strConfigFile, strWhat):
+    # Read the configuration file
+    print(f"Reading {strWhat} configuration from {strConfigFile}...")
+    if os.path.exists(strConfigFile):
+        try:
+            # Open and read the JSON file
+            with open(strConfigFile, 'r') as file:
+                return json.load(file)
+        except json.JSONDecodeError:
+            print(f"Error: The file {strConfigFile} exists but could not be parsed as JSON.", file=sys.stderr)
+            sys.exit(1)
+    else:
+        print(f"Error: The file {strConfigFile} does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+
+def add_host_arguments(parser):
+    parser.add_argument('--config_private', type=str, help='Specify the JSON configuration file for PRIVATE data. Defaults to ' + PRIVATE_CONFIG_FILE_DEFAULT, default=PRIVATE_CONFIG_FILE_DEFAULT)
+    parser.add_argument('--config_public', type=str, help='Specify the JSON configuration file for PUBLIC data. Defaults to ' + PUBLIC_CONFIG_FILE_DEFAULT, default=PUBLIC_CONFIG_FILE_DEFAULT)
+    parser.add_argument('--host', type=str, help='Instead of the configuration files: the broker to connect to (both in and out)')
+    parser.add_argument('--port', type=int, help='Instead of the configuration files: the port of the broker. Defaults to ' + str(PORT_DEFAULT), default=PORT_DEFAULT)
+    parser.add_argument('--username', type=str, help='Instead of the configuration files: the username for the broker. See also the --pw argument', default="")
+    parser.add_argument('--pw', type=str, help='Instead of the configuration files: the password for the broker. See also the --username option', default="")
+    parser.add_argument('--topic', type=str, help='Instead of the configuration files: the topic to subscribe to. Defaults to ' + MQTT_TOPIC_DEFAULT, default=MQTT_TOPIC_DEFAULT)
+    parser.add_argument('--gather_timeout', type=float, help='Max time (in s) to wait for the frames of all the sensors of a node (or a channel set) before processing them in one batch (batched blocks, or --assemble). Defaults to ' + str(GATHER_TIMEOUT_DEFAULT), default=GATHER_TIMEOUT_DEFAULT)
+    parser.add_argument('--assemble', type=str, nargs='+', metavar='PATTERN', help='Channel sets processed together as one (channels x samples) block: the streams matching an MQTT pattern of the topic without data/metadata, e.g. cpsens/d1/+/+/acc/raw. Defaults to the nodes (batched blocks only)')
+    parser.add_argument('--missing_policy', type=str, choices=assembler.MISSING_POLICIES, help='What to do with the channels of a set missing after --gather_timeout: partial (process the others), drop (the time step), zero/hold (run zeros/the last sample through their blocks). Defaults to ' + assembler.MISSING_POLICY_DEFAULT, default=assembler.MISSING_POLICY_DEFAULT)
+    parser.add_argument('--worker_threads', type=int, help='Number of the processing threads, 0 to process in the MQTT thread. Defaults to ' + str(WORKER_THREADS_DEFAULT), default=WORKER_THREADS_DEFAULT)
+    parser.add_argument('--queue_size', type=int, help='Capacity of the work queue of every processing thread (messages). Defaults to ' + str(QUEUE_SIZE_DEFAULT), default=QUEUE_SIZE_DEFAULT)
+    parser.add_argument('--overflow', type=str, choices=wq.OVERFLOW_POLICIES, help='What to do when a work queue is full. Defaults to ' + OVERFLOW_DEFAULT, default=OVERFLOW_DEFAULT)
+    parser.add_argument('--stream_ttl', type=float, help='Forget the streams idle for longer than that many seconds (they are rebuilt from their next metadata), 0 for never. Defaults to ' + str(STREAM_TTL_DEFAULT), default=STREAM_TTL_DEFAULT)
+    parser.add_argument('--max_streams', type=int, help='Max number of streams kept, the least recently seen are forgotten first, 0 for unlimited. Defaults to ' + str(MAX_STREAMS_DEFAULT), default=MAX_STREAMS_DEFAULT)
+    parser.add_argument('--pool_size', type=int, help='Max free memory (in MiB) kept in the pool of the buffers of the variable-length frames (Data.Samples -1). Defaults to ' + str(bufferpool.POOL_BYTES_DEFAULT // (1024 * 1024)), default=bufferpool.POOL_BYTES_DEFAULT // (1024 * 1024))
+    parser.add_argument('--coalesce_bytes', type=int, help='Publish the consecutive frames of a topic as one frame of up to that many bytes (Data.Samples becomes -1), 0 for one message per frame. Defaults to 0', default=0)
+    parser.add_argument('--coalesce_delay', type=float, help='Max time (in s) a frame waits to be coalesced (with --coalesce_bytes). Defaults to ' + str(outbound.COALESCE_DELAY_DEFAULT), default=outbound.COALESCE_DELAY_DEFAULT)
+    parser.add_argument('--runtime', type=str, choices=RUNTIMES, help='threads: a paho network thread per MQTT client and --worker_threads processing threads; asyncio: all the MQTT clients (MQTT_IN/MQTT_OUT can be lists of brokers) on one event loop, the processing on --worker_threads executor threads (needs aiomqtt). Defaults to ' + RUNTIME_DEFAULT, default=RUNTIME_DEFAULT)
+    parser.add_argument('--offline', type=str, metavar='CAPTURE', help='Process a capture file instead of the MQTT traffic (no broker; of the configuration files only the public one is read, if it exists, for the settings of the blocks) and write the results to --offline_output')
+    parser.add_argument('--offline_output', type=str, help='The output directory of --offline (.npy files). Defaults to ' + OFFLINE_OUTPUT_DEFAULT, default=OFFLINE_OUTPUT_DEFAULT)
+    parser.add_argument('--offline_processes', type=int, help='The number of the processes of --offline, 0 for all the cores. Defaults to 0', default=0)
+    parser.add_argument('--offline_block', type=int, help='With --offline: join the frames of a stream into blocks of at least that many samples (faster; the integration results depend on the blocks), 0 to keep the recorded frames. Defaults to 0', default=0)
+    parser.add_argument('--workers', type=int, help='Number of the worker processes; the streams are distributed among them, each one processes its streams in its main thread. 0 to run in this process. Defaults to 0', default=0)
+    parser.add_argument('--ring_size', type=int, help='Size of the shared-memory buffer of every worker process, in MiB (with --workers). Defaults to ' + str(shard.RING_SIZE_DEFAULT), default=shard.RING_SIZE_DEFAULT)
+    parser.add_argument('--stats_interval', type=float, help='Print the work queue counters and the hand-off latency histogram every that many seconds, 0 for never. Defaults to 0', default=0)
+    parser.add_argument('--gap_policy', type=str, choices=sequence.GAP_POLICIES, help='What to do with the samples lost before a frame (nSamplesFromDAQStart): none (only count them), zero/extrapolate (run zeros/the last sample through the blocks), reset (start the block states again). Defaults to ' + sequence.GAP_POLICY_DEFAULT, default=sequence.GAP_POLICY_DEFAULT)
+    parser.add_argument('--reorder_frames', type=int, help='Hold up to that many early frames per stream while waiting for the missing ones, 0 for no reordering. Defaults to ' + str(sequence.REORDER_FRAMES_DEFAULT), default=sequence.REORDER_FRAMES_DEFAULT)
+    parser.add_argument('--reorder_wait', type=float, help='Max time (in s) a frame waits for the missing ones (with --reorder_frames). Defaults to ' + str(sequence.REORDER_WAIT_DEFAULT), default=sequence.REORDER_WAIT_DEFAULT)
+    parser.add_argument('--gap_fill_max', type=int, help='Longer gaps (in samples) reset the block states whatever the --gap_policy. Defaults to ' + str(sequence.GAP_FILL_MAX_DEFAULT), default=sequence.GAP_FILL_MAX_DEFAULT)
+    parser.add_argument('--checkpoint', type=str, metavar='FILE', help='Save the block states of the streams to FILE every --checkpoint_interval s and on exit, and restore them on startup (with --workers: FILE.<worker>)')
+    parser.add_argument('--checkpoint_interval', type=float, help='How often the checkpoint is written (in s). Defaults to ' + str(checkpoint.CHECKPOINT_INTERVAL_DEFAULT), default=checkpoint.CHECKPOINT_INTERVAL_DEFAULT)
+    parser.add_argument('--metrics_port', type=int, help='Serve the Prometheus metrics on http://<metrics_addr>:<port>/metrics (with --workers: the router on that port, worker i on port+1+i), 0 for no metrics. Defaults to 0', default=0)
+    parser.add_argument('--metrics_addr', type=str, help='The address of the metrics endpoint. Defaults to ' + metrics.METRICS_ADDR_DEFAULT, default=metrics.METRICS_ADDR_DEFAULT)
+    parser.add_argument('--metrics_sample', type=int, help='Time the stages of one processing call out of every that many (with --metrics_port). Defaults to ' + str(metrics.METRICS_SAMPLE_DEFAULT), default=metrics.METRICS_SAMPLE_DEFAULT)
+
+
+def load_configs(args):
+    """
+    Returns (json_config_private, json_config_public): read from the files, or made from
+    --host/--port/... (one broker for both in and out)
+    """
+    if args.host is not None:
+        broker = {"host": args.host, "port": args.port, "userId": args.username, "password": args.pw}
+        json_config_private = {"MQTT_IN": broker, "MQTT_OUT": broker}
+        json_config_public = {"MQTT_IN": {"TopicsToSubscribe": [args.topic], "QoS": 0}}
+        return json_config_private, json_config_public
+    return read_config(args.config_private, "private"), read_config(args.config_public, "public")
+
+
+def configure_blocks(blocks, json_config_public):
+    # Returns the blocks, configured
+    for block in blocks:
+        block.configure(json_config_public)
+    return blocks
+
+
+def main(description, add_arguments=None, create_blocks=None):
+    """
+    The main() of a service: parses the command line, reads the configuration and runs the
+    host with the blocks returned by create_blocks(args).
+    """
+    # Parse command line parameters
+    parser = argparse.ArgumentParser(description=description)
+    add_host_arguments(parser)
+    if add_arguments is not None:
+        add_arguments(parser)
+    args = parser.parse_args()
+    if args.workers > 0 and args.overflow == "drop-oldest":
+        parser.error("--overflow drop-oldest is not available with --workers")
+    if args.runtime == "asyncio" and (args.workers > 0 or args.overflow != "block"):
+        parser.error("--runtime asyncio works in one process, with --overflow block (backpressure)")
+    if args.runtime == "asyncio":
+        # (imported only here: the other runtimes do without aiomqtt)
+        try:
+            import cpsns_AsyncRuntime as arun
+        except ModuleNotFoundError as e:
+            if e.name != "aiomqtt":
+                raise
+            parser.error("--runtime asyncio needs the aiomqtt package (pip install aiomqtt, see requirements.txt)")
+    # the same in every runtime
+    hostOptions = dict(gap_policy=args.gap_policy, reorder_frames=args.reorder_frames, reorder_wait=args.reorder_wait, gap_fill_max=args.gap_fill_max,
+                       assemble=args.assemble, missing_policy=args.missing_policy, pool_bytes=args.pool_size * 1024 * 1024)
+    # the sensors processed together (a channel set) go to the same worker
+    channelSets = assembler.ChannelSets(args.assemble, NODE_KEY_LEVELS)
+
+    if args.offline is not None:
+        import cpsns_Offline as offline
+        # no broker: the public configuration only has the settings of the blocks, if any
+        json_config_public = read_config(args.config_public, "public") if os.path.exists(args.config_public) else {}
+        blocks = configure_blocks(create_blocks(args), json_config_public)
+        bGather = args.gather_timeout > 0 and (any(block.batched for block in blocks) or bool(args.assemble))
+        offline.run(args.offline, args.offline_output, lambda: Host(blocks, args.gather_timeout, 0, stream_ttl=0, **hostOptions),
+                    channelSets.group_key if bGather else None, args.offline_processes, args.offline_block)
+        return
+    json_config_private, json_config_public = load_configs(args)
+    metrics_sample = args.metrics_sample if args.metrics_port > 0 else 0
+    # (not offline)
+    hostOptions.update(checkpoint_file=args.checkpoint, checkpoint_interval=args.checkpoint_interval)
+    if args.workers > 0:
+        # One subscriber, the streams are processed by the worker processes
+        blocks = configure_blocks(create_blocks(args), json_config_public)
+        bGather = args.gather_timeout > 0 and (any(block.batched for block in blocks) or bool(args.assemble))
+        router = shard.ShardRouter(args.workers, args.ring_size, args.overflow == "block", channelSets.group_key if bGather else None)
+        router.run(lambda: Host(blocks, args.gather_timeout, 0, stream_ttl=args.stream_ttl, max_streams=args.max_streams,
+                                coalesce_bytes=args.coalesce_bytes, coalesce_delay=args.coalesce_delay, metrics_sample=metrics_sample, **hostOptions),
+                   json_config_private, json_config_public, args.metrics_port, args.metrics_addr)
+        return
+    if args.runtime == "asyncio":
+        # the host gets the shards, the runtime feeds them (its work queue is not started)
+        nExecutorThreads = max(1, args.worker_threads)
+        host = Host(configure_blocks(create_blocks(args), json_config_public), args.gather_timeout, nExecutorThreads, args.queue_size, args.overflow, 0,
+                    args.stream_ttl, args.max_streams, args.coalesce_bytes, args.coalesce_delay, metrics_sample, **hostOptions)
+        if args.metrics_port > 0:
+            host.serve_metrics(args.metrics_port, args.metrics_addr)
+        arun.run(host, nExecutorThreads, args.queue_size, json_config_private, json_config_public, args.stats_interval)
+        return
+    host = Host(configure_blocks(create_blocks(args), json_config_public), args.gather_timeout, args.worker_threads, args.queue_size, args.overflow, args.stats_interval,
+                args.stream_ttl, args.max_streams, args.coalesce_bytes, args.coalesce_delay, metrics_sample, **hostOptions)
+    if args.metrics_port > 0:
+        host.serve_metrics(args.metrics_port, args.metrics_addr)
+    host.run(json_config_private, json_config_public)
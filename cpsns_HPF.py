@@ -5,143 +5,58 @@ This program will
 3. publish the MQTT messages (to the same broker), with modified ANALYSIS:
     - /raw/ --> /hpf/ (keeping the other parts of the topic identical)
     - metadata will get extended the ANALYSIS CHAIN section
+
+The frames of all the sensors under a node (or a channel set, see cpsns_Assembler) with the same
+time stamp are filtered in one batch, in float64; the output is in the sample type of the stream
+(float32 or float64).
 """
-import numpy as np
-from paho.mqtt.client import Client as MQTTClient
-from paho.mqtt.client import CallbackAPIVersion
-from paho.mqtt.client import MQTTv311
-import argparse
-import struct
-import time
-import json
+import cpsns_Assembler as assembler
+import cpsns_Framework as fw
 import simpleHPF as hpf
 
-HOST_DEFAULT = "dtl-server-2.st.lab.au.dk"
-PORT_DEFAULT = 8090
-USERNAME_DEFAULT = "hbk1"
-PASSWORD_DEFAULT = "hbk1shffd"
-MQTT_TOPIC_DEFAULT = "cpsens/+/+/+/+/raw/+"
 CUT_OFF_DEFAULT = 0.5
 HPF_ORDER_DEFAULT = 5
 
-myDict = {}
-strMQTTTopic = MQTT_TOPIC_DEFAULT
-dCutOff = CUT_OFF_DEFAULT
-nHPFOrder = HPF_ORDER_DEFAULT
-
-mqttc = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
-
-
-def on_connect(mqttc, userdata, flags, rc, properties=None):
-    print("connected with response code %s" % rc)
-    mqttc.subscribe(strMQTTTopic)
-
-
-def on_subscribe(self, mqttc, userdata, msg, granted_qos):
-    print("mid/response = " + str(msg) + " / " + str(granted_qos))
-
-
-def on_message(client, userdata, msg):
-    topic = msg.topic
-    # print(topic)
-    substrings = topic.split('/')
-    bIsMetadata = True
-    if substrings[-1] == "data":
-        bIsMetadata = False
-    elif substrings[-1] == "metadata":
-        bIsMetadata = True
-    else:
-        raise Exception("Unknown topic" + substrings[-1])
-    
-    # Create a tuple made of the topic string without the last element (data/metadata)
-    myKey = tuple(substrings[:-1])
-
-    global myDict
-    if bIsMetadata:
-        # Process JSON metadata
-        # Add the key to the dictionary
-        if myKey not in myDict:
-            # Parse the payload
-            json_metadata = json.loads(msg.payload)
-            nSamples = json_metadata['Data']['Samples']
-            cType = json_metadata['Data']['Type'][0]
-            Fs = json_metadata["Analysis chain"][0]["Sampling"]
-            # Modify the topic
-            newMetadataTopic = topic.replace("/" + substrings[5] + "/", "/hpf/")
-            newDataTopic = topic.replace("/" + substrings[5] + "/", "/hpf/").replace("/metadata", "/data")
-            # Modify the metadata: add to the analysis section
-            newAnalysis = {"Name": "HPF", "Output": "hpf-ed", "Type": "Butterworth", "Cut-off": dCutOff, "Order": nHPFOrder}
-            json_metadata["Analysis chain"].append(newAnalysis)
-            json_metadata_str = json.dumps(json_metadata, indent=4)
-            # Instantiate the HPF
-            filter = hpf.RealTimeHighPassFilter(dCutOff, Fs, nHPFOrder)
-            #                0         1      2                  3                 4             5   6
-            myDict[myKey] = [nSamples, cType, json_metadata_str, newMetadataTopic, newDataTopic, Fs, filter]
-        if myKey in myDict:
-            # Publish it!
-            mqttc.publish(myDict[myKey][3], myDict[myKey][2])
-    else:
-        if myKey in myDict:
-            nSamples = myDict[myKey][0]
-            cType = myDict[myKey][1]
-            # Parse the payload
-            payload = msg.payload
-            descriptorLength, metadataVer = struct.unpack_from('HH', payload)
-            strBinFormat = str(nSamples) + str(cType)  # e.g., '640f' for 640 floats
-            data = np.array(struct.unpack_from(strBinFormat, payload, descriptorLength), dtype=float)
-            # apply the filter, in place
-            filter = myDict[myKey][6]  # I hope it passes a reference...
-            data = filter.apply_filter(data)
-            # Update
-            pass
-            # Form the payload
-            if cType == 'f':
-                data = data.astype(np.float32)
-            newPayload = payload[0:descriptorLength] + data.tobytes()
-            # Publish
-            mqttc.publish(myDict[myKey][4], newPayload)
-        else:
-            print("Waiting for the metadata...")
 
+class HPFBlock(fw.ProcessingBlock):
+    batched = True
 
-def main():
-    # Parse command line parameters
-    # Create the parser
-    parser = argparse.ArgumentParser(description="This Python script reads the time data from MQTT and outputs it on a life graph.")
-    parser.add_argument('--host', type=str, help='Specify the host to connect to. Defaults to ' + HOST_DEFAULT, default=HOST_DEFAULT)
-    parser.add_argument('--port', type=int, help='Connect to the port specified. Defaults to ' + str(PORT_DEFAULT), default=PORT_DEFAULT)
-    parser.add_argument('--username', type=str, help='Provide a username to be used for authenticating with the broker. See also the --pw argument. Defaults to ' + USERNAME_DEFAULT, default=USERNAME_DEFAULT)
-    parser.add_argument('--pw', type=str, help='Provide a password to be used for authenticating with the broker. See also the --username option. Defaults to ' + PASSWORD_DEFAULT, default=PASSWORD_DEFAULT)
-    parser.add_argument('--topic', type=str, help='The topic parameter. Defaults to ' + MQTT_TOPIC_DEFAULT, default=MQTT_TOPIC_DEFAULT)
-    parser.add_argument('--cutoff', type=float, help='Cut-off frequency (in Hz). Defaults to ' + str(CUT_OFF_DEFAULT), default=CUT_OFF_DEFAULT)
-    parser.add_argument('--hpforder', type=int, help='HPF order. Defaults to ' + str(HPF_ORDER_DEFAULT), default=HPF_ORDER_DEFAULT)
+    def __init__(self, dCutOff=CUT_OFF_DEFAULT, nHPFOrder=HPF_ORDER_DEFAULT):
+        self.dCutOff = dCutOff
+        self.nHPFOrder = nHPFOrder
 
-    # Parse the arguments
-    args = parser.parse_args()
+    def on_metadata(self, substrings, json_metadata):
+        Fs = json_metadata["Analysis chain"][0]["Sampling"]
+        # Modify the topic
+        substrings[5] = "hpf"
+        # Modify the metadata: add to the analysis section
+        newAnalysis = {"Name": "HPF", "Output": "hpf-ed", "Type": "Butterworth", "Cut-off": self.dCutOff, "Order": self.nHPFOrder}
+        json_metadata["Analysis chain"].append(newAnalysis)
+        # Instantiate the HPF
+        cType = json_metadata["Data"]["Type"][0]
+        return hpf.RealTimeHighPassFilter(self.dCutOff, Fs, self.nHPFOrder, cType)
 
-    global strMQTTTopic
-    strMQTTTopic = args.topic
+    def process(self, data, filter):
+        return filter.apply_filter(data)
 
-    global dCutOff
-    dCutOff = args.cutoff
+    def process_batch(self, datas, filters):
+        if hasattr(datas, "block") and len({(id(filter.sos), filter.dtype) for filter in filters}) == 1:
+            # an assembled time step: filter its block as it is
+            return assembler.FrameBlock(hpf.apply_filter_block(filters, datas.block))
+        return hpf.apply_filter_batch(filters, datas)
 
-    global nHPFOrder
-    nHPFOrder = args.hpforder
 
-    # Set username and password
-    mqttc.username_pw_set(args.username, args.pw)
+def add_arguments(parser):
+    parser.add_argument('--cutoff', type=float, help='Cut-off frequency (in Hz). Defaults to ' + str(CUT_OFF_DEFAULT), default=CUT_OFF_DEFAULT)
+    parser.add_argument('--hpforder', type=int, help='HPF order. Defaults to ' + str(HPF_ORDER_DEFAULT), default=HPF_ORDER_DEFAULT)
 
-    mqttc.on_connect = on_connect
-    mqttc.on_message = on_message
-    mqttc.on_subscribe = on_subscribe
-    mqttc.connect(args.host, args.port, 60)
 
-    mqttc.loop_start()
+def create_block(args):
+    return HPFBlock(args.cutoff, args.hpforder)
 
-    while True:
-        # Sleep for a short time to reduce CPU usage
-        time.sleep(0.1)
-        pass
+
+def main():
+    fw.main("High-pass filters the CP-SENS streams.", add_arguments, lambda args: [create_block(args)])
 
 
 if __name__ == "__main__":
@@ -6,221 +6,294 @@ This program will
     - /acc/ --> /vel/ (keeping the other parts of the topic identical)
     - /acc/ --> /displ/ (keeping the other parts of the topic identical)
     - metadata will get extended the ANALYSIS CHAIN section
+
+The frames of all the sensors under a node (or a channel set, see cpsns_Assembler) with the same
+time stamp are integrated in one batch.
+--outputs selects what is published, all from the one integration pass: displacement (default),
+velocity and the input acceleration (passthrough, useful after detrend/hpf in a --chain).
+
+The covariances Q and R are --kf_q and --kf_r, or per stream from the "Integration" section of
+the public configuration (the first pattern matching the topic the block gets, without
+data/metadata; the analysis level is + in a chain):
+    "Integration": {
+        "Streams": [
+            {"Topic": "cpsens/d1/+/+/acc/+", "Q": 1e-6, "R": 1e-9},
+            {"Topic": "cpsens/d2/#", "Adaptive": true}
+        ]
+    }
+The streams with the same sampling, Q and R share one steady-state filter (cached per (Ts, Q, R)).
+
+Adaptive (--kf_adaptive, or "Adaptive" of a pattern): Q and R are tuned at the frame boundaries
+from the incoming data, see NoiseTuner.
 """
 import numpy as np
-from paho.mqtt.client import Client as MQTTClient
-from paho.mqtt.client import CallbackAPIVersion
-from paho.mqtt.client import MQTTv311
-import argparse
-import struct
-import time
-import json
 import copy
+import math
+import cpsns_Assembler as assembler
+import cpsns_Framework as fw
 import Integration_KF_Chatzi as intgr
-import sys
-import os
-
-# Default configuration files
-PRIVATE_CONFIG_FILE_DEFAULT = "private_config.json" # locate this file in the private folder and chmod 600 it.
-PUBLIC_CONFIG_FILE_DEFAULT = "public_config.json"   # this file can be located in a public folder 
-
-myDict = {}
-
-# Replaces the subtopics of the topic by the strings in the list
-def replace_subtopics(topic, replacements):
-    subtopics = topic.split('/')
-    for i in range(min(len(subtopics), len(replacements))):
-        if replacements[i]:
-            subtopics[i] = replacements[i]
-    return '/'.join(subtopics)
-
-def on_connect_in(mqttc_in, userdata, flags, rc, properties=None):
-    global json_config_public
-    print("MQTT_IN: Connected with response code %s" % rc)
-    for topic in json_config_public["MQTT_IN"]["TopicsToSubscribe"]:
-        print(f"MQTT_IN: Subscribing to the topic {topic}...")
-        mqttc_in.subscribe(topic, qos=json_config_public["MQTT_IN"]["QoS"])
-
-def on_connect_out(mqttc_in, userdata, flags, rc, properties=None):
-    print("MQTT_OUT: Connected with response code %s" % rc)
-
-def on_subscribe(self, mqttc, userdata, msg, granted_qos):
-    print("Subscribed. Message: " + str(msg))
-
-def on_message(client, userdata, msg):
-    global myDict, mqttc_out 
-    topic = msg.topic
-    substrings = topic.split('/')
-    bIsMetadata = True
-    if substrings[6] == "data":
-        bIsMetadata = False
-    elif substrings[6] == "metadata":
-        bIsMetadata = True
-    else:
-        raise Exception("Unknown topic" + substrings[6])
-    
-    # Initial values
-    v0 = 0.0
-    d0 = 0.0
-    P0 = np.eye(2)
-    # Covariances
-    # TODO: take from the command line
-    Q = 1.e-6
-    R = 1.e-10   # % Q/R=10 Nice and smooth but the magnitude is smaller
-
-    # Create a tuple made of the topic string without the last element (data/metadata)
-    myKey = tuple(substrings[:-1])
-
-    if bIsMetadata:
-        # Process JSON metadata
-        # Add the key to the dictionary
-        if myKey not in myDict:
-            # Parse the payload
-            json_metadata = json.loads(msg.payload)
-            nSamples = json_metadata['Data']['Samples']
-            cType = json_metadata['Data']['Type'][0]
-            Ts = 1.0 / json_metadata["Analysis chain"][0]["Sampling"]
-            # Modify the topic
-            newMetadataTopic = topic.replace("/" + substrings[4] + "/", "/displ/")
-            newDataTopic = topic.replace("/" + substrings[4] + "/", "/displ/").replace("/metadata", "/data")
-            # Make a deep copy of the last element of the Analysis chain:
-            lastAnalysisInChain = json_metadata["Analysis chain"][-1]
-            lastAnalysisInChain_copy = copy.deepcopy(lastAnalysisInChain)
-            lastAnalysisInChain_copy["Name"] = "Integration"
-            lastAnalysisInChain_copy["Output"] = "Displacement"
-            json_metadata["Analysis chain"].append(lastAnalysisInChain_copy)
-            # Modify Units in the Data section
-            json_metadata["Data"]["Unit"] = "m"
-            json_metadata_str = json.dumps(json_metadata, indent=4)
-            # Append the updated metadate to the dictionary
-            #                0         1      2                  3                 4             5   6   7   8
-            myDict[myKey] = [nSamples, cType, json_metadata_str, newMetadataTopic, newDataTopic, d0, v0, P0, Ts]
-        if myKey in myDict:
-            # Publish it!
-            print(f"Publish {myDict[myKey][3]}...")
-            mqttc_out.publish(myDict[myKey][3], myDict[myKey][2])
-    else: # data message
-        if myKey in myDict:
-            # Parse the payload
-            payload = msg.payload
-            descriptorLength, metadataVer = struct.unpack_from('HH', payload)
-            # how many samples and what's its type, float or double?
-            cType = myDict[myKey][1]
-            nSamples = myDict[myKey][0]
-            if nSamples == -1: # unknown or variable
-                # calculate nSamples from the payload length
-                payload_len = len(payload)
-                nSamples = round((payload_len-descriptorLength)/struct.calcsize(cType))
-            # Data
-            strBinFormat = str(nSamples) + str(cType)  # e.g., '640f' for 640 floats
-            # data
-            data = np.array(struct.unpack_from(strBinFormat, payload, descriptorLength))
-            '''
-            # time stamp of the payload
-            secFromEpoch = struct.unpack_from('Q', payload, 4)[0]
-            nanosec = struct.unpack_from('Q', payload, 12)[0]
-            # nSamples
-            nSamplesFromDAQStart = 0
-            if metadataVer >= 2:
-                nSamplesFromDAQStart = struct.unpack_from('Q', payload, 20)[0]
+
+# Covariances
+Q_DEFAULT = 1.e-6
+R_DEFAULT = 1.e-10   # % Q/R=10 Nice and smooth but the magnitude is smaller
+
+# Adaptive tuning
+ADAPT_RATE = 0.1         # the weight of a frame in the running estimates
+ADAPT_GRID = 8           # Q and Q/R are rounded to that many values per decade (shared, cached filters)
+ADAPT_RATIO_SPAN = 1e3   # Q/R stays within the configured one / and * that
+DRIFT_HIGH = 0.5         # raise Q/R when the mean of the displacement is more of its power than that
+DRIFT_LOW = 0.05         # lower it when less
+MAD_TO_SIGMA = 1.0 / (0.6745 * math.sqrt(6))   # the noise sigma from the median |second difference| of the samples
+
+# Output (the PHYSICS part of the topic) -> (the Output in the analysis chain, unit)
+OUTPUTS = {
+    "displ": ("Displacement", "m"),
+    "vel": ("Velocity", "m/s"),
+    "acc": (None, None),  # passthrough: the metadata is not modified
+}
+OUTPUTS_DEFAULT = ["displ"]
+
+
+def grid_index(x):
+    # The index of x on the log grid of the adaptive tuning
+    return int(round(math.log10(x) * ADAPT_GRID))
+
+
+class NoiseTuner:
+    """
+    Online tuning of the covariances of one stream, from the frames it integrates:
+    - Q follows the noise level of the acceleration (the variance of the white noise, from the
+      median absolute second difference of the samples). The gains only depend on Q/R, so R
+      follows Q and the level only scales P (no new transient).
+    - Q/R follows the drift of the displacement: the part of its power that is its (running)
+      mean. Q/R is raised a grid step (the displacement is pulled harder towards 0) when the
+      drift is above DRIFT_HIGH and lowered when it is below DRIFT_LOW.
+    Both are on a log grid (ADAPT_GRID values per decade): the streams with similar signals end
+    up with the same, cached, steady-state filter and a small change keeps the filter.
+    """
+    __slots__ = ("noise", "dMean", "dPower", "iQ", "iRatio", "iRatio0")
+
+    def __init__(self, Q, R):
+        self.noise = None   # the running estimates, None before the first frame
+        self.dMean = 0.0
+        self.dPower = 0.0
+        self.iQ = grid_index(Q)
+        self.iRatio0 = grid_index(Q / R)
+        self.iRatio = self.iRatio0
+
+    def covariances(self):
+        # (Q, R) of the grid indices
+        return 10.0 ** (self.iQ / ADAPT_GRID), 10.0 ** ((self.iQ - self.iRatio) / ADAPT_GRID)
+
+    def update(self, noise, dMean, dPower):
+        """
+        Takes the estimates of a frame: the noise variance of the acceleration, the mean and the
+        mean square of the displacement. Returns True if Q or R has changed.
+        """
+        w = ADAPT_RATE if self.noise is not None else 1.0
+        if noise > 0:
+            self.noise = noise if self.noise is None else (1 - w) * self.noise + w * noise
+        self.dMean = (1 - w) * self.dMean + w * dMean
+        self.dPower = (1 - w) * self.dPower + w * dPower
+        iQ, iRatio = self.iQ, self.iRatio
+        # (a grid step of hysteresis, not to switch back and forth)
+        if self.noise is not None and abs(math.log10(self.noise) * ADAPT_GRID - iQ) > 1:
+            iQ = grid_index(self.noise)
+        if self.dPower > 0:
+            drift = self.dMean ** 2 / self.dPower
+            nSpan = grid_index(ADAPT_RATIO_SPAN)
+            if drift > DRIFT_HIGH:
+                iRatio = min(iRatio + 1, self.iRatio0 + nSpan)
+            elif drift < DRIFT_LOW:
+                iRatio = max(iRatio - 1, self.iRatio0 - nSpan)
+        bChanged = (iQ, iRatio) != (self.iQ, self.iRatio)
+        self.iQ, self.iRatio = iQ, iRatio
+        return bChanged
+
+    def get_state(self):
+        return np.array([np.nan if self.noise is None else self.noise, self.dMean, self.dPower, self.iQ, self.iRatio])
+
+    def set_state(self, tuning):
+        noise, self.dMean, self.dPower, iQ, iRatio = (float(x) for x in tuning)
+        self.noise = None if np.isnan(noise) else noise
+        self.iQ = int(iQ)
+        nSpan = grid_index(ADAPT_RATIO_SPAN)
+        self.iRatio = min(max(int(iRatio), self.iRatio0 - nSpan), self.iRatio0 + nSpan)
+
+
+class KFState:
+    """
+    The state of the integration KF of one stream.
+    """
+    __slots__ = ("d0", "v0", "P0", "Ts", "Q", "R", "tuner")
+
+    def __init__(self, Ts, d0=0.0, v0=0.0, P0=None, Q=Q_DEFAULT, R=R_DEFAULT, bAdaptive=False):
+        self.d0 = d0
+        self.v0 = v0
+        self.P0 = np.eye(2) if P0 is None else P0
+        self.Ts = Ts
+        self.Q = Q
+        self.R = R
+        self.tuner = NoiseTuner(Q, R) if bAdaptive else None
+        if self.tuner is not None:
+            self.Q, self.R = self.tuner.covariances()
+
+    def tune(self, noise, dMean, dPower):
+        # Adaptive: updates Q and R for the next frame
+        if not self.tuner.update(noise, dMean, dPower):
+            return
+        Q, R = self.tuner.covariances()
+        if math.isclose(Q / R, self.Q / self.R):
+            # the same gains: P scales with the covariances
+            self.P0 = self.P0 * (Q / self.Q)
+        self.Q, self.R = Q, R
+
+    def get_state(self):
+        # for the checkpoints (Ts comes from the metadata, Q and R from the settings unless adaptive)
+        arrays = {"d0": np.array(self.d0), "v0": np.array(self.v0), "P0": np.asarray(self.P0)}
+        if self.tuner is not None:
+            arrays["tuning"] = self.tuner.get_state()
+        return arrays
+
+    def set_state(self, arrays):
+        if arrays["P0"].shape != (2, 2):
+            return False
+        self.d0 = float(arrays["d0"])
+        self.v0 = float(arrays["v0"])
+        self.P0 = np.array(arrays["P0"], dtype=float)
+        if self.tuner is not None and "tuning" in arrays:
+            self.tuner.set_state(arrays["tuning"])
+            self.Q, self.R = self.tuner.covariances()
+        return True
+
+
+class IntegrateBlock(fw.ProcessingBlock):
+    batched = True
+
+    def __init__(self, Q=Q_DEFAULT, R=R_DEFAULT, outputs=OUTPUTS_DEFAULT, bAdaptive=False):
+        """
+        Parameters:
+        Q: The process noise covariance (of the streams not set in the configuration)
+        R: The measurement noise covariance (idem)
+        bAdaptive: Tune Q and R online (idem)
+        outputs: What to publish, names from OUTPUTS. With one output the block is an ordinary
+                 block (it can be followed by others), with more it must be the last one
+        """
+        unknown = [name for name in outputs if name not in OUTPUTS]
+        if unknown or not outputs:
+            raise ValueError(f"Unknown outputs {unknown}, use some of {list(OUTPUTS)}")
+        self.Q = Q
+        self.R = R
+        self.bAdaptive = bAdaptive
+        self.streamSettings = []   # (pattern, Q, R, bAdaptive) from the configuration
+        self.outputNames = tuple(outputs)
+        if len(self.outputNames) > 1:
+            self.outputs = self.outputNames
+
+    def configure(self, json_config_public):
+        for entry in json_config_public.get("Integration", {}).get("Streams", []):
+            pattern = tuple(entry["Topic"].rstrip('/').split('/'))
+            self.streamSettings.append((pattern, float(entry.get("Q", self.Q)), float(entry.get("R", self.R)),
+                                        bool(entry.get("Adaptive", self.bAdaptive))))
+
+    def settings(self, myKey):
+        # (Q, R, bAdaptive) of the stream: the first pattern it matches, else the block's
+        for pattern, Q, R, bAdaptive in self.streamSettings:
+            if assembler.matches(pattern, myKey):
+                return Q, R, bAdaptive
+        return self.Q, self.R, self.bAdaptive
+
+    def on_metadata(self, substrings, json_metadata):
+        Ts = 1.0 / json_metadata["Analysis chain"][0]["Sampling"]
+        Q, R, bAdaptive = self.settings(tuple(substrings[:-1]))
+        if self.outputs is None:
+            self.on_metadata_output(self.outputNames[0], substrings, json_metadata)
+        # Initial values: d0 = 0, v0 = 0, P0 = I
+        return KFState(Ts, Q=Q, R=R, bAdaptive=bAdaptive)
+
+    def on_metadata_output(self, output, substrings, json_metadata):
+        strOutput, strUnit = OUTPUTS[output]
+        if strOutput is None:
+            return
+        # Modify the topic
+        substrings[4] = output
+        # Make a deep copy of the last element of the Analysis chain:
+        lastAnalysisInChain = json_metadata["Analysis chain"][-1]
+        lastAnalysisInChain_copy = copy.deepcopy(lastAnalysisInChain)
+        lastAnalysisInChain_copy["Name"] = "Integration"
+        lastAnalysisInChain_copy["Output"] = strOutput
+        json_metadata["Analysis chain"].append(lastAnalysisInChain_copy)
+        # Modify Units in the Data section
+        json_metadata["Data"]["Unit"] = strUnit
+
+    def process(self, data, state):
+        return self.process_batch([data], [state])[0]
+
+    def process_batch(self, datas, states):
+        # One batch per frame length
+        batches = {}
+        for i, data in enumerate(datas):
+            batches.setdefault(len(data), []).append(i)
+        results = [None] * len(datas)
+        for indices in batches.values():
+            if len(indices) == len(datas):
+                # all of them (the block of an assembled time step is used as it is)
+                a = assembler.rows_block(datas)
             else:
-                raise Exception("Incompatible version. Use earlier version of cpsns_LifePlot!")
-            '''
-            # Integrate
-            Ts = myDict[myKey][8]
-            d, v, P = intgr.Integration_KF_Chatzi(data, Ts, Q, R, myDict[myKey][5], myDict[myKey][6], myDict[myKey][7])  # d, v, P = Integration_KF_Chatzi(a, Ts, Q, R, d0=0, v0=0, P0=np.eye(2))
-            # Update. MATLAB: d0_1 = d(end); v0_1 = v(end); P0_1 = P;
-            myDict[myKey][5] = d[-1]
-            myDict[myKey][6] = v[-1]
-            myDict[myKey][7] = P
-            # Form the payload
-            if cType == 'f':
-                d = d.astype(np.float32)
-            newPayload = payload[0:descriptorLength] + d.tobytes()
-            # Publish
-            mqttc_out.publish(myDict[myKey][4], newPayload)
-        else:
-            print("Waiting for the metadata...")
+                a = np.empty((len(indices), len(datas[indices[0]])))
+                for j, i in enumerate(indices):
+                    a[j] = datas[i]
+            Ts = np.array([states[i].Ts for i in indices])
+            d0 = np.array([states[i].d0 for i in indices])
+            v0 = np.array([states[i].v0 for i in indices])
+            P0 = np.array([states[i].P0 for i in indices])
+            Q = np.array([states[i].Q for i in indices])
+            R = np.array([states[i].R for i in indices])
+            # Integrate all the channels at once (one steady-state filter per (Ts, Q, R))
+            d, v, P = intgr.Integration_KF_Batch(a, Ts, Q, R, d0, v0, P0)
+            for j, i in enumerate(indices):
+                # Update. MATLAB: d0_1 = d(end); v0_1 = v(end); P0_1 = P;
+                if d.shape[1] > 0:
+                    states[i].d0 = d[j, -1]
+                    states[i].v0 = v[j, -1]
+                    states[i].P0 = P[j]
+                results[i] = self.select_outputs(d[j], v[j], datas[i])
+            self.tune([states[i] for i in indices], a, d)
+        if hasattr(datas, "block") and len(batches) == 1 and self.outputs is None:
+            return assembler.FrameBlock(self.select_outputs(d, v, a))
+        return results
+
+    def tune(self, states, a, d):
+        # Adaptive streams: the estimates of the frames (rows of a and d), all at once
+        jAdaptive = [j for j, state in enumerate(states) if state.tuner is not None]
+        if not jAdaptive or a.shape[1] < 3:
+            return
+        noise = (np.median(np.abs(np.diff(a[jAdaptive], n=2, axis=1)), axis=1) * MAD_TO_SIGMA) ** 2
+        dMean = d[jAdaptive].mean(axis=1)
+        dPower = np.mean(d[jAdaptive] ** 2, axis=1)
+        for k, j in enumerate(jAdaptive):
+            states[j].tune(noise[k], dMean[k], dPower[k])
+
+    def select_outputs(self, d, v, a):
+        computed = {"displ": d, "vel": v, "acc": a}
+        if self.outputs is None:
+            return computed[self.outputNames[0]]
+        return tuple(computed[name] for name in self.outputNames)
+
+
+def add_arguments(parser):
+    parser.add_argument('--kf_q', type=float, help='Process noise covariance of the integration KF (the streams not set in the public configuration). Defaults to ' + str(Q_DEFAULT), default=Q_DEFAULT)
+    parser.add_argument('--kf_r', type=float, help='Measurement noise covariance of the integration KF (idem). Defaults to ' + str(R_DEFAULT), default=R_DEFAULT)
+    parser.add_argument('--kf_adaptive', action='store_true', help='Tune Q and R online, from the drift and the noise level of the data (idem)')
+    parser.add_argument('--outputs', nargs='+', choices=OUTPUTS.keys(), help='What to publish (from one integration pass). Defaults to ' + ' '.join(OUTPUTS_DEFAULT), default=OUTPUTS_DEFAULT)
+
+
+def create_block(args):
+    return IntegrateBlock(args.kf_q, args.kf_r, args.outputs, args.kf_adaptive)
 
 
 def main():
-    global mqttc_out 
-    global json_config_public
-    # Parse command line parameters
-    # Create the parser
-    parser = argparse.ArgumentParser(description="Write the description here...")
-    parser.add_argument('--config_private', type=str, help='Specify the JSON configuration file for PRIVATE data. Defaults to ' + PRIVATE_CONFIG_FILE_DEFAULT, default=PRIVATE_CONFIG_FILE_DEFAULT)
-    parser.add_argument('--config_public', type=str, help='Specify the JSON configuration file for PUBLIC data. Defaults to ' + PUBLIC_CONFIG_FILE_DEFAULT, default=PUBLIC_CONFIG_FILE_DEFAULT)
-
-    # Parse the arguments
-    args = parser.parse_args()
-
-    # Name of the configuration file
-    strConfigFile = args.config_private
-    # Read the configuration file
-    print(f"Reading private configuration from {strConfigFile}...")
-    if os.path.exists(strConfigFile):
-        try:
-            # Open and read the JSON file
-            with open(strConfigFile, 'r') as file:
-                json_config_private = json.load(file)
-        except json.JSONDecodeError:
-            print(f"Error: The file {strConfigFile} exists but could not be parsed as JSON.", file=sys.stderr)
-            sys.exit(1)
-    else:
-        print(f"Error: The file {strConfigFile} does not exist.", file=sys.stderr)    
-        sys.exit(1)
-
-    # Name of the configuration file
-    strConfigFile = args.config_public
-    # Read the configuration file
-    print(f"Reading public configuration from {strConfigFile}...")
-    if os.path.exists(strConfigFile):
-        try:
-            # Open and read the JSON file
-            with open(strConfigFile, 'r') as file:
-                json_config_public = json.load(file)
-        except json.JSONDecodeError:
-            print(f"Error: The file {strConfigFile} exists but could not be parsed as JSON.", file=sys.stderr)
-            sys.exit(1)
-    else:
-        print(f"Error: The file {strConfigFile} does not exist.", file=sys.stderr)    
-        sys.exit(1)
-
-    # MQTT_IN stuff
-    mqttc_in = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
-    #mqttc_in = MQTTClient()
-
-    # Set username and password
-    if json_config_private["MQTT_IN"]["userId"] != "":
-        mqttc_in.username_pw_set(json_config_private["MQTT_IN"]["userId"], json_config_private["MQTT_IN"]["password"])
-
-    mqttc_in.on_connect = on_connect_in
-    mqttc_in.on_message = on_message
-    mqttc_in.on_subscribe = on_subscribe
-    mqttc_in.connect(json_config_private["MQTT_IN"]["host"], json_config_private["MQTT_IN"]["port"], 60) # we subscribe to the topics in on_connect callback
-
-    mqttc_in.loop_start()
-    # MQTT_IN done
-
-    # MQTT_OUT stuff
-    mqttc_out = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
-    #mqttc_out = MQTTClient()
-
-    # Set username and password
-    if json_config_private["MQTT_OUT"]["userId"] != "":
-        mqttc_out.username_pw_set(json_config_private["MQTT_OUT"]["userId"], json_config_private["MQTT_OUT"]["password"])
-
-    mqttc_out.on_connect = on_connect_out
-    mqttc_out.connect(json_config_private["MQTT_OUT"]["host"], json_config_private["MQTT_OUT"]["port"], 60) 
-
-    mqttc_out.loop_start()
-    # MQTT_OUT done
-
-    while True:
-        # Sleep for a short time to reduce CPU usage
-        time.sleep(0.1)
-        pass
+    fw.main("Integrates the CP-SENS acceleration streams to displacement and/or velocity.", add_arguments, lambda args: [create_block(args)])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+"""
+Metrics of the services, served in the Prometheus text format on a local HTTP endpoint
+(--metrics_port, http://127.0.0.1:<port>/metrics).
+
+The counters are plain integers and the histograms are preallocated LatencyHistograms
+(cpsns_WorkQueue), updated by the thread that owns them (a shard worker, or the outbound stage
+under its lock) and only merged and formatted when /metrics is scraped. The stage times are
+measured on one processing call out of every --metrics_sample, so the timing costs next to
+nothing; the message counters are always exact.
+
+    cpsns_messages_total{topic}         data frames received, per input topic (rate() for the rates)
+    cpsns_received_bytes_total{topic}
+    cpsns_stage_seconds{stage}          decode, compute (all the blocks), encode and publish times
+    cpsns_frame_lag_seconds             publish time - the time stamp of the frame (its header)
+    cpsns_queue_depth                   messages waiting to be processed
+    cpsns_frames_dropped_total{reason}  no_metadata, drop_oldest, drop_newest, ring_full, missing_policy
+    cpsns_missing_channels_total        channels missing from the assembled time steps (cpsns_Assembler)
+"""
+import copy
+import http.server
+import threading
+import time
+from cpsns_WorkQueue import LatencyHistogram
+
+METRICS_ADDR_DEFAULT = "127.0.0.1"  # local only
+METRICS_SAMPLE_DEFAULT = 10         # time one processing call out of that many
+
+# The lag is much longer than the stage times (the sensors, the network, the brokers)
+LAG_MIN = 1e-4   # s
+LAG_MAX = 1e4    # s
+
+
+class StageTimes:
+    """
+    The stage time histograms of one shard, updated by its worker only.
+    """
+    __slots__ = ("nCalls", "decode", "compute")
+
+    def __init__(self):
+        self.nCalls = 0   # processing calls, for the sampling
+        self.decode = LatencyHistogram()
+        self.compute = LatencyHistogram()
+
+
+class StageTimer:
+    """
+    The stage times of the processing calls of a host: one call out of every nSample (0: none)
+    is timed, into the StageTimes of its shard.
+    """
+    def __init__(self, nSample=0, nShards=1):
+        self.nSample = nSample
+        self.stageTimes = [StageTimes() for _ in range(nShards)]
+
+    def start(self, iShard=0):
+        """
+        Returns the start time (time.perf_counter()) if this call is timed, else None.
+        """
+        if self.nSample <= 0:
+            return None
+        stageTimes = self.stageTimes[iShard]
+        stageTimes.nCalls += 1
+        return time.perf_counter() if stageTimes.nCalls % self.nSample == 0 else None
+
+    def record(self, strStage, t0, iShard=0):
+        """
+        Records the time of the stage (decode or compute) that started at t0. Returns the time now.
+        """
+        t1 = time.perf_counter()
+        getattr(self.stageTimes[iShard], strStage).record(t1 - t0)
+        return t1
+
+    def merged(self, strStage):
+        # The histogram of the stage, of all the shards
+        return merged([getattr(stageTimes, strStage) for stageTimes in self.stageTimes])
+
+
+def merged(histograms):
+    # (of the same range)
+    histogram = copy.deepcopy(histograms[0])
+    for other in histograms[1:]:
+        histogram.merge(other)
+    return histogram
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Exposition:
+    """
+    Builds the text of a /metrics response.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, strType, strHelp, samples):
+        """
+        Parameters:
+        name: The metric name
+        strType: "counter" or "gauge"
+        strHelp: The description
+        samples: A number, or a list of (labels dict, number)
+        """
+        self.lines.append(f"# HELP {name} {strHelp}")
+        self.lines.append(f"# TYPE {name} {strType}")
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{format_labels(labels)} {value}")
+
+    def histogram(self, name, strHelp, histograms):
+        """
+        histograms: A list of (labels dict, LatencyHistogram)
+        """
+        self.lines.append(f"# HELP {name} {strHelp}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in histograms:
+            cumulative = 0
+            # the last bin also holds everything above the range: it is +Inf
+            for i in range(histogram.nBins - 1):
+                cumulative += histogram.counts[i]
+                self.lines.append(f"{name}_bucket{format_labels(dict(labels, le=f'{histogram.upper_edge(i):.6g}'))} {cumulative}")
+            self.lines.append(f"{name}_bucket{format_labels(dict(labels, le='+Inf'))} {histogram.n}")
+            self.lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            self.lines.append(f"{name}_count{format_labels(labels)} {histogram.n}")
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves collect() (the text of the exposition) on GET /metrics, on a daemon thread.
+    """
+    def __init__(self, port, collect, addr=METRICS_ADDR_DEFAULT):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = collect().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((addr, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        print(f"Metrics on http://{addr}:{self.server.server_address[1]}/metrics")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,238 @@
+"""
+Offline (batch) mode of the services (--offline CAPTURE): runs the blocks of a service over a
+capture file instead of the MQTT traffic, and writes the results to .npy files.
+
+The capture is memory-mapped (cpsns_Capture). The streams are distributed among the worker
+processes (all the cores by default) the same way as with --workers: by the stream, or by the
+node if the frames of a node are processed together. Every process runs the same Host as the
+streaming service, so with the recorded frames as the blocks the results are bit-identical
+to the streaming ones. --offline_block N joins the consecutive frames of a stream into
+blocks of at least N samples: fewer, larger calls into the engines. The detrending and the
+filtering carry their state exactly, but the integration starts every block from the last
+estimate of the previous one (as the original), so its results depend on the blocks.
+
+For every output topic (e.g. cpsens/d1/m1/1/displ/detrend) the output directory gets:
+    cpsens.d1.m1.1.displ.detrend.npy         the samples, one after the other (Data.Type)
+    cpsens.d1.m1.1.displ.detrend.frames.npy  per frame: secFromEpoch, nanosec,
+                                             nSamplesFromDAQStart, offset, count
+    cpsens.d1.m1.1.displ.detrend.json        the metadata
+"""
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import cpsns_Capture as capture
+import cpsns_Codec as codec
+import cpsns_Sharding as shard
+
+FRAME_DTYPE = np.dtype([("secFromEpoch", "<u8"), ("nanosec", "<u8"), ("nSamplesFromDAQStart", "<i8"), ("offset", "<i8"), ("count", "<i8")])
+
+
+class NpyAppender:
+    """
+    A 1D .npy file written in pieces: the header is rewritten with the final length on close
+    (NumPy leaves room in the header for the length to grow).
+    """
+    def __init__(self, strFile, dtype):
+        self.file = open(strFile, 'wb')
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+        np.lib.format.write_array_header_1_0(self.file, self.header(0))
+        self.headerLength = self.file.tell()
+
+    def header(self, n):
+        return {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (n,)}
+
+    def write(self, data):
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        self.file.write(data.data)
+        self.n += len(data)
+
+    def close(self):
+        self.file.seek(0)
+        np.lib.format.write_array_header_1_0(self.file, self.header(self.n))
+        if self.file.tell() != self.headerLength:
+            raise RuntimeError(f"The .npy header of {self.file.name} has changed its length")
+        self.file.close()
+
+
+class OutputWriter:
+    """
+    What the Host publishes to in the offline mode: the frames go to the .npy files.
+    """
+    def __init__(self, strDir):
+        self.strDir = strDir
+        self.cTypes = {}    # data topic -> cType, from the metadata
+        self.samples = {}   # data topic -> NpyAppender
+        self.frames = {}    # data topic -> NpyAppender
+
+    def file_name(self, topic, strSuffix):
+        return os.path.join(self.strDir, topic.rsplit('/', 1)[0].replace('/', '.') + strSuffix)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if topic.endswith("/metadata"):
+            with open(self.file_name(topic, ".json"), 'w') as file:
+                file.write(payload)
+            self.cTypes[topic[:-len("metadata")] + "data"] = json.loads(payload)["Data"]["Type"][0]
+            return
+        samplesFile = self.samples.get(topic)
+        if samplesFile is None:
+            samplesFile = self.samples[topic] = NpyAppender(self.file_name(topic, ".npy"), self.cTypes[topic])
+            self.frames[topic] = NpyAppender(self.file_name(topic, ".frames.npy"), FRAME_DTYPE)
+        header = codec.decode_header(payload)
+        samples = codec.decode_data(payload, samplesFile.dtype.char, -1, header.descriptorLength)
+        nSamplesFromDAQStart = -1 if header.nSamplesFromDAQStart is None else header.nSamplesFromDAQStart
+        self.frames[topic].write(np.array([(header.secFromEpoch, header.nanosec, nSamplesFromDAQStart, samplesFile.n, len(samples))], dtype=FRAME_DTYPE))
+        samplesFile.write(samples)
+
+    def close(self):
+        for appender in list(self.samples.values()) + list(self.frames.values()):
+            appender.close()
+
+
+class FrameJoiner:
+    """
+    Joins the consecutive frames of every stream into blocks of at least nBlock samples
+    (--offline_block). A gap in nSamplesFromDAQStart ends a block.
+    """
+    def __init__(self, nBlock, handle):
+        self.nBlock = nBlock
+        self.handle = handle    # called as handle(topic, payload) with the joined frames
+        self.pending = {}       # data topic -> [header bytes, [sample bytes], nSamples, next nSamplesFromDAQStart]
+        self.itemsizes = {}     # data topic -> bytes per sample
+
+    def on_metadata(self, topic, payload):
+        json_metadata = json.loads(payload)
+        dataTopic = topic[:-len("metadata")] + "data"
+        self.itemsizes[dataTopic] = np.dtype(json_metadata["Data"]["Type"][0]).itemsize
+        # the joined frames have a variable length
+        json_metadata["Data"]["Samples"] = -1
+        self.handle(topic, json.dumps(json_metadata).encode())
+
+    def on_data(self, topic, payload):
+        itemsize = self.itemsizes.get(topic)
+        if itemsize is None:
+            self.handle(topic, payload)   # no metadata yet, the Host waits for it
+            return
+        header = codec.decode_header(payload)
+        nSamples = (len(payload) - header.descriptorLength) // itemsize
+        block = self.pending.get(topic)
+        if block is not None and header.nSamplesFromDAQStart is not None and block[3] != header.nSamplesFromDAQStart:
+            self.flush(topic)
+            block = None
+        if block is None:
+            block = self.pending[topic] = [bytes(payload[:header.descriptorLength]), [], 0, None]
+        block[1].append(payload[header.descriptorLength:])
+        block[2] += nSamples
+        if header.nSamplesFromDAQStart is not None:
+            block[3] = header.nSamplesFromDAQStart + nSamples
+        if block[2] >= self.nBlock:
+            self.flush(topic)
+
+    def flush(self, topic):
+        block = self.pending.pop(topic)
+        self.handle(topic, b"".join([block[0]] + block[1]))
+
+    def flush_all(self):
+        for topic in list(self.pending):
+            self.flush(topic)
+
+
+def run_worker(strCapture, offsets, create_host, strDir, nBlock):
+    """
+    Processes the records at offsets (in the file order) with a Host of its own.
+    """
+    host = create_host()
+    writer = OutputWriter(strDir)
+    host.outbound.mqttc_out = writer
+
+    def handle(topic, payload):
+        host.handle_message(shard.RingMessage(topic, payload))
+
+    joiner = FrameJoiner(nBlock, handle) if nBlock > 0 else None
+    # The waits (--gather_timeout, --reorder_wait) run on the capture time, the time stamps of the
+    # records: the periodic duties flush the steps a sensor did not deliver as in the streaming
+    # service, instead of keeping them all to the end
+    now = [0.0]
+    host.clock = lambda: now[0]
+    tNextTick = None
+    with capture.CaptureReader(strCapture) as reader:
+        for offset in offsets:
+            now[0], topic, payload, _ = reader.record_at(int(offset))
+            if host.tick is not None:
+                if tNextTick is None:
+                    tNextTick = now[0] + host.tick
+                elif now[0] >= tNextTick:
+                    for iShard in range(host.nShards):
+                        host.periodic(iShard)
+                    tNextTick = now[0] + host.tick
+            if topic.endswith("/metadata"):
+                # small, and json needs bytes
+                payload = bytes(payload)
+                if joiner is not None:
+                    joiner.on_metadata(topic, payload)
+                else:
+                    handle(topic, payload)
+            elif joiner is not None:
+                joiner.on_data(topic, payload)
+            else:
+                handle(topic, payload)
+        if joiner is not None:
+            joiner.flush_all()
+        host.flush_reordered(0, True)
+        # What is left: the time steps some of the sensors did not deliver, the coalesced frames
+        for iShard in range(host.nShards):
+            host.flush_pending(iShard, True)
+        host.outbound.flush_all()
+        # the views on the file must be gone before it is closed
+        payload = None
+    writer.close()
+
+
+def run(strCapture, strDir, create_host, group_key=None, nProcesses=0, nBlock=0):
+    """
+    Processes a capture file.
+
+    Parameters:
+    strCapture: The capture file
+    strDir: The output directory (created if needed)
+    create_host: Called (in every worker process) to create the Host
+    group_key: Distribute by group_key(the stream key as a tuple), e.g. its channel set, instead of by the stream
+    nProcesses: The number of the worker processes, 0 for the number of the cores
+    nBlock: Join the frames of a stream into blocks of at least that many samples, 0 to keep the frames
+    """
+    tStart = time.monotonic()
+    os.makedirs(strDir, exist_ok=True)
+    if nProcesses <= 0:
+        nProcesses = os.cpu_count() or 1
+    # Index: the records of every worker, in the file order
+    offsets = [[] for _ in range(nProcesses)]
+    workerOfTopic = {}
+    nRecords = 0
+    with capture.CaptureReader(strCapture) as reader:
+        for offset, _, topic, payload in reader.records():
+            iWorker = workerOfTopic.get(topic)
+            if iWorker is None:
+                myKey = topic.rsplit('/', 1)[0] if group_key is None else '/'.join(group_key(tuple(topic.split('/')[:-1])))
+                iWorker = workerOfTopic[topic] = shard.jump_hash(myKey, nProcesses)
+            offsets[iWorker].append(offset)
+            nRecords += 1
+        payload = None
+    offsets = [np.array(workerOffsets, dtype=np.int64) for workerOffsets in offsets]
+    print(f"{strCapture}: {nRecords} messages, {len(workerOfTopic)} topics, {nProcesses} processes")
+
+    if nProcesses == 1:
+        run_worker(strCapture, offsets[0], create_host, strDir, nBlock)
+    else:
+        # fork: the workers inherit the blocks (create_host) and the index
+        ctx = multiprocessing.get_context("fork")
+        processes = [ctx.Process(target=run_worker, args=(strCapture, workerOffsets, create_host, strDir, nBlock))
+                     for workerOffsets in offsets if len(workerOffsets) > 0]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"An offline worker process failed (exit code {process.exitcode})")
+    print(f"Done in {time.monotonic() - tStart:.1f} s, the results are in {strDir}")
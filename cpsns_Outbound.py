@@ -0,0 +1,200 @@
+"""
+Outbound stage of the services: encodes the processed frames and publishes them to MQTT_OUT.
+
+Without coalescing every frame is published as it is, from the reused output buffer of its
+output (one publish per frame). With coalescing (max_bytes > 0) the consecutive frames of an
+output are collected into one CP-SENS frame: the header of the first frame (its time stamp
+and nSamplesFromDAQStart are those of the first sample) followed by the samples of all of
+them. A batch is published when the next frame would not fit into max_bytes, when the next
+frame does not continue it (a gap in nSamplesFromDAQStart), or max_delay seconds after its
+first frame (flush_expired). The number of samples per frame then varies, so the metadata of
+the outputs says Data.Samples = -1.
+
+The output buffer of a frame of another length than the last one (variable-length frames) is
+resized in place within its size class, or taken from the BufferPool (cpsns_BufferPool); a
+coalesced batch is published from that buffer too.
+
+With bTimed (metrics), the encode and publish times and the lag of the published frames (from
+the time stamp in their header) go into histograms: for the frames the host asks to time, and
+for every coalesced batch (the lag of its first frame).
+"""
+import threading
+import time
+import numpy as np
+import cpsns_BufferPool as bufferpool
+import cpsns_Codec as codec
+import cpsns_Metrics as metrics
+from cpsns_WorkQueue import LatencyHistogram
+
+COALESCE_DELAY_DEFAULT = 0.1 # s
+
+
+class OutputBatch:
+    """
+    The frames of one output waiting to be published as one frame.
+    """
+    __slots__ = ("buffer", "nBytes", "nFrames", "tFirst", "tFrame", "nextSample")
+
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.nBytes = 0        # used bytes of buffer (header included), 0 if empty
+        self.nFrames = 0
+        self.tFirst = 0.0      # time.monotonic() of the first frame
+        self.tFrame = 0.0      # the time stamp (s since the epoch) of the first frame
+        self.nextSample = None # nSamplesFromDAQStart the next frame must have to continue the batch
+
+
+class Outbound:
+    def __init__(self, mqttc_out, max_bytes=0, max_delay=COALESCE_DELAY_DEFAULT, pool=None):
+        """
+        Parameters:
+        mqttc_out: The MQTT client (anything with publish(topic, payload))
+        max_bytes: The max size of a coalesced frame (in bytes), 0 for no coalescing
+        max_delay: The max time a frame waits in a batch (in s)
+        pool: The BufferPool of the output buffers (a new one if None)
+        """
+        self.mqttc_out = mqttc_out
+        self.pool = bufferpool.BufferPool() if pool is None else pool
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.bCoalesce = max_bytes > 0
+        self.batches = {}           # StreamOutput -> OutputBatch, the outputs with a non-empty batch
+        self.lock = threading.Lock()
+        # Counters
+        self.nFrames = 0            # frames sent
+        self.nPublished = 0         # data messages published
+        self.nBytes = 0
+        self.maxFrames = 0          # the largest batch (in frames)
+        # Timing (metrics), updated under the lock
+        self.bTimed = False
+        self.encodeTime = LatencyHistogram()
+        self.publishTime = LatencyHistogram()
+        self.lag = LatencyHistogram(metrics.LAG_MIN, metrics.LAG_MAX)
+
+    def publish_metadata(self, output):
+        self.mqttc_out.publish(output.metadataTopic, output.metadata)
+
+    def send(self, output, payload, header, samples, cType, bTimed=False):
+        """
+        Sends one processed frame of the output.
+
+        Parameters:
+        output: The StreamOutput
+        payload: The input frame, its header is reused
+        header: The FrameHeader of payload (its nSamplesFromDAQStart is the one published)
+        samples: The processed samples, cast to cType
+        cType: The sample type of the output, 'f' or 'd'
+        bTimed: Time the encoding and the publishing of this frame (if the metrics are on)
+        """
+        bTimed = bTimed and self.bTimed
+        if not self.bCoalesce:
+            if bTimed:
+                t0 = time.perf_counter()
+            frameLength = header.descriptorLength + len(samples) * np.dtype(cType).itemsize
+            if output.outBuffer is None or len(output.outBuffer) != frameLength:
+                output.outBuffer = self.pool.fit_bytearray(output.outBuffer, frameLength)
+            output.outBuffer = codec.encode_data(payload, header.descriptorLength, samples, cType, output.outBuffer, header.nSamplesFromDAQStart)
+            if bTimed:
+                t1 = time.perf_counter()
+            self.mqttc_out.publish(output.dataTopic, output.outBuffer)
+            with self.lock:
+                self.count(1, len(output.outBuffer))
+                if bTimed:
+                    t2 = time.perf_counter()
+                    self.encodeTime.record(t1 - t0)
+                    self.publishTime.record(t2 - t1)
+                    self.lag.record(time.time() - header.secFromEpoch - 1e-9 * header.nanosec)
+            return
+        if bTimed:
+            t0 = time.perf_counter()
+        dtype = np.dtype(cType)
+        nSampleBytes = len(samples) * dtype.itemsize
+        with self.lock:
+            batch = self.batches.get(output)
+            if batch is not None and (batch.nBytes + nSampleBytes > len(batch.buffer) or batch.nextSample != header.nSamplesFromDAQStart):
+                self.flush(output)
+                batch = None
+            if batch is None:
+                # Start a batch, in the buffer of the output (allocated once)
+                batch = output.batch
+                frameLength = header.descriptorLength + nSampleBytes
+                if batch is None or len(batch.buffer) < frameLength:
+                    batch = output.batch = OutputBatch(max(self.max_bytes, frameLength))
+                # The header of the first frame
+                batch.buffer[0:header.descriptorLength] = memoryview(payload)[0:header.descriptorLength]
+                if header.nSamplesFromDAQStart is not None:
+                    codec.write_sample_index(batch.buffer, header.nSamplesFromDAQStart)
+                batch.nBytes = header.descriptorLength
+                batch.nFrames = 0
+                batch.tFirst = time.monotonic()
+                batch.tFrame = header.secFromEpoch + 1e-9 * header.nanosec
+                batch.nextSample = None
+                self.batches[output] = batch
+            np.frombuffer(batch.buffer, dtype=dtype, count=len(samples), offset=batch.nBytes)[:] = samples
+            batch.nBytes += nSampleBytes
+            batch.nFrames += 1
+            if header.nSamplesFromDAQStart is not None:
+                batch.nextSample = header.nSamplesFromDAQStart + len(samples)
+            if bTimed:
+                self.encodeTime.record(time.perf_counter() - t0)
+            if batch.nBytes + nSampleBytes > len(batch.buffer):
+                # the next frame of the same size would not fit
+                self.flush(output)
+
+    def flush(self, output):
+        # Must be called with the lock held
+        batch = self.batches.pop(output)
+        if self.bTimed:
+            t0 = time.perf_counter()
+        # (from the output buffer: the batch buffer is larger and filled again right away)
+        output.outBuffer = self.pool.fit_bytearray(output.outBuffer, batch.nBytes)
+        output.outBuffer[:] = memoryview(batch.buffer)[:batch.nBytes]
+        self.mqttc_out.publish(output.dataTopic, output.outBuffer)
+        self.count(batch.nFrames, batch.nBytes)
+        if self.bTimed:
+            self.publishTime.record(time.perf_counter() - t0)
+            self.lag.record(time.time() - batch.tFrame)
+        batch.nBytes = 0
+
+    def flush_expired(self, now=None):
+        """
+        Publishes the batches older than max_delay.
+        """
+        if not self.batches:
+            return
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            for output in [output for output, batch in self.batches.items() if now - batch.tFirst >= self.max_delay]:
+                self.flush(output)
+
+    def flush_all(self):
+        with self.lock:
+            for output in list(self.batches):
+                self.flush(output)
+
+    def close(self, output):
+        """
+        Publishes the pending batch of an output that is going away.
+        """
+        with self.lock:
+            if output in self.batches:
+                self.flush(output)
+
+    def count(self, nFrames, nBytes):
+        # Must be called with the lock held
+        self.nFrames += nFrames
+        self.nPublished += 1
+        self.nBytes += nBytes
+        if nFrames > self.maxFrames:
+            self.maxFrames = nFrames
+
+    def stats(self):
+        return {
+            "frames": self.nFrames,
+            "published": self.nPublished,
+            "bytes": self.nBytes,
+            "mean_batch": self.nFrames / max(1, self.nPublished),
+            "max_batch": self.maxFrames,
+            "pending": len(self.batches),
+        }
@@ -0,0 +1,308 @@
+"""
+Record, replay and benchmark the CP-SENS traffic without the production broker.
+
+    record: subscribes to MQTT_IN and writes the data and the metadata messages to a capture file
+        python cpsns_Replay.py record capture.bin --host localhost --duration 60
+    synth: writes a synthetic capture (sine + noise, fixed seed): so many channels, frame size...
+        python cpsns_Replay.py synth capture.bin --channels 16 --frame 256 --seconds 10
+    replay: publishes a capture to a broker (e.g. a local mosquitto) at 1x, Nx or max speed
+        python cpsns_Replay.py replay capture.bin --host localhost --speed 0
+    bench: runs the services in this process, fed by a fake MQTT client (no broker), and reports
+        the throughput, the end-to-end latency percentiles, the CPU time and the RSS
+        python cpsns_Replay.py bench --channels 1 16 128 --frame 64 1024 --chain detrend integrate
+
+The benchmark runs every configuration (service x channels x frame size) in a forked process of
+its own, so that the CPU time and the memory of the runs do not mix. Without --chain, the detrend,
+hpf and integrate services are measured one by one.
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import struct
+import time
+import numpy as np
+from paho.mqtt.client import Client as MQTTClient
+from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.client import MQTTv311
+import cpsns_Capture as capture
+import cpsns_Codec as codec
+import cpsns_FB_Template as template
+import cpsns_Framework as fw
+import cpsns_WorkQueue as wq
+
+SERVICES_DEFAULT = ["detrend", "hpf", "integrate"]
+CHANNELS_DEFAULT = [1, 16, 128]
+FRAME_DEFAULT = [64, 1024]
+SAMPLING_DEFAULT = 1000.0
+SECONDS_DEFAULT = 10.0
+CHANNELS_PER_NODE = 8   # synthetic topics: cpsens/synth/<node>/<channel>/acc/raw
+
+
+class FakeMessage:
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeMQTTClient:
+    """
+    In-process stand-in for the paho client: publish calls on_publish(topic, payload) right away.
+    """
+    def __init__(self, on_publish=None):
+        self.on_publish = on_publish
+        self.nPublished = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.nPublished += 1
+        if self.on_publish is not None:
+            self.on_publish(topic, payload)
+
+
+def synthesize(nChannels, nFrame, Fs=SAMPLING_DEFAULT, dSeconds=SECONDS_DEFAULT, cType='f', seed=0):
+    """
+    Yields (t, topic, payload) of a synthetic capture: the metadata of every channel, then the
+    frames (all the channels of a time step together), t relative to the start.
+    """
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(cType)
+    topics = [f"cpsens/synth/{i // CHANNELS_PER_NODE}/{i % CHANNELS_PER_NODE}/acc/raw" for i in range(nChannels)]
+    metadata = {"Data": {"Samples": nFrame, "Type": "float" if cType == 'f' else "double", "Unit": "m/s^2"},
+                "Analysis chain": [{"Name": "DAQ", "Sampling": Fs}]}
+    for topic in topics:
+        yield 0.0, topic + "/metadata", json.dumps(metadata).encode()
+    frequencies = rng.uniform(1.0, Fs / 10, nChannels)[:, None]
+    for iFrame in range(int(dSeconds * Fs / nFrame)):
+        t = iFrame * nFrame / Fs
+        n = np.arange(iFrame * nFrame, (iFrame + 1) * nFrame)
+        frames = (np.sin(2 * np.pi * frequencies * n / Fs) + 0.1 * rng.standard_normal((nChannels, nFrame)) + 0.5).astype(dtype)
+        header = struct.pack(codec.HEADER_FORMAT_V2, 28, 2, 1700000000 + int(t), int((t % 1) * 1e9), iFrame * nFrame)
+        for topic, frame in zip(topics, frames):
+            yield t, topic + "/data", header + frame.tobytes()
+
+
+def replay(messages, publish, speed=1.0):
+    """
+    Publishes the (t, topic, payload) messages, speed times faster than recorded (0: as fast as
+    possible). Returns the number of messages.
+    """
+    n = 0
+    tStart = time.monotonic()
+    t0 = None
+    for t, topic, payload in messages:
+        if t0 is None:
+            t0 = t
+        if speed > 0:
+            delay = (t - t0) / speed - (time.monotonic() - tStart)
+            if delay > 0:
+                time.sleep(delay)
+        publish(topic, payload)
+        n += 1
+    return n
+
+
+def cmd_record(args):
+    json_config_private, json_config_public = fw.load_configs(args)
+    broker = json_config_private["MQTT_IN"]
+    writer = capture.CaptureWriter(args.capture)
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        print("MQTT_IN: Connected with response code %s" % rc)
+        for topic in json_config_public["MQTT_IN"]["TopicsToSubscribe"]:
+            print(f"MQTT_IN: Subscribing to the topic {topic}...")
+            client.subscribe(topic, qos=json_config_public["MQTT_IN"]["QoS"])
+
+    def on_message(client, userdata, msg):
+        writer.write(time.time(), msg.topic, msg.payload)
+
+    mqttc = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
+    if broker["userId"] != "":
+        mqttc.username_pw_set(broker["userId"], broker["password"])
+    mqttc.on_connect = on_connect
+    mqttc.on_message = on_message
+    mqttc.connect(broker["host"], broker["port"], 60)
+    mqttc.loop_start()
+    tStart = time.monotonic()
+    try:
+        while args.duration <= 0 or time.monotonic() - tStart < args.duration:
+            time.sleep(1.0)
+            print(f"Recorded {writer.nRecords} messages")
+    except KeyboardInterrupt:
+        pass
+    mqttc.loop_stop()
+    writer.close()
+    print(f"Recorded {writer.nRecords} messages to {args.capture}")
+
+
+def cmd_synth(args):
+    with capture.CaptureWriter(args.capture) as writer:
+        for t, topic, payload in synthesize(args.channels[0], args.frame[0], args.sampling, args.seconds, args.type):
+            writer.write(t, topic, payload)
+    print(f"Wrote {writer.nRecords} messages to {args.capture}")
+
+
+def cmd_replay(args):
+    json_config_private, _ = fw.load_configs(args)
+    broker = json_config_private["MQTT_OUT"]
+    mqttc = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
+    if broker["userId"] != "":
+        mqttc.username_pw_set(broker["userId"], broker["password"])
+    mqttc.connect(broker["host"], broker["port"], 60)
+    mqttc.loop_start()
+    tStart = time.monotonic()
+    with capture.CaptureReader(args.capture) as reader:
+        # paho keeps the payload until it is sent: give it a copy, not a view on the file
+        n = replay(reader, lambda topic, payload: mqttc.publish(topic, bytes(payload)), args.speed)
+    mqttc.loop_stop()
+    dElapsed = time.monotonic() - tStart
+    print(f"Replayed {n} messages in {dElapsed:.2f} s ({n / dElapsed:.0f} messages/s)")
+
+
+def read_rss():
+    # (current, peak) resident set size of this process, in MiB
+    values = {}
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                values[line.split(':')[0]] = int(line.split()[1]) / 1024
+    return values.get("VmRSS", 0.0), values.get("VmHWM", 0.0)
+
+
+def run_benchmark(create_blocks, args, nChannels, nFrame):
+    """
+    Runs the service on a synthetic stream and returns the measurements (a dict).
+    """
+    messages = list(synthesize(nChannels, nFrame, args.sampling, args.seconds, args.type))
+    host = fw.Host(create_blocks(args), args.gather_timeout, args.worker_threads, args.queue_size, "block", 0, 0, 0,
+                   args.coalesce_bytes, args.coalesce_delay)
+    latency = wq.LatencyHistogram()
+    injected = {}         # (input key, secFromEpoch, nanosec) -> time of the injection
+    inputKeys = {}        # output data topic -> input key
+    counters = {"frames": 0, "samples": 0}
+
+    def on_publish(topic, payload):
+        if topic.endswith("/metadata"):
+            return
+        key = inputKeys.get(topic)
+        if key is None:
+            for stream in list(host.myDict.streams.values()):
+                for output in stream.outputs:
+                    inputKeys[output.dataTopic] = '/'.join(stream.key)
+            key = inputKeys[topic]
+        header = codec.decode_header(payload)
+        tInjected = injected.pop((key, header.secFromEpoch, header.nanosec), None)
+        if tInjected is not None:
+            latency.record(time.perf_counter() - tInjected)
+        counters["frames"] += 1
+
+    host.outbound.mqttc_out = FakeMQTTClient(on_publish)
+    if host.workQueue is not None:
+        host.workQueue.start()
+
+    def inject(topic, payload):
+        if topic.endswith("/data"):
+            header = codec.decode_header(payload)
+            injected[(topic[:-len("/data")], header.secFromEpoch, header.nanosec)] = time.perf_counter()
+            counters["samples"] += nFrame
+        host.on_message(None, None, FakeMessage(topic, payload))
+
+    cpuStart = time.process_time()
+    tStart = time.perf_counter()
+    replay(messages, inject, args.speed)
+    if host.workQueue is not None:
+        host.workQueue.stop()
+    # What is left: the frames waiting for the missing ones, the time steps some of the sensors
+    # did not deliver, the coalesced frames
+    for iShard in range(host.nShards):
+        host.flush_reordered(iShard, True)
+    for iShard in range(host.nShards):
+        host.flush_pending(iShard, True)
+    host.outbound.flush_all()
+    dElapsed = time.perf_counter() - tStart
+    dCPU = time.process_time() - cpuStart
+    rss, rssPeak = read_rss()
+    nFrames = len(messages) - nChannels
+    return {
+        "channels": nChannels,
+        "frame": nFrame,
+        "frames_in": nFrames,
+        "frames_out": counters["frames"],
+        "frames_per_s": nFrames / dElapsed,
+        "samples_per_s": counters["samples"] / dElapsed,
+        "latency_p50_ms": 1e3 * latency.percentile(50),
+        "latency_p90_ms": 1e3 * latency.percentile(90),
+        "latency_p99_ms": 1e3 * latency.percentile(99),
+        "latency_max_ms": 1e3 * latency.max,
+        "cpu_s": dCPU,
+        "cpu_percent": 100 * dCPU / dElapsed,
+        "rss_mib": rss,
+        "rss_peak_mib": rssPeak,
+    }
+
+
+def cmd_bench(args, chains):
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    print(f"{'service':<24} {'ch':>5} {'frame':>6} {'frames/s':>10} {'Msamples/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'CPU %':>6} {'RSS MiB':>8}")
+    for chain in chains:
+        modules = [importlib.import_module(template.BLOCK_MODULES[name]) for name in chain]
+        create_blocks = lambda args: [module.create_block(args) for module in modules]
+        for nChannels in args.channels:
+            for nFrame in args.frame:
+                # a process per run: the CPU time and the memory of the runs do not mix
+                queue = ctx.Queue()
+                process = ctx.Process(target=lambda: queue.put(run_benchmark(create_blocks, args, nChannels, nFrame)))
+                process.start()
+                result = queue.get()
+                process.join()
+                result["service"] = ' '.join(chain)
+                results.append(result)
+                print(f"{result['service']:<24} {nChannels:>5} {nFrame:>6} {result['frames_per_s']:>10.0f} {result['samples_per_s'] / 1e6:>10.2f} "
+                      f"{result['latency_p50_ms']:>8.3f} {result['latency_p99_ms']:>8.3f} {result['cpu_percent']:>6.0f} {result['rss_peak_mib']:>8.1f}")
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+        print(f"The results are in {args.json}")
+
+
+def main():
+    # The blocks of the benchmarked chains add their own arguments
+    chainParser = argparse.ArgumentParser(add_help=False)
+    chainParser.add_argument('--chain', nargs='+', choices=template.BLOCK_MODULES.keys())
+    chainArgs, _ = chainParser.parse_known_args()
+    chains = [chainArgs.chain] if chainArgs.chain else [[name] for name in SERVICES_DEFAULT]
+
+    parser = argparse.ArgumentParser(description="Records, replays and benchmarks the CP-SENS traffic.")
+    parser.add_argument('command', choices=["record", "synth", "replay", "bench"])
+    parser.add_argument('capture', nargs='?', help='The capture file (record, synth, replay)')
+    fw.add_host_arguments(parser)
+    parser.add_argument('--duration', type=float, help='record: stop after that many seconds, 0 for Ctrl+C. Defaults to 0', default=0)
+    parser.add_argument('--speed', type=float, help='replay/bench: 1 for real time, N for N times faster, 0 for as fast as possible. Defaults to 0', default=0)
+    parser.add_argument('--channels', type=int, nargs='+', help='synth/bench: the numbers of channels. Defaults to ' + ' '.join(map(str, CHANNELS_DEFAULT)), default=CHANNELS_DEFAULT)
+    parser.add_argument('--frame', type=int, nargs='+', help='synth/bench: the frame sizes (samples). Defaults to ' + ' '.join(map(str, FRAME_DEFAULT)), default=FRAME_DEFAULT)
+    parser.add_argument('--sampling', type=float, help='synth/bench: the sampling frequency (Hz). Defaults to ' + str(SAMPLING_DEFAULT), default=SAMPLING_DEFAULT)
+    parser.add_argument('--seconds', type=float, help='synth/bench: the length of the synthetic stream (s). Defaults to ' + str(SECONDS_DEFAULT), default=SECONDS_DEFAULT)
+    parser.add_argument('--type', type=str, choices=['f', 'd'], help="synth/bench: the sample type. Defaults to f", default='f')
+    parser.add_argument('--chain', nargs='+', choices=template.BLOCK_MODULES.keys(), help='bench: the service (chain of blocks) to measure. Defaults to ' + ', '.join(SERVICES_DEFAULT) + ' one by one')
+    parser.add_argument('--json', type=str, help='bench: also write the results to this JSON file')
+    for module in dict.fromkeys(importlib.import_module(template.BLOCK_MODULES[name]) for chain in chains for name in chain):
+        if hasattr(module, "add_arguments"):
+            module.add_arguments(parser)
+    args = parser.parse_args()
+    if args.command != "bench" and args.capture is None:
+        parser.error(f"{args.command} needs the capture file")
+
+    if args.command == "record":
+        cmd_record(args)
+    elif args.command == "synth":
+        cmd_synth(args)
+    elif args.command == "replay":
+        cmd_replay(args)
+    else:
+        cmd_bench(args, chains)
+
+
+if __name__ == "__main__":
+    main()
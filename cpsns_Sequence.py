@@ -0,0 +1,247 @@
+"""
+Sequence tracking of the streams: nSamplesFromDAQStart (the frame header, metadataVer >= 2)
+says where every frame belongs, so lost, repeated and reordered frames can be detected before
+they go through the blocks (whose states assume that the samples are continuous).
+
+Per stream:
+    - a frame that continues the stream is processed
+    - a frame that starts before the expected sample is dropped: a duplicate, or a late frame
+      that had already been given up on (counted apart). A frame far behind (RESTART_FRAMES
+      frames) means that the DAQ was restarted: the stream starts again from it
+    - a frame that starts after the expected sample waits in the reorder buffer (at most
+      reorder_frames frames, for at most reorder_wait s) for the missing ones. When the wait
+      is over, the missing samples are a gap and the waiting frames are processed in order
+
+The gaps are handled by the host before the frame that follows the gap, by the gap policy:
+    none:        count them only, the states carry on as before
+    zero:        run zeros through the blocks in place of the missing samples (not published)
+    extrapolate: run the last sample, repeated, in place of the missing samples (not published)
+    reset:       start the block states again, as from the metadata
+A gap longer than gap_fill_max samples always resets the states.
+
+Frames without nSamplesFromDAQStart (metadataVer < 2) are processed as they come.
+
+The SequenceStage is the part of the host that does all this: the policies, the streams
+waiting in their reorder buffer and the counters.
+"""
+import struct
+import numpy as np
+
+GAP_POLICIES = ("none", "zero", "extrapolate", "reset")
+GAP_POLICY_DEFAULT = "none"
+REORDER_FRAMES_DEFAULT = 0      # frames per stream, 0: no reordering (a frame that comes early makes a gap)
+REORDER_WAIT_DEFAULT = 0.05     # s
+GAP_FILL_MAX_DEFAULT = 100000   # samples
+RESTART_FRAMES = 16             # a frame that many frames behind restarts the stream
+
+RESET = -1  # in SequenceTracker.gaps: reset the states instead of filling
+
+# The counters of the trackers: (the name in SequenceStage.stats, the SequenceTracker attribute, the metric, its help)
+COUNTERS = (
+    ("gaps", "nGaps", "cpsns_sequence_gaps_total", "Gaps in nSamplesFromDAQStart"),
+    ("gap_samples", "nGapSamples", "cpsns_sequence_gap_samples_total", "Samples missing in the gaps"),
+    ("duplicates", "nDuplicates", "cpsns_sequence_duplicates_total", "Duplicate frames dropped"),
+    ("late", "nLate", "cpsns_sequence_late_total", "Frames dropped because they came after their gap was given up"),
+    ("reordered", "nReordered", "cpsns_sequence_reordered_total", "Frames put back in order by the reorder buffer"),
+    ("restarts", "nRestarts", "cpsns_sequence_restarts_total", "DAQ restarts (nSamplesFromDAQStart went back)"),
+)
+
+
+class SequenceTracker:
+    """
+    The sequence state of one stream.
+    """
+    __slots__ = (
+        "itemsize",       # bytes per sample
+        "bRecordGaps",    # keep the gaps for the host (the gap policy is not "none")
+        "expected",       # nSamplesFromDAQStart of the next frame, None before the first frame
+        "pending",        # the reorder buffer: nSamplesFromDAQStart -> (payload, nSamples, arrival time)
+        "gaps",           # nSamplesFromDAQStart of the frame after a gap -> missing samples (or RESET)
+        "lastGap",        # (first, end) sample of the last gap, to tell the late frames from the duplicates
+        "lastSample",     # the last input sample (extrapolate)
+        "nGaps", "nGapSamples", "nDuplicates", "nLate", "nReordered", "nRestarts",
+    )
+
+    def __init__(self, itemsize, bRecordGaps=False):
+        self.itemsize = itemsize
+        self.bRecordGaps = bRecordGaps
+        self.expected = None
+        self.pending = {}
+        self.gaps = {}
+        self.lastGap = None
+        self.lastSample = 0.0
+        self.nGaps = 0
+        self.nGapSamples = 0
+        self.nDuplicates = 0
+        self.nLate = 0
+        self.nReordered = 0
+        self.nRestarts = 0
+
+    def push(self, payload, reorder_frames=0, now=0.0):
+        """
+        Takes a data frame of the stream.
+
+        Parameters:
+        payload: The frame
+        reorder_frames: The capacity of the reorder buffer, 0 for no reordering
+        now: The arrival time (time.monotonic(), used if the frame has to wait)
+
+        Returns:
+        The list of the frames to process now, in order (possibly empty)
+        """
+        descriptorLength, metadataVer = struct.unpack_from('=HH', payload)
+        if metadataVer < 2:
+            return [payload]
+        n = struct.unpack_from('=Q', payload, 20)[0]
+        nSamples = (len(payload) - descriptorLength) // self.itemsize
+        expected = self.expected
+        if expected is None or n == expected:
+            self.expected = n + nSamples
+            if not self.pending:
+                return [payload]
+            return [payload] + self.release()
+        if n < expected:
+            if n + RESTART_FRAMES * max(nSamples, 1) < expected:
+                # The DAQ was restarted: what is waiting belongs to the old sequence
+                self.nRestarts += 1
+                ready = self.flush()
+                self.expected = n + nSamples
+                self.lastGap = None
+                if self.bRecordGaps:
+                    self.gaps[n] = RESET
+                return ready + [payload]
+            if self.lastGap is not None and self.lastGap[0] <= n < self.lastGap[1]:
+                self.nLate += 1
+            else:
+                self.nDuplicates += 1
+            return []
+        # Ahead of the expected sample: something is missing (or late)
+        if reorder_frames <= 0:
+            self.skip_to(n)
+            self.expected = n + nSamples
+            return [payload]
+        if n in self.pending:
+            self.nDuplicates += 1
+            return []
+        self.pending[n] = (payload, nSamples, now)
+        if len(self.pending) <= reorder_frames:
+            return []
+        # The buffer is full: give up on the missing samples
+        return self.give_up()
+
+    def skip_to(self, n):
+        # The samples from expected to n are lost
+        nGap = n - self.expected
+        self.nGaps += 1
+        self.nGapSamples += nGap
+        self.lastGap = (self.expected, n)
+        if self.bRecordGaps:
+            self.gaps[n] = nGap
+        self.expected = n
+
+    def release(self):
+        # The waiting frames that continue the stream
+        ready = []
+        while self.expected in self.pending:
+            payload, nSamples, _ = self.pending.pop(self.expected)
+            ready.append(payload)
+            self.expected += nSamples
+            self.nReordered += 1
+        return ready
+
+    def give_up(self):
+        # Skips to the first waiting frame
+        self.skip_to(min(self.pending))
+        return self.release()
+
+    def expire(self, now, reorder_wait):
+        """
+        Returns the waiting frames (in order) if the oldest one has waited for reorder_wait s.
+        """
+        ready = []
+        while self.pending and now - min(arrival for _, _, arrival in self.pending.values()) >= reorder_wait:
+            ready += self.give_up()
+        return ready
+
+    def flush(self):
+        """
+        Returns all the waiting frames, in order (e.g. when stopping).
+        """
+        ready = []
+        while self.pending:
+            ready += self.give_up()
+        return ready
+
+
+class SequenceStage:
+    """
+    The sequence handling of a host. The streams are its StreamStates: their tracker is in
+    their sequence attribute. Must be used with the lock of the host held.
+    """
+    def __init__(self, gap_policy=GAP_POLICY_DEFAULT, reorder_frames=REORDER_FRAMES_DEFAULT, reorder_wait=REORDER_WAIT_DEFAULT,
+                 gap_fill_max=GAP_FILL_MAX_DEFAULT, nShards=1):
+        if gap_policy not in GAP_POLICIES:
+            raise ValueError(f"Unknown gap policy {gap_policy}, use one of {GAP_POLICIES}")
+        self.gap_policy = gap_policy
+        self.reorder_frames = reorder_frames
+        self.reorder_wait = reorder_wait
+        self.gap_fill_max = gap_fill_max
+        # Per shard: the streams with frames in their reorder buffer
+        self.reorderingStreams = [set() for _ in range(nShards)]
+
+    def tracker(self, itemsize):
+        # The tracker of a new stream
+        return SequenceTracker(itemsize, self.gap_policy != "none")
+
+    def push(self, stream, payload, now=0.0, iShard=0):
+        """
+        Returns the frames of the stream to process now, in order (see SequenceTracker.push).
+        """
+        payloads = stream.sequence.push(payload, self.reorder_frames, now)
+        if stream.sequence.pending:
+            self.reorderingStreams[iShard].add(stream)
+        return payloads
+
+    def expire(self, now, iShard=0, bAll=False):
+        """
+        Returns the (stream, frame) of the shard that have waited longer than reorder_wait for
+        the missing frames of their stream (all of them with bAll, e.g. when stopping), in order.
+        """
+        ready = []
+        reorderingStreams = self.reorderingStreams[iShard]
+        for stream in list(reorderingStreams):
+            payloads = stream.sequence.flush() if bAll else stream.sequence.expire(now, self.reorder_wait)
+            if not stream.sequence.pending:
+                reorderingStreams.discard(stream)
+            ready += [(stream, payload) for payload in payloads]
+        return ready
+
+    def forget(self, stream, iShard=0):
+        self.reorderingStreams[iShard].discard(stream)
+
+    def take_gap(self, tracker, nSample):
+        """
+        Returns the number of the samples missing before the frame that starts at nSample, to
+        fill by the gap policy, RESET if the states have to start again, None if there is no gap.
+        """
+        nGap = tracker.gaps.pop(nSample, None)
+        if nGap is None:
+            return None
+        if self.gap_policy == "reset" or nGap == RESET or nGap > self.gap_fill_max:
+            return RESET
+        return nGap
+
+    def filling(self, tracker, nGap):
+        # The samples run through the blocks in place of the missing ones
+        return np.full(nGap, 0.0 if self.gap_policy == "zero" else float(tracker.lastSample))
+
+    def stats(self, streams):
+        """
+        Returns the totals of the counters of the streams.
+        """
+        return {name: sum(getattr(stream.sequence, attribute) for stream in streams) for name, attribute, _, _ in COUNTERS}
+
+    def add_metrics(self, exposition, streams):
+        # The counters per input topic
+        for _, attribute, metric, strHelp in COUNTERS:
+            exposition.metric(metric, "counter", strHelp, [({"topic": '/'.join(stream.key + ("data",))}, getattr(stream.sequence, attribute)) for stream in streams])
@@ -0,0 +1,288 @@
+"""
+Multi-process sharding of the services (--workers N).
+
+The parent process subscribes to MQTT_IN once and routes every stream (the topic key, i.e. the
+topic without data/metadata) to one of N worker processes by consistent hashing. The messages are
+handed over through one shared-memory ring buffer per worker (no pickling). Every worker runs its
+own Host: it owns the state of its streams and publishes to MQTT_OUT itself, so the work scales
+with the number of cores.
+
+Needs the "fork" start method (Linux): the workers inherit the blocks and the shared memory.
+"""
+import glob
+import hashlib
+import multiprocessing
+import signal
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from paho.mqtt.client import Client as MQTTClient
+from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.client import MQTTv311
+import cpsns_Metrics as metrics
+
+RING_SIZE_DEFAULT = 16 # MiB, per worker
+TOPIC_CACHE_MAX = 100000 # topics, the routing cache is cleared when it grows larger
+WORKER_STOP_TIMEOUT = 10.0 # s
+
+RING_HEADER_SIZE = 64        # write position, read position, "producer is waiting" flag
+RECORD_HEADER_FORMAT = '=III' # record length (8-byte aligned), topic length, payload length
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+WRAP_MARKER = 0xFFFFFFFF      # the rest of the ring is unused, continue from the start
+
+
+def jump_hash(key, nBuckets):
+    """
+    Jump consistent hash (Lamping & Veach): when nBuckets grows, only 1/nBuckets of the keys move.
+    The key is hashed with blake2b, so the result is the same in every process and every run.
+    """
+    h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+    b, j = -1, 0
+    while j < nBuckets:
+        b = j
+        h = (h * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((h >> 33) + 1)))
+    return b
+
+
+class SharedRingBuffer:
+    """
+    Single-producer single-consumer ring buffer of (topic, payload) records in shared memory.
+    The positions are monotonic byte counters, the consumer is woken up by a semaphore.
+    """
+    def __init__(self, ctx, capacity):
+        self.capacity = capacity - capacity % 8
+        self.shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_SIZE + self.capacity)
+        self.positions = np.ndarray((3,), dtype=np.uint64, buffer=self.shm.buf)
+        self.positions[:] = 0
+        self.data = self.shm.buf[RING_HEADER_SIZE:]
+        self.items = ctx.Semaphore(0)
+        self.spaceFreed = ctx.Event()
+        self.nDropped = 0
+
+    def put(self, topic, payload, bBlock=True):
+        """
+        Producer: copies the record into the ring. Returns False if it was dropped (the ring is
+        full and bBlock is False, or the record is larger than the ring).
+        """
+        topicBytes = topic.encode()
+        recordLength = RECORD_HEADER_SIZE + len(topicBytes) + len(payload)
+        recordLength += -recordLength % 8
+        if recordLength > self.capacity:
+            self.nDropped += 1
+            return False
+        positions = self.positions
+        while True:
+            writePos = int(positions[0])
+            offset = writePos % self.capacity
+            skip = self.capacity - offset if offset + recordLength > self.capacity else 0
+            if self.capacity - (writePos - int(positions[1])) >= skip + recordLength:
+                break
+            if not bBlock:
+                self.nDropped += 1
+                return False
+            # Full: wait for the consumer
+            self.spaceFreed.clear()
+            positions[2] = 1
+            if self.capacity - (writePos - int(positions[1])) < skip + recordLength:
+                self.spaceFreed.wait(0.01)
+        if skip:
+            struct.pack_into('=I', self.data, offset, WRAP_MARKER)
+            offset = 0
+        struct.pack_into(RECORD_HEADER_FORMAT, self.data, offset, recordLength, len(topicBytes), len(payload))
+        start = offset + RECORD_HEADER_SIZE
+        self.data[start:start + len(topicBytes)] = topicBytes
+        start += len(topicBytes)
+        self.data[start:start + len(payload)] = payload
+        positions[0] = writePos + skip + recordLength
+        self.items.release()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Consumer: returns the next (topic, payload), or None after timeout seconds without data.
+        """
+        if not self.items.acquire(timeout=timeout):
+            return None
+        positions = self.positions
+        readPos = int(positions[1])
+        offset = readPos % self.capacity
+        if struct.unpack_from('=I', self.data, offset)[0] == WRAP_MARKER:
+            readPos += self.capacity - offset
+            offset = 0
+        recordLength, topicLength, payloadLength = struct.unpack_from(RECORD_HEADER_FORMAT, self.data, offset)
+        start = offset + RECORD_HEADER_SIZE
+        topic = bytes(self.data[start:start + topicLength]).decode()
+        start += topicLength
+        payload = bytes(self.data[start:start + payloadLength])
+        positions[1] = readPos + recordLength
+        if positions[2]:
+            positions[2] = 0
+            self.spaceFreed.set()
+        return topic, payload
+
+    def close(self, bUnlink=False):
+        del self.positions
+        self.data.release()
+        self.shm.close()
+        if bUnlink:
+            self.shm.unlink()
+
+
+class RingMessage:
+    """
+    What on_message gets from paho, as far as the Host is concerned.
+    """
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def worker_main(ring, host, json_config_private, metrics_port=0, metrics_addr=metrics.METRICS_ADDR_DEFAULT):
+    # The parent handles Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if metrics_port > 0:
+        host.serve_metrics(metrics_port, metrics_addr)
+    host.connect_out(json_config_private)
+    if host.checkpointer is not None:
+        host.restore_checkpoint()
+        # the parent stops the workers with SIGTERM: write the checkpoint on the way out
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    tick = host.tick
+    lastPeriodic = time.monotonic()
+    try:
+        while True:
+            # Wait for data at most until the periodic duties are due
+            item = ring.get(None if tick is None else max(0.0, tick - (time.monotonic() - lastPeriodic)))
+            if item is not None:
+                host.handle_message(RingMessage(*item))
+            # every tick, not after every message
+            if tick is not None and time.monotonic() - lastPeriodic >= tick:
+                lastPeriodic = time.monotonic()
+                host.periodic()
+    finally:
+        if host.checkpointer is not None:
+            host.write_checkpoint()
+
+
+class ShardRouter:
+    """
+    The parent process: subscribes once and routes the streams to the worker processes.
+    """
+    def __init__(self, nWorkers, ring_size=RING_SIZE_DEFAULT, bBlock=True, group_key=None):
+        """
+        Parameters:
+        nWorkers: The number of worker processes
+        ring_size: The size of the ring buffer of every worker, in MiB
+        bBlock: Wait when a ring is full (True) or drop the message (False)
+        group_key: Route by group_key(the stream key as a tuple), e.g. its channel set, instead of the stream key
+        """
+        self.nWorkers = nWorkers
+        self.group_key = group_key
+        self.ctx = multiprocessing.get_context("fork")
+        self.rings = [SharedRingBuffer(self.ctx, ring_size * 1024 * 1024) for _ in range(nWorkers)]
+        self.bBlock = bBlock
+        self.topicToRing = {}   # topic -> ring, so that the hashing is done once per topic
+        self.processes = []
+        self.topicsToSubscribe = []
+        self.qos = 0
+
+    def worker_of(self, topic):
+        # The key of the stream: the topic without the last element (data/metadata)
+        if self.group_key is None:
+            myKey = topic.rsplit('/', 1)[0]
+        else:
+            myKey = '/'.join(self.group_key(tuple(topic.split('/')[:-1])))
+        return jump_hash(myKey, self.nWorkers)
+
+    def ring_of(self, topic):
+        ring = self.topicToRing.get(topic)
+        if ring is None:
+            if len(self.topicToRing) >= TOPIC_CACHE_MAX:
+                self.topicToRing.clear()
+            ring = self.topicToRing[topic] = self.rings[self.worker_of(topic)]
+        return ring
+
+    def worker_host(self, create_host, iWorker):
+        """
+        Creates the Host of a worker (in the worker process).
+        """
+        host = create_host()
+        if host.checkpointer is not None:
+            # One checkpoint file per worker. On startup every worker takes its streams from all
+            # the files, as the number of the workers may have changed (the files of an earlier
+            # run with more workers are not written again: the newest record of a stream wins)
+            checkpointer = host.checkpointer
+            strFile = checkpointer.strFile
+            checkpointer.strFile = f"{strFile}.{iWorker}"
+            checkpointer.restoreFiles = sorted((strWorkerFile for strWorkerFile in glob.glob(glob.escape(strFile) + ".[0-9]*")
+                                                if strWorkerFile.rsplit('.', 1)[1].isdigit()), key=lambda strWorkerFile: int(strWorkerFile.rsplit('.', 1)[1]))
+            checkpointer.owns = lambda strKey: self.worker_of(strKey + "/data") == iWorker
+        return host
+
+    def on_connect_in(self, mqttc_in, userdata, flags, rc, properties=None):
+        print("MQTT_IN: Connected with response code %s" % rc)
+        for topic in self.topicsToSubscribe:
+            print(f"MQTT_IN: Subscribing to the topic {topic}...")
+            mqttc_in.subscribe(topic, qos=self.qos)
+
+    def on_message(self, client, userdata, msg):
+        self.ring_of(msg.topic).put(msg.topic, msg.payload, self.bBlock)
+
+    def collect_metrics(self):
+        """
+        The metrics of the router (the workers serve their own), in the Prometheus text format.
+        """
+        exposition = metrics.Exposition()
+        exposition.metric("cpsns_ring_used_bytes", "gauge", "Bytes waiting in the ring buffer of a worker",
+                          [({"worker": i}, int(ring.positions[0]) - int(ring.positions[1])) for i, ring in enumerate(self.rings)])
+        exposition.metric("cpsns_frames_dropped_total", "counter", "Messages dropped",
+                          [({"reason": "ring_full", "worker": i}, ring.nDropped) for i, ring in enumerate(self.rings)])
+        return exposition.text()
+
+    def run(self, create_host, json_config_private, json_config_public, metrics_port=0, metrics_addr=metrics.METRICS_ADDR_DEFAULT):
+        """
+        Starts the workers (create_host() is called in every worker) and routes the messages.
+        With metrics_port, the router serves its metrics on that port and worker i on metrics_port + 1 + i.
+        """
+        self.topicsToSubscribe = json_config_public["MQTT_IN"]["TopicsToSubscribe"]
+        self.qos = json_config_public["MQTT_IN"]["QoS"]
+        try:
+            for i, ring in enumerate(self.rings):
+                workerPort = metrics_port + 1 + i if metrics_port > 0 else 0
+                process = self.ctx.Process(target=lambda i=i, ring=ring, workerPort=workerPort: worker_main(ring, self.worker_host(create_host, i), json_config_private, workerPort, metrics_addr), daemon=True)
+                process.start()
+                self.processes.append(process)
+            print(f"Started {self.nWorkers} worker processes")
+            if metrics_port > 0:
+                metrics.MetricsServer(metrics_port, self.collect_metrics, metrics_addr)
+
+            # MQTT_IN stuff
+            mqttc_in = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2, protocol=MQTTv311)
+            # Set username and password
+            if json_config_private["MQTT_IN"]["userId"] != "":
+                mqttc_in.username_pw_set(json_config_private["MQTT_IN"]["userId"], json_config_private["MQTT_IN"]["password"])
+            mqttc_in.on_connect = self.on_connect_in
+            mqttc_in.on_message = self.on_message
+            mqttc_in.connect(json_config_private["MQTT_IN"]["host"], json_config_private["MQTT_IN"]["port"], 60) # we subscribe to the topics in on_connect callback
+            mqttc_in.loop_start()
+            # MQTT_IN done
+
+            while True:
+                time.sleep(1.0)
+                for i, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        print(f"Error: worker process {i} died (exit code {process.exitcode})", file=sys.stderr)
+                        sys.exit(1)
+        finally:
+            for process in self.processes:
+                process.terminate()
+            # let them write their checkpoints
+            for process in self.processes:
+                process.join(WORKER_STOP_TIMEOUT)
+            for ring in self.rings:
+                ring.close(bUnlink=True)
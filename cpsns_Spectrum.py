@@ -0,0 +1,110 @@
+"""
+This program will
+1. read CP-SENS MQTT messages, both data and metadata
+2. calculate the Welch power spectra of the recent samples, every --hop seconds
+3. publish the spectra (to the same broker), with modified ANALYSIS:
+    - /raw/ --> /psd/ (--scaling density) or /spectrum/ (--scaling spectrum), keeping the other
+      parts of the topic identical
+    - metadata will get extended the ANALYSIS CHAIN section (the segments, the window, the
+      number of bins and the frequency resolution), Data.Unit is that of the spectra
+
+A data frame holds the spectra completed by the input frame, one after the other, every one
+Bins values from 0 Hz to Fs/2 (Frequency resolution apart). nSamplesFromDAQStart counts the
+values: divided by Bins it is the index of the first spectrum of the frame, spectrum i being
+that of the samples up to i * Hop s after the DAQ start. If a frame can complete more than one
+spectrum, Data.Samples is -1.
+
+The segments of all the sensors under a node with the same time stamp are transformed in one
+batch, in the sample type of the stream (float32 or float64).
+"""
+import cpsns_Framework as fw
+import simpleSpectrum as spc
+
+NFFT_DEFAULT = 1024
+OVERLAP_DEFAULT = 0.5
+AVERAGES_DEFAULT = 8
+HOP_DEFAULT = 10.0      # s
+WINDOW_DEFAULT = "hann"
+SCALING_DEFAULT = "density"
+
+# Scaling -> (the ANALYSIS part of the topic, the Output in the analysis chain)
+SCALING_OUTPUTS = {
+    "density": ("psd", "PSD"),
+    "spectrum": ("spectrum", "Power spectrum"),
+}
+
+
+class SpectrumBlock(fw.ProcessingBlock):
+    batched = True
+    resampling = True
+
+    def __init__(self, nFFT=NFFT_DEFAULT, dOverlap=OVERLAP_DEFAULT, nAverages=AVERAGES_DEFAULT, dHop=HOP_DEFAULT,
+                 strWindow=WINDOW_DEFAULT, strScaling=SCALING_DEFAULT):
+        """
+        Parameters:
+        nFFT: The segment length (samples)
+        dOverlap: The overlap of the segments, a fraction of nFFT
+        nAverages: The number of the segments averaged in a spectrum
+        dHop: A spectrum every that many seconds (rounded to whole segment steps)
+        strWindow: The window, see scipy.signal.get_window
+        strScaling: "density" (unit^2/Hz) or "spectrum" (unit^2)
+        """
+        if strScaling not in SCALING_OUTPUTS:
+            raise ValueError(f"Unknown scaling {strScaling}, use one of {list(SCALING_OUTPUTS)}")
+        self.nFFT = nFFT
+        self.nOverlap = min(int(round(dOverlap * nFFT)), nFFT - 1)
+        self.nAverages = nAverages
+        self.dHop = dHop
+        self.strWindow = strWindow
+        self.strScaling = strScaling
+
+    def on_metadata(self, substrings, json_metadata):
+        Fs = json_metadata["Analysis chain"][0]["Sampling"]
+        step = self.nFFT - self.nOverlap
+        hop = max(1, round(self.dHop * Fs / step))
+        # Instantiate the spectral analysis (the recent samples and periodograms are kept by it)
+        cType = json_metadata["Data"]["Type"][0]
+        spectrum = spc.RealTimeSpectrum(Fs, self.nFFT, self.nOverlap, self.nAverages, hop, self.strWindow, self.strScaling, cType)
+        # Modify the topic
+        strTopic, strOutput = SCALING_OUTPUTS[self.strScaling]
+        substrings[5] = strTopic
+        # Modify the metadata: add to the analysis section
+        newAnalysis = {"Name": "Welch", "Output": strOutput, "Window": self.strWindow, "Segment": self.nFFT,
+                       "Overlap": self.nOverlap, "Averages": self.nAverages, "Hop": hop * step / Fs,
+                       "Bins": spectrum.nbins(), "Frequency resolution": Fs / self.nFFT}
+        json_metadata["Analysis chain"].append(newAnalysis)
+        strUnit = json_metadata["Data"].get("Unit", "")
+        json_metadata["Data"]["Unit"] = f"({strUnit})^2/Hz" if self.strScaling == "density" else f"({strUnit})^2"
+        nSamples = json_metadata["Data"]["Samples"]
+        json_metadata["Data"]["Samples"] = spectrum.nbins() if nSamples != -1 and nSamples <= hop * step else -1
+        return spectrum
+
+    def output_sample(self, nSample, spectrum):
+        return spectrum.output_sample(nSample)
+
+    def process(self, data, spectrum):
+        return spectrum.apply_filter(data)
+
+    def process_batch(self, datas, spectra):
+        return spc.apply_filter_batch(spectra, datas)
+
+
+def add_arguments(parser):
+    parser.add_argument('--nfft', type=int, help='Segment length (samples). Defaults to ' + str(NFFT_DEFAULT), default=NFFT_DEFAULT)
+    parser.add_argument('--overlap', type=float, help='Overlap of the segments (a fraction of --nfft). Defaults to ' + str(OVERLAP_DEFAULT), default=OVERLAP_DEFAULT)
+    parser.add_argument('--averages', type=int, help='Number of the segments averaged in a spectrum. Defaults to ' + str(AVERAGES_DEFAULT), default=AVERAGES_DEFAULT)
+    parser.add_argument('--hop', type=float, help='Time (in s) between the spectra. Defaults to ' + str(HOP_DEFAULT), default=HOP_DEFAULT)
+    parser.add_argument('--window', type=str, help='Window (scipy.signal.get_window). Defaults to ' + WINDOW_DEFAULT, default=WINDOW_DEFAULT)
+    parser.add_argument('--scaling', type=str, choices=SCALING_OUTPUTS.keys(), help='density (unit^2/Hz) or spectrum (unit^2). Defaults to ' + SCALING_DEFAULT, default=SCALING_DEFAULT)
+
+
+def create_block(args):
+    return SpectrumBlock(args.nfft, args.overlap, args.averages, args.hop, args.window, args.scaling)
+
+
+def main():
+    fw.main("Publishes the Welch power spectra of the CP-SENS streams.", add_arguments, lambda args: [create_block(args)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Per-stream state of the services.
+
+A stream is one sensor channel: the topic without the last element (data/metadata). Its state is
+created from the first metadata message and holds everything the hot path needs, so processing
+a data frame does no topic parsing and, in steady state, no allocation.
+
+The streams are kept in a bounded registry: streams idle for longer than a TTL are evicted, and
+so are the least recently used ones when there are too many. An evicted stream that comes back is
+rebuilt from its next metadata message.
+"""
+import heapq
+import sys
+import threading
+import time
+import numpy as np
+
+
+def sizeof(obj, seen=None):
+    """
+    Approximate number of bytes held by obj, following the containers, the attributes and the
+    NumPy buffers (each object counted once).
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        # only the arrays that own their data (the views are counted with their base)
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else sizeof(obj.base, seen))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool, type(None))):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(sizeof(item, seen) for item in obj)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += sizeof(getattr(obj, slot), seen)
+    if hasattr(obj, "__dict__"):
+        size += sizeof(obj.__dict__, seen)
+    return size
+
+
+class StreamOutput:
+    """
+    One published output of a stream (most streams have one, a multi-output block gives more).
+    """
+    __slots__ = (
+        "name",           # the name of the output (None for the single output of a chain)
+        "metadata",       # the (modified) metadata to publish, JSON string
+        "metadataTopic",  # where to publish the metadata
+        "dataTopic",      # where to publish the data
+        "outBuffer",      # the output frame (bytearray), allocated on the first frame and reused
+        "batch",          # the frames waiting to be published as one (when coalescing), reused
+    )
+
+    def __init__(self, name, metadata, metadataTopic, dataTopic):
+        self.name = name
+        self.metadata = metadata
+        self.metadataTopic = metadataTopic
+        self.dataTopic = dataTopic
+        self.outBuffer = None
+        self.batch = None
+
+
+class StreamState:
+    """
+    The state of one stream, created from its metadata.
+    """
+    __slots__ = (
+        "key",            # the topic without data/metadata, as a tuple of the subtopics
+        "nodeKey",        # the channel set of the sensor: the first levels of the key (its node), see cpsns_Assembler
+        "nSamples",       # Data.Samples, -1 if unknown or variable
+        "cType",          # Data.Type[0], 'f' or 'd'
+        "metadataIn",     # the metadata payload the stream was created from
+        "dtype",          # NumPy dtype of the samples
+        "outputs",        # the StreamOutput list, in the order of the results of the chain
+        "blockStates",    # the per-stream state of every block of the chain
+        "inBuffer",       # float64 working copy of the samples (preallocated if nSamples is known)
+        "poolBuffer",     # the same for the frames of another length, of their size class (cpsns_BufferPool)
+        "lastSeen",       # time.monotonic() of the last message
+        "nFrames",        # data frames received (metrics)
+        "nBytes",         # data bytes received (metrics)
+        "sequence",       # the SequenceTracker (cpsns_Sequence)
+        "skippedSteps",   # the time steps of its channel set processed without it (cpsns_Assembler), None if none
+    )
+
+    def __init__(self, key, nodeKey, nSamples, cType, outputs, blockStates):
+        self.key = key
+        self.nodeKey = nodeKey
+        self.nSamples = nSamples
+        self.cType = cType
+        self.dtype = np.dtype(cType)
+        self.outputs = outputs
+        self.blockStates = blockStates
+        self.inBuffer = np.empty(nSamples) if nSamples > 0 else None
+        self.poolBuffer = None
+        self.metadataIn = None
+        self.lastSeen = time.monotonic()
+        self.nFrames = 0
+        self.nBytes = 0
+        self.sequence = None
+        self.skippedSteps = None
+
+    def input_buffer(self, n, pool=None):
+        """
+        Returns a float64 buffer for n samples: the preallocated one if n is the expected size,
+        else the first n samples of a buffer of the size class of n (kept for the next frames)
+        from the BufferPool pool (a new array without a pool).
+        """
+        if self.inBuffer is not None and len(self.inBuffer) == n:
+            return self.inBuffer
+        if pool is None:
+            return np.empty(n)
+        self.poolBuffer = pool.fit_array(self.poolBuffer, n)
+        return self.poolBuffer[:n]
+
+    def nbytes(self):
+        """
+        Approximate number of bytes held by the stream (metadata, buffers and block states).
+        """
+        return sizeof(self)
+
+
+class StreamRegistry:
+    """
+    The streams by their key (the topic without data/metadata, as a tuple), bounded in time
+    (ttl) and in number (max_streams). The hot path only sets StreamState.lastSeen, the
+    eviction is done by add (over max_streams, least recently seen first) and sweep (idle
+    for longer than ttl).
+    """
+    def __init__(self, ttl=0, max_streams=0, on_evict=None):
+        """
+        Parameters:
+        ttl: Evict the streams idle for longer than that many seconds, 0 for never
+        max_streams: Max number of streams, 0 for unlimited
+        on_evict: Called as on_evict(stream) for every evicted stream
+        """
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.on_evict = on_evict
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.nEvicted = 0
+
+    def __contains__(self, key):
+        return key in self.streams
+
+    def __getitem__(self, key):
+        return self.streams[key]
+
+    def __len__(self):
+        return len(self.streams)
+
+    def get(self, key):
+        return self.streams.get(key)
+
+    def add(self, stream):
+        with self.lock:
+            self.streams[stream.key] = stream
+            if self.max_streams > 0 and len(self.streams) > self.max_streams:
+                # least recently seen first
+                victims = heapq.nsmallest(len(self.streams) - self.max_streams, self.streams.values(), key=lambda s: s.lastSeen)
+                self._evict(victims)
+
+    def remove(self, key):
+        """
+        Evicts the stream now (e.g. its metadata has changed).
+        """
+        with self.lock:
+            stream = self.streams.get(key)
+            if stream is not None:
+                self._evict([stream])
+
+    def sweep(self, now=None):
+        """
+        Evicts the streams idle for longer than ttl. Returns how many were evicted.
+        """
+        if self.ttl <= 0:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            victims = [stream for stream in self.streams.values() if now - stream.lastSeen > self.ttl]
+            self._evict(victims)
+        return len(victims)
+
+    def _evict(self, victims):
+        for stream in victims:
+            del self.streams[stream.key]
+            self.nEvicted += 1
+            if self.on_evict is not None:
+                self.on_evict(stream)
+
+    def memory_report(self):
+        """
+        Returns {topic: bytes held} for every stream.
+        """
+        with self.lock:
+            streams = list(self.streams.values())
+        return {'/'.join(stream.key): stream.nbytes() for stream in streams}
@@ -0,0 +1,242 @@
+"""
+Bounded, sharded work queue with a pool of worker threads.
+
+The MQTT network thread only puts the raw messages into the queue, the processing runs on the
+workers. Every item has a shard key (e.g. the topic key of the stream): all the items with the
+same key go to the same worker, so they are processed in order and the per-stream state needs
+no locking.
+
+A worker sleeps on a condition variable until items arrive, then takes all the pending items of
+its shard at once. The hand-off latency (from put to processing) is kept in a histogram.
+
+Overflow policies (when the shard of an item is full):
+    - "block": put waits until there is room (backpressure to the MQTT client)
+    - "drop-oldest": the oldest item of the shard is dropped
+    - "drop-newest": the new item is dropped
+"""
+import collections
+import math
+import sys
+import threading
+import time
+import traceback
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies (in s) with log-spaced bins, preallocated so that record is O(1).
+    """
+    def __init__(self, minLatency=1e-6, maxLatency=10.0, binsPerDecade=10):
+        self.minLatency = minLatency
+        self.binsPerDecade = binsPerDecade
+        self.nBins = int(math.ceil(math.log10(maxLatency / minLatency) * binsPerDecade)) + 1
+        self.counts = [0] * self.nBins
+        self.n = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        if latency <= self.minLatency:
+            iBin = 0
+        else:
+            iBin = min(self.nBins - 1, int(math.log10(latency / self.minLatency) * self.binsPerDecade) + 1)
+        self.counts[iBin] += 1
+        self.n += 1
+        self.sum += latency
+        if latency > self.max:
+            self.max = latency
+
+    def upper_edge(self, iBin):
+        return self.minLatency * 10 ** (iBin / self.binsPerDecade)
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.n += other.n
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q):
+        """
+        Returns the upper edge of the bin holding the q-th percentile (0 < q <= 100).
+        """
+        if self.n == 0:
+            return 0.0
+        threshold = q / 100.0 * self.n
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return min(self.upper_edge(i), self.max)
+        return self.max
+
+    def summary(self):
+        if self.n == 0:
+            return "n=0"
+        return (f"n={self.n} mean={1e3 * self.sum / self.n:.3f}ms p50={1e3 * self.percentile(50):.3f}ms "
+                f"p90={1e3 * self.percentile(90):.3f}ms p99={1e3 * self.percentile(99):.3f}ms max={1e3 * self.max:.3f}ms")
+
+
+class ShardedWorkQueue:
+    def __init__(self, handler, nWorkers=1, maxsize=1000, policy="block", idle=None, idle_interval=None):
+        """
+        Parameters:
+        handler: Called as handler(item, iShard) on the worker of the shard
+        nWorkers: The number of worker threads (= the number of shards)
+        maxsize: The capacity of each shard
+        policy: The overflow policy, one of OVERFLOW_POLICIES
+        idle: If given, called as idle(iShard) on the worker at least every idle_interval seconds
+        idle_interval: See idle (in s)
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}, use one of {OVERFLOW_POLICIES}")
+        if nWorkers < 1 or maxsize < 1:
+            raise ValueError("nWorkers and maxsize must be at least 1")
+        self.handler = handler
+        self.nWorkers = nWorkers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.idle = idle
+        self.idle_interval = idle_interval
+        self.shards = [collections.deque() for _ in range(nWorkers)]
+        self.locks = [threading.Lock() for _ in range(nWorkers)]
+        self.notEmpty = [threading.Condition(lock) for lock in self.locks]
+        self.notFull = [threading.Condition(lock) for lock in self.locks]
+        self.threads = []
+        self.bRunning = False
+        # Counters, per shard (each one is only updated under the shard lock or by the shard worker)
+        self.nEnqueued = [0] * nWorkers
+        self.nProcessed = [0] * nWorkers
+        self.nDroppedOldest = [0] * nWorkers
+        self.nDroppedNewest = [0] * nWorkers
+        self.nBlocked = [0] * nWorkers   # how many times put had to wait for room
+        self.nErrors = [0] * nWorkers    # exceptions raised by the handler
+        self.maxDepth = [0] * nWorkers   # the highest depth seen
+        self.nBatches = [0] * nWorkers   # how many times a worker drained its shard
+        # Time from put to the start of the processing (the hand-off latency)
+        self.latency = [LatencyHistogram() for _ in range(nWorkers)]
+
+    def shard_of(self, key):
+        return hash(key) % self.nWorkers
+
+    def put(self, key, item):
+        """
+        Puts the item into the shard of the key. Returns False if an item was dropped
+        (the new one or the oldest one), True otherwise.
+        """
+        iShard = self.shard_of(key)
+        shard = self.shards[iShard]
+        with self.locks[iShard]:
+            bDropped = False
+            if len(shard) >= self.maxsize:
+                if self.policy == "drop-newest":
+                    self.nDroppedNewest[iShard] += 1
+                    return False
+                elif self.policy == "drop-oldest":
+                    shard.popleft()
+                    self.nDroppedOldest[iShard] += 1
+                    bDropped = True
+                else:
+                    self.nBlocked[iShard] += 1
+                    while len(shard) >= self.maxsize and self.bRunning:
+                        self.notFull[iShard].wait()
+            shard.append((time.perf_counter(), item))
+            self.nEnqueued[iShard] += 1
+            if len(shard) > self.maxDepth[iShard]:
+                self.maxDepth[iShard] = len(shard)
+            self.notEmpty[iShard].notify()
+            return not bDropped
+
+    def depth(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def stats(self):
+        return {
+            "workers": self.nWorkers,
+            "depth": self.depth(),
+            "max_depth": max(self.maxDepth),
+            "enqueued": sum(self.nEnqueued),
+            "processed": sum(self.nProcessed),
+            "dropped_oldest": sum(self.nDroppedOldest),
+            "dropped_newest": sum(self.nDroppedNewest),
+            "blocked": sum(self.nBlocked),
+            "errors": sum(self.nErrors),
+            "mean_batch": sum(self.nProcessed) / max(1, sum(self.nBatches)),
+        }
+
+    def latency_histogram(self):
+        """
+        Returns the hand-off latency histogram of all the shards.
+        """
+        histogram = LatencyHistogram()
+        for shardHistogram in self.latency:
+            histogram.merge(shardHistogram)
+        return histogram
+
+    def run_worker(self, iShard):
+        """
+        The worker loop of a shard: sleeps until items arrive, then drains and processes all the
+        pending items at once. start() runs it on threads; call it directly to run a shard on the
+        current (e.g. the main) thread. Returns after stop(), once the shard is empty.
+        """
+        shard = self.shards[iShard]
+        notEmpty = self.notEmpty[iShard]
+        notFull = self.notFull[iShard]
+        latency = self.latency[iShard]
+        lastIdle = time.monotonic()
+        while True:
+            with notEmpty:
+                while not shard and self.bRunning:
+                    if self.idle is None:
+                        notEmpty.wait()
+                    elif not notEmpty.wait(max(0.0, self.idle_interval - (time.monotonic() - lastIdle))):
+                        break
+                if not shard and not self.bRunning:
+                    return
+                # Take everything that is pending
+                items = list(shard)
+                shard.clear()
+                notFull.notify_all()
+            if items:
+                self.nBatches[iShard] += 1
+                now = time.perf_counter()
+                for tEnqueued, item in items:
+                    latency.record(now - tEnqueued)
+                    try:
+                        self.handler(item, iShard)
+                    except Exception:
+                        self.nErrors[iShard] += 1
+                        traceback.print_exc(file=sys.stderr)
+                    self.nProcessed[iShard] += 1
+            if self.idle is not None and time.monotonic() - lastIdle >= self.idle_interval:
+                lastIdle = time.monotonic()
+                try:
+                    self.idle(iShard)
+                except Exception:
+                    self.nErrors[iShard] += 1
+                    traceback.print_exc(file=sys.stderr)
+
+    def start(self, bMainThreadWorker=False):
+        """
+        Starts the worker threads. With bMainThreadWorker, shard 0 gets no thread: the caller
+        runs it with run_worker(0).
+        """
+        self.bRunning = True
+        self.threads = [threading.Thread(target=self.run_worker, args=(i,), name=f"worker-{i}", daemon=True) for i in range(1 if bMainThreadWorker else 0, self.nWorkers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the workers after they have processed the queued items.
+        """
+        self.bRunning = False
+        for i in range(self.nWorkers):
+            with self.locks[i]:
+                self.notEmpty[i].notify_all()
+                self.notFull[i].notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
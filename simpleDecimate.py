@@ -0,0 +1,178 @@
+"""
+Streaming (real-time) decimation: polyphase anti-alias FIR filtering run block by block, for
+integer (e.g. 10) and rational (e.g. 5/2: up 2, down 5) factors.
+
+The anti-alias filter is the one of scipy.signal.resample_poly (a Kaiser windowed sinc, cut-off
+at the lower of the two Nyquist frequencies), split into its up polyphase sub-filters and cached
+by (up, down, dtype). Only the output samples are computed: output k is the sub-filter of its
+phase applied to the input samples before it. The state between the blocks is the last inputs
+(the length of a sub-filter - 1) and where the next output falls relative to the next input.
+
+The output samples sit at fixed positions of the input: output k at input sample k*down/up
+(counted from the DAQ start if the frames say where they start), so the output of consecutive
+frames is continuous and a restarted service produces the same samples. The filter is causal:
+the output is delayed by half the filter length (delay()).
+
+A (channels x samples) block of the streams in the same phase is decimated with one matrix
+product per phase, in float32 or float64 (the type of the stream).
+"""
+import functools
+from fractions import Fraction
+import numpy as np
+import scipy.signal
+
+HALF_LENGTH_FACTOR = 10   # the filter is 2 * 10 * max(up, down) + 1 taps long (as resample_poly)
+KAISER_BETA = 5.0
+
+
+def parse_factor(factor):
+    """
+    Returns (up, down) of a decimation factor: an int, a Fraction or a string like "10", "5/2" or "2.5".
+    """
+    factor = Fraction(factor)
+    if factor <= 1:
+        raise ValueError(f"The decimation factor must be greater than 1, got {factor}")
+    return factor.denominator, factor.numerator
+
+
+@functools.lru_cache(maxsize=None)
+def design_polyphase(up, down, dtype="d"):
+    """
+    Returns the polyphase anti-alias filter: an (up, taps per phase) array (shared by the
+    callers), every row reversed (the newest input last), so that output = window @ row.
+
+    Parameters:
+    up, down: The resampling factors (without a common divisor)
+    dtype: 'f' or 'd'
+    """
+    halfLength = HALF_LENGTH_FACTOR * max(up, down)
+    h = scipy.signal.firwin(2 * halfLength + 1, 1.0 / max(up, down), window=('kaiser', KAISER_BETA)) * up
+    nTaps = -(-len(h) // up)
+    h = np.concatenate((h, np.zeros(nTaps * up - len(h))))
+    # phase p: h[p], h[p + up], h[p + 2 up]... applied to x[i], x[i - 1], x[i - 2]...
+    phases = np.ascontiguousarray(h.reshape(nTaps, up).T[:, ::-1]).astype(dtype)
+    phases.flags.writeable = False
+    return phases
+
+
+class RealTimeDecimator:
+    def __init__(self, factor, dtype=np.float64):
+        """
+        Parameters:
+        factor: The decimation factor (input rate / output rate), see parse_factor
+        dtype: The type the filtering is done in, float32 or float64
+        """
+        self.up, self.down = parse_factor(factor)
+        self.dtype = np.dtype(dtype)
+        self.phases = design_polyphase(self.up, self.down, self.dtype.char)
+        self.history = None   # the last (taps per phase - 1) inputs, None before the first block
+        self.offset = 0       # (up * input) position of the next output - that of the next input
+        self.nextIn = None    # nSamplesFromDAQStart of the next input, None if unknown
+        self.nextOut = 0      # and of the next output
+
+    def delay(self, Fs):
+        """
+        Returns the delay of the output (in s) for the input sampling frequency Fs.
+        """
+        return HALF_LENGTH_FACTOR * max(self.up, self.down) / (Fs * self.up)
+
+    def output_sample(self, nSample):
+        """
+        Returns nSamplesFromDAQStart (of the output) of the first output of the frame starting
+        at the input sample nSample. The first frame and the frame after a gap (not filled)
+        place the outputs on the fixed positions.
+        """
+        if nSample != self.nextIn:
+            self.nextOut = -(-nSample * self.up // self.down)
+            self.offset = self.nextOut * self.down - nSample * self.up
+            self.nextIn = nSample
+        return self.nextOut
+
+    def count(self, nSamples):
+        # The number of the outputs of the next nSamples inputs
+        return max(0, -(-(nSamples * self.up - self.offset) // self.down))
+
+    def apply_filter(self, data):
+        """
+        Decimates the block and returns the output samples (in self.dtype).
+        """
+        return apply_filter_batch([self], [data])[0]
+
+    def get_state(self):
+        """
+        Returns the state as a dict of NumPy arrays (for the checkpoints), empty before the first block.
+        """
+        if self.history is None:
+            return {}
+        return {"history": self.history, "position": np.array([self.offset, -1 if self.nextIn is None else self.nextIn, self.nextOut], dtype=np.int64)}
+
+    def set_state(self, arrays):
+        """
+        Restores a state returned by get_state. Returns False (and keeps the state) if it does
+        not fit the decimator (e.g. it was saved with another factor).
+        """
+        history = arrays.get("history")
+        if history is None:
+            return True
+        if history.shape != (self.phases.shape[1] - 1,):
+            return False
+        offset, nextIn, nextOut = (int(n) for n in arrays["position"])
+        self.history = np.array(history, dtype=self.dtype)
+        self.offset = offset
+        self.nextIn = None if nextIn < 0 else nextIn
+        self.nextOut = nextOut
+        return True
+
+
+def apply_filter_batch(decimators, datas):
+    """
+    Decimates one frame per decimator, the frames of the same length, factor and phase in one
+    vectorized call. Every decimator is for a single channel.
+
+    Parameters:
+    decimators: The RealTimeDecimator of every frame
+    datas: The frames (1D arrays)
+
+    Returns:
+    The list of the output frames
+    """
+    # The decimators sharing a design have the same (cached) phases object
+    groups = {}
+    for i, (decimator, data) in enumerate(zip(decimators, datas)):
+        groups.setdefault((id(decimator.phases), decimator.offset, len(data)), []).append(i)
+    results = [None] * len(datas)
+    for indices in groups.values():
+        first = decimators[indices[0]]
+        nSamples = len(datas[indices[0]])
+        phases = first.phases
+        nHistory = phases.shape[1] - 1
+        up, down, offset = first.up, first.down, first.offset
+        nOut = first.count(nSamples)
+        if nSamples == 0:
+            for i in indices:
+                results[i] = np.empty(0, dtype=first.dtype)
+            continue
+        # The history followed by the frame, per channel
+        block = np.empty((len(indices), nHistory + nSamples), dtype=first.dtype)
+        for j, i in enumerate(indices):
+            block[j, nHistory:] = datas[i]
+            history = decimators[i].history
+            # Start as if the first sample had been there forever
+            block[j, :nHistory] = history if history is not None else block[j, nHistory]
+        # windows[:, i] ends with the input sample i of the frame
+        windows = np.lib.stride_tricks.sliding_window_view(block, nHistory + 1, axis=-1)
+        out = np.empty((len(indices), nOut), dtype=first.dtype)
+        # The outputs r, r + up, r + 2 up... have the same phase and are down inputs apart
+        for r in range(min(up, nOut)):
+            position = offset + r * down
+            start = position // up
+            out[:, r::up] = windows[:, start::down][:, :len(range(r, nOut, up))] @ phases[position % up]
+        for j, i in enumerate(indices):
+            decimator = decimators[i]
+            decimator.history = block[j, nSamples:].copy()
+            decimator.offset = offset + nOut * down - nSamples * up
+            decimator.nextOut += nOut
+            if decimator.nextIn is not None:
+                decimator.nextIn += nSamples
+            results[i] = out[j]
+    return results
@@ -0,0 +1,149 @@
+"""
+Streaming (real-time) detrending: removes a running mean from a stream of data blocks.
+
+The whole block is processed with a few vectorized NumPy calls (cumulative sums with
+arange-based divisors), the state between the blocks is the number of samples seen so
+far (K) and the current mean. The mean is carried as a compensated (Kahan) pair, so it
+stays accurate when K reaches billions of samples.
+
+Modes:
+    - "cumulative": the mean of all the samples seen so far (the classic running mean)
+    - "exponential": exponentially weighted mean, x_mean += alpha*(x - x_mean)
+    - "window": the mean of the last `window` samples
+"""
+import numpy as np
+import scipy.signal
+
+MODES = ("cumulative", "exponential", "window")
+
+
+class RealTimeDetrender:
+    def __init__(self, mode="cumulative", alpha=None, window=None):
+        """
+        Parameters:
+        mode: "cumulative", "exponential" or "window"
+        alpha: The smoothing factor (0 < alpha <= 1) for the "exponential" mode
+        window: The number of samples averaged in the "window" mode
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, use one of {MODES}")
+        if mode == "exponential" and not (alpha is not None and 0 < alpha <= 1):
+            raise ValueError("The exponential mode needs 0 < alpha <= 1")
+        if mode == "window" and not (window is not None and window >= 1):
+            raise ValueError("The window mode needs window >= 1")
+        self.mode = mode
+        self.alpha = alpha
+        self.window = int(window) if window is not None else None
+        self.K = 0            # number of samples seen so far
+        self.xMean = 0.0      # the running mean...
+        self.xMeanComp = 0.0  # ...and its compensation term (the low-order bits)
+        self.history = np.empty(0)  # "window" mode: the last window-1 samples
+
+    @property
+    def mean(self):
+        return self.xMean + self.xMeanComp
+
+    def _add_to_mean(self, delta):
+        # Kahan summation: xMean + xMeanComp += delta
+        y = delta - self.xMeanComp
+        t = self.xMean + y
+        self.xMeanComp = (t - self.xMean) - y
+        self.xMean = t
+
+    def running_mean(self, data):
+        """
+        Returns the running mean at every sample of the block (the sample itself included)
+        and advances the state.
+        """
+        data = np.asarray(data, dtype=float)
+        n = len(data)
+        if n == 0:
+            return np.empty(0)
+        if self.mode == "cumulative":
+            return self._cumulative_mean(data)
+        elif self.mode == "exponential":
+            return self._exponential_mean(data)
+        else:
+            return self._window_mean(data)
+
+    def _cumulative_mean(self, data):
+        if self.K == 0:
+            # Very first time: start from the first sample
+            self.xMean = data[0]
+            self.xMeanComp = 0.0
+            self.K = 1
+            return np.concatenate(([data[0]], self._cumulative_mean(data[1:]) if len(data) > 1 else []))
+        n = len(data)
+        # mean_j = mean_0 + sum_{i<=j}(x_i - mean_0) / (K + j): the deviations are small,
+        # so their cumulative sum does not lose precision even for huge K
+        deviations = (data - self.xMean) - self.xMeanComp
+        divisors = np.arange(self.K + 1, self.K + n + 1, dtype=float)
+        increments = np.cumsum(deviations) / divisors
+        xMean = self.mean + increments
+        self._add_to_mean(increments[-1])
+        self.K += n
+        return xMean
+
+    def _exponential_mean(self, data):
+        n = len(data)
+        if self.K == 0:
+            self.xMean = data[0]
+            self.xMeanComp = 0.0
+        alpha = self.alpha
+        # x_mean_j = (1-alpha)*x_mean_{j-1} + alpha*x_j, as a first-order IIR filter,
+        # run on the deviations from the carried mean
+        mean0 = self.mean
+        increments, _ = scipy.signal.lfilter([alpha], [1.0, alpha - 1.0], data - mean0, zi=[0.0])
+        self._add_to_mean(increments[-1])
+        self.K += n
+        return mean0 + increments
+
+    def _window_mean(self, data):
+        n = len(data)
+        window = self.window
+        extended = np.concatenate((self.history, data))
+        # Cumulative sum relative to a reference value keeps the sums small
+        reference = extended[0]
+        cumsum = np.concatenate(([0.0], np.cumsum(extended - reference)))
+        nHistory = len(self.history)
+        ends = np.arange(nHistory + 1, nHistory + n + 1)
+        starts = np.maximum(ends - window, 0)
+        xMean = reference + (cumsum[ends] - cumsum[starts]) / (ends - starts)
+        self.history = extended[-(window - 1):] if window > 1 else np.empty(0)
+        self.xMean = xMean[-1]
+        self.xMeanComp = 0.0
+        self.K += n
+        return xMean
+
+    def get_state(self):
+        """
+        Returns the state as a dict of NumPy arrays (for the checkpoints).
+        """
+        return {"mode": np.array(MODES.index(self.mode)), "K": np.array(self.K, dtype=np.int64),
+                "mean": np.array([self.xMean, self.xMeanComp]), "history": self.history}
+
+    def set_state(self, arrays):
+        """
+        Restores a state returned by get_state. Returns False (and keeps the state) if it was
+        saved with another mode or window.
+        """
+        if int(arrays["mode"]) != MODES.index(self.mode):
+            return False
+        if self.mode == "window" and len(arrays["history"]) > self.window - 1:
+            return False
+        self.K = int(arrays["K"])
+        self.xMean, self.xMeanComp = (float(x) for x in arrays["mean"])
+        self.history = np.array(arrays["history"], dtype=float)
+        return True
+
+    def apply_filter(self, data):
+        """
+        Removes the running mean from the block and returns the detrended data (float64).
+        """
+        bFirst = self.K == 0
+        data = np.asarray(data, dtype=float)
+        detrended = data - self.running_mean(data)
+        if bFirst and self.mode == "cumulative" and len(data) > 0:
+            # The very first sample is passed through, as in the original per-sample loop
+            detrended[0] = data[0]
+        return detrended
@@ -0,0 +1,140 @@
+"""
+Streaming (real-time) high-pass filtering: a Butterworth filter run block by block.
+
+The filter is designed once as second-order sections (numerically safe for high orders and
+low cut-offs) and cached by (Fs, cutoff, order): all the channels with the same sampling
+share the one coefficient array. The state between the blocks is the zi of the
+sections. A (channels x samples) block is filtered with one sosfilt call. The coefficients, the
+state and the filtering are always float64 (in float32 a low cut-off, e.g. 0.1 Hz at 5 kHz, is
+off by percents): only the output is in the type of the stream (float32 or float64).
+"""
+import functools
+import numpy as np
+import scipy.signal
+
+
+@functools.lru_cache(maxsize=None)
+def design_sos(Fs, cutoff, order):
+    """
+    Returns the Butterworth high-pass filter as second-order sections (shared by the callers) and
+    the zi of its step response (the state of the filter after a long constant input of 1).
+
+    Parameters:
+    Fs: The sampling frequency (in Hz)
+    cutoff: The cut-off frequency (in Hz), below Fs/2
+    order: The order of the filter
+    """
+    if not 0 < cutoff < Fs / 2:
+        raise ValueError(f"The cut-off frequency must be between 0 and Fs/2 = {Fs / 2} Hz, got {cutoff}")
+    if order < 1:
+        raise ValueError("The order of the filter must be at least 1")
+    sos = scipy.signal.butter(order, cutoff, btype="highpass", output="sos", fs=Fs)
+    zi_step = scipy.signal.sosfilt_zi(sos)
+    # (sosfilt needs a writeable sos, so it is not locked - do not modify it)
+    zi_step.flags.writeable = False
+    return sos, zi_step
+
+
+class RealTimeHighPassFilter:
+    def __init__(self, cutoff, Fs, order, dtype=np.float64):
+        """
+        Parameters:
+        cutoff: The cut-off frequency (in Hz)
+        Fs: The sampling frequency (in Hz)
+        order: The order of the Butterworth filter
+        dtype: The type of the output, float32 or float64 (the filtering is done in float64)
+        """
+        self.dtype = np.dtype(dtype)
+        self.sos, self.zi_step = design_sos(float(Fs), float(cutoff), int(order))
+        self.zi = None  # (sections, 2) for one channel, (sections, channels, 2) for a block
+
+    def initial_zi(self, data):
+        # Start as if the first sample had been there forever: no step response from the offset
+        x0 = data[..., 0]
+        return self.zi_step.reshape((len(self.sos),) + (1,) * np.ndim(x0) + (2,)) * x0[..., None]
+
+    def apply_filter(self, data):
+        """
+        Filters the block and returns the filtered data (in self.dtype).
+
+        Parameters:
+        data: The samples, 1D, or 2D (channels x samples) for several channels of the same stream
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.shape[-1] == 0:
+            return data.astype(self.dtype)
+        if self.zi is None:
+            self.zi = self.initial_zi(data)
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, data, axis=-1, zi=self.zi)
+        return filtered.astype(self.dtype, copy=False)
+
+    def get_state(self):
+        """
+        Returns the state as a dict of NumPy arrays (for the checkpoints), empty before the first block.
+        """
+        return {} if self.zi is None else {"zi": self.zi}
+
+    def set_state(self, arrays):
+        """
+        Restores a state returned by get_state. Returns False (and keeps the state) if it does
+        not fit the filter (e.g. it was saved with another order).
+        """
+        zi = arrays.get("zi")
+        if zi is None:
+            return True
+        if zi.shape[0] != len(self.sos) or zi.shape[-1] != 2:
+            return False
+        self.zi = np.array(zi, dtype=np.float64)
+        return True
+
+
+def apply_filter_batch(filters, datas):
+    """
+    Filters one frame per filter, the frames of the same length and the same design in one
+    vectorized call. Every filter is for a single channel.
+
+    Parameters:
+    filters: The RealTimeHighPassFilter of every frame
+    datas: The frames (1D arrays)
+
+    Returns:
+    The list of the filtered frames
+    """
+    # The filters sharing a design have the same (cached) sos object
+    groups = {}
+    for i, (filter, data) in enumerate(zip(filters, datas)):
+        groups.setdefault((id(filter.sos), filter.dtype, len(data)), []).append(i)
+    results = [None] * len(datas)
+    for indices in groups.values():
+        if len(indices) == 1 or len(datas[indices[0]]) == 0:
+            for i in indices:
+                results[i] = filters[i].apply_filter(datas[i])
+            continue
+        block = np.empty((len(indices), len(datas[indices[0]])), dtype=np.float64)
+        for j, i in enumerate(indices):
+            block[j] = datas[i]
+        filtered = apply_filter_block([filters[i] for i in indices], block)
+        for j, i in enumerate(indices):
+            results[i] = filtered[j]
+    return results
+
+
+def apply_filter_block(filters, block):
+    """
+    Filters a (channels x samples) block, one filter per row, all of the same design (the same
+    sos) and output type, in one sosfilt call.
+
+    Returns:
+    The (channels x samples) filtered block (in the type of the filters)
+    """
+    first = filters[0]
+    block = np.asarray(block, dtype=np.float64)
+    if block.shape[-1] == 0:
+        return block.astype(first.dtype)
+    zi = np.empty((len(first.sos), len(filters), 2))
+    for j, filter in enumerate(filters):
+        zi[:, j] = filter.zi if filter.zi is not None else filter.initial_zi(block[j])
+    filtered, zi = scipy.signal.sosfilt(first.sos, block, axis=-1, zi=zi)
+    for j, filter in enumerate(filters):
+        filter.zi = zi[:, j]
+    return filtered.astype(first.dtype, copy=False)
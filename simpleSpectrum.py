@@ -0,0 +1,207 @@
+"""
+Streaming (real-time) spectral analysis: Welch power spectra of the recent samples, updated
+block by block.
+
+The samples are cut into segments of nperseg samples, step = nperseg - overlap apart (the same
+as scipy.signal.welch). Every segment is transformed once, when its last sample comes: the mean
+is removed, the window applied and the periodogram (one-sided, scaled as density or spectrum)
+kept in a ring of the last nAverages periodograms. Every hop segments the mean of the ring is
+the Welch spectrum of the last nperseg + (nAverages - 1) * step samples. The stream starts as if
+its first sample had been there forever (constant, so nothing after the mean is removed) and the
+first spectra average the periodograms there are so far.
+
+The segments and the spectra sit at fixed positions of the input: segment k ends at input
+sample k*step and spectrum i is that of segment i*hop (counted from the DAQ start if the frames
+say where they start), so a restarted service produces the same spectra.
+
+The window and the scaling are cached by (nperseg, window, Fs, scaling, dtype) and shared by
+the channels; the FFT plans are cached by scipy.fft. The segments of a (channels x samples)
+block of the streams in the same phase are transformed with one rfft call.
+"""
+import functools
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+SCALINGS = ("density", "spectrum")
+
+
+@functools.lru_cache(maxsize=None)
+def design_window(nperseg, window, Fs, scaling="density", dtype="d"):
+    """
+    Returns the window (nperseg samples) and the scale of every frequency bin (the one-sided
+    periodogram is scale * |rfft(window * segment)|^2), shared by the callers.
+
+    Parameters:
+    nperseg: The segment length (samples)
+    window: The name of the window, see scipy.signal.get_window
+    Fs: The sampling frequency (in Hz)
+    scaling: "density" (unit^2/Hz) or "spectrum" (unit^2)
+    dtype: 'f' or 'd'
+    """
+    if scaling not in SCALINGS:
+        raise ValueError(f"Unknown scaling {scaling}, use one of {SCALINGS}")
+    w = scipy.signal.get_window(window, nperseg)
+    scale = np.full(nperseg // 2 + 1, 1.0 / (Fs * np.sum(w ** 2)) if scaling == "density" else 1.0 / np.sum(w) ** 2)
+    # one-sided: the negative frequencies are folded (not DC, nor Nyquist for even nperseg)
+    scale[1:(nperseg + 1) // 2] *= 2
+    w = w.astype(dtype)
+    scale = scale.astype(dtype)
+    w.flags.writeable = False
+    scale.flags.writeable = False
+    return w, scale
+
+
+class RealTimeSpectrum:
+    def __init__(self, Fs, nperseg, noverlap, nAverages, hop, window="hann", scaling="density", dtype=np.float64):
+        """
+        Parameters:
+        Fs: The sampling frequency (in Hz)
+        nperseg: The segment length (samples)
+        noverlap: The overlap of the segments (samples), below nperseg
+        nAverages: The number of the segments averaged
+        hop: A spectrum every that many segments
+        window: The name of the window, see scipy.signal.get_window
+        scaling: "density" or "spectrum"
+        dtype: The type the FFTs are done in, float32 or float64
+        """
+        if not 0 <= noverlap < nperseg:
+            raise ValueError(f"The overlap must be between 0 and the segment length ({nperseg}), got {noverlap}")
+        if nAverages < 1 or hop < 1:
+            raise ValueError("The number of averages and the hop must be at least 1")
+        self.dtype = np.dtype(dtype)
+        self.nperseg = nperseg
+        self.step = nperseg - noverlap
+        self.nAverages = nAverages
+        self.hop = hop
+        self.window, self.scale = design_window(nperseg, window, float(Fs), scaling, self.dtype.char)
+        self.tail = np.zeros(nperseg, dtype=self.dtype)            # the last nperseg samples
+        self.nSeen = 0                                              # samples seen (up to nperseg)
+        self.periodograms = np.zeros((nAverages, self.nbins()), dtype=self.dtype)  # ring
+        self.nPeriodograms = 0                                      # in the ring (up to nAverages)
+        self.untilSegment = self.step  # samples until the end of the next segment (1..step)
+        self.nextSegment = 1           # the index of the next segment
+        self.nextIn = None             # nSamplesFromDAQStart of the next input, None if unknown
+
+    def nbins(self):
+        return self.nperseg // 2 + 1
+
+    def frequencies(self, Fs):
+        return scipy.fft.rfftfreq(self.nperseg, 1.0 / Fs)
+
+    def output_sample(self, nSample):
+        """
+        Returns the index of the next spectrum * nbins (the output is counted in values) for the
+        frame starting at the input sample nSample. The first frame and the frame after a gap
+        (not filled) place the segments on the fixed positions.
+        """
+        if nSample != self.nextIn:
+            self.nextSegment = nSample // self.step + 1
+            self.untilSegment = self.nextSegment * self.step - nSample
+            self.nextIn = nSample
+        return -(-self.nextSegment // self.hop) * self.nbins()
+
+    def apply_filter(self, data):
+        """
+        Takes the block and returns the spectra completed by it, one after the other (in self.dtype).
+        """
+        return apply_filter_batch([self], [data])[0]
+
+    def add_periodogram(self, periodogram):
+        # Returns the spectrum if one is due with this segment, else None
+        self.periodograms[self.nextSegment % self.nAverages] = periodogram
+        self.nPeriodograms = min(self.nPeriodograms + 1, self.nAverages)
+        bDue = self.nextSegment % self.hop == 0
+        self.nextSegment += 1
+        # (the ring is zero where there is no periodogram yet)
+        return np.sum(self.periodograms, axis=0) / self.nPeriodograms if bDue else None
+
+    def get_state(self):
+        """
+        Returns the state as a dict of NumPy arrays (for the checkpoints), empty before the first block.
+        """
+        if self.nSeen == 0:
+            return {}
+        return {"tail": self.tail, "periodograms": self.periodograms,
+                "position": np.array([self.nSeen, self.nPeriodograms, self.untilSegment, self.nextSegment,
+                                      -1 if self.nextIn is None else self.nextIn], dtype=np.int64)}
+
+    def set_state(self, arrays):
+        """
+        Restores a state returned by get_state. Returns False (and keeps the state) if it does
+        not fit (e.g. it was saved with another segment length).
+        """
+        if "tail" not in arrays:
+            return True
+        if arrays["tail"].shape != self.tail.shape or arrays["periodograms"].shape != self.periodograms.shape:
+            return False
+        nSeen, nPeriodograms, untilSegment, nextSegment, nextIn = (int(n) for n in arrays["position"])
+        if not 1 <= untilSegment <= self.step:
+            return False
+        self.tail = np.array(arrays["tail"], dtype=self.dtype)
+        self.periodograms = np.array(arrays["periodograms"], dtype=self.dtype)
+        self.nSeen = nSeen
+        self.nPeriodograms = nPeriodograms
+        self.untilSegment = untilSegment
+        self.nextSegment = nextSegment
+        self.nextIn = None if nextIn < 0 else nextIn
+        return True
+
+
+def apply_filter_batch(spectra, datas):
+    """
+    Takes one frame per RealTimeSpectrum, the segments of the frames of the same length, design
+    and phase transformed in one vectorized call. Every RealTimeSpectrum is for a single channel.
+
+    Parameters:
+    spectra: The RealTimeSpectrum of every frame
+    datas: The frames (1D arrays)
+
+    Returns:
+    The list of the outputs: the spectra completed by the frames, one after the other (possibly empty)
+    """
+    # The spectra sharing a design have the same (cached) window object
+    groups = {}
+    for i, (spectrum, data) in enumerate(zip(spectra, datas)):
+        groups.setdefault((id(spectrum.window), id(spectrum.scale), spectrum.step, spectrum.untilSegment, len(data)), []).append(i)
+    results = [None] * len(datas)
+    for indices in groups.values():
+        first = spectra[indices[0]]
+        nSamples = len(datas[indices[0]])
+        nperseg, step, untilSegment = first.nperseg, first.step, first.untilSegment
+        # The segments ending in the frame
+        nSegments = 0 if nSamples < untilSegment else (nSamples - untilSegment) // step + 1
+        periodograms = None
+        if nSegments > 0:
+            # The last nperseg samples followed by the frame, per channel
+            block = np.empty((len(indices), nperseg + nSamples), dtype=first.dtype)
+            for j, i in enumerate(indices):
+                block[j, nperseg:] = datas[i]
+                # Start as if the first sample had been there forever
+                block[j, :nperseg] = spectra[i].tail if spectra[i].nSeen > 0 else block[j, nperseg]
+            # segments[:, k] ends with the input sample untilSegment + k * step (exclusive) of the frame
+            segments = np.lib.stride_tricks.sliding_window_view(block, nperseg, axis=-1)[:, untilSegment::step][:, :nSegments]
+            segments = (segments - segments.mean(axis=-1, keepdims=True)) * first.window
+            spectrum = scipy.fft.rfft(segments, axis=-1)
+            periodograms = (spectrum.real ** 2 + spectrum.imag ** 2) * first.scale
+        for j, i in enumerate(indices):
+            state = spectra[i]
+            outputs = []
+            for k in range(nSegments):
+                output = state.add_periodogram(periodograms[j, k])
+                if output is not None:
+                    outputs.append(output)
+            if nSamples > 0:
+                if state.nSeen == 0:
+                    state.tail[:] = datas[i][0]
+                if nSamples >= nperseg:
+                    state.tail[:] = datas[i][nSamples - nperseg:]
+                else:
+                    state.tail[:nperseg - nSamples] = state.tail[nSamples:]
+                    state.tail[nperseg - nSamples:] = datas[i]
+            state.nSeen = min(state.nSeen + nSamples, nperseg)
+            state.untilSegment = untilSegment + nSegments * step - nSamples
+            if state.nextIn is not None:
+                state.nextIn += nSamples
+            results[i] = np.concatenate(outputs) if outputs else np.empty(0, dtype=state.dtype)
+    return results
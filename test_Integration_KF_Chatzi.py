@@ -0,0 +1,66 @@
+"""
+Regression tests of the Kalman integration: the steady-state and the batched versions against
+the original per-sample recursion (Integration_KF_Chatzi).
+"""
+import numpy as np
+import Integration_KF_Chatzi as kf
+
+TS = 1e-3
+Q = 1.e-6
+R = 1.e-10
+
+
+def run_frames(integrate, a, nFrame, **kwargs):
+    # Frame by frame, each frame starting from the last estimate of the one before (as the blocks do)
+    d0, v0, P = 0.0, 0.0, np.eye(2)
+    ds, vs = [], []
+    for start in range(0, len(a), nFrame):
+        d, v, P = integrate(a[start:start + nFrame], TS, Q, R, d0, v0, P, **kwargs)
+        d0, v0 = d[-1], v[-1]
+        ds.append(d)
+        vs.append(v)
+    return np.concatenate(ds), np.concatenate(vs), P
+
+
+def test_steady_state_matches_reference():
+    a = np.random.default_rng(0).standard_normal(20000)
+    for nFrame in (20000, 1000, 100):
+        dRef, vRef, PRef = run_frames(kf.Integration_KF_Chatzi, a, nFrame)
+        d, v, P = run_frames(kf.Integration_KF_SteadyState, a, nFrame)
+        assert np.abs(d - dRef).max() <= 1e-9 * np.abs(dRef).max()
+        assert np.abs(v - vRef).max() <= 1e-9 * np.abs(vRef).max()
+        assert np.allclose(P, PRef, rtol=1e-6)
+
+
+def test_steady_state_short_frames():
+    # Frames shorter than the convergence of P: the exact recursion carries over the frames
+    a = np.random.default_rng(1).standard_normal(600)
+    dRef, _, PRef = run_frames(kf.Integration_KF_Chatzi, a, 3)
+    d, _, P = run_frames(kf.Integration_KF_SteadyState, a, 3)
+    assert np.abs(d - dRef).max() <= 1e-9 * np.abs(dRef).max()
+    assert np.allclose(P, PRef, rtol=1e-6)
+
+
+def test_batch_matches_per_channel():
+    rng = np.random.default_rng(2)
+    nChannels = 6
+    a = rng.standard_normal((nChannels, 3000))
+    Qs = np.array([Q, Q, 1e-5, 1e-5, Q, 1e-7])
+    d0 = rng.standard_normal(nChannels) * 1e-3
+    v0 = rng.standard_normal(nChannels) * 1e-3
+    # Some channels converged already, some not
+    P0 = np.stack([np.eye(2) if i % 2 else kf.steady_state_filter(TS, float(Qs[i]), R)[0] for i in range(nChannels)])
+    d, v, P = kf.Integration_KF_Batch(a, TS, Qs, R, d0, v0, P0)
+    for i in range(nChannels):
+        dRef, vRef, PRef = kf.Integration_KF_SteadyState(a[i], TS, Qs[i], R, d0[i], v0[i], P0[i])
+        # (the two may switch to the steady state a sample apart: within rtol of P)
+        assert np.abs(d[i] - dRef).max() <= 1e-8 * np.abs(dRef).max()
+        assert np.abs(v[i] - vRef).max() <= 1e-8 * np.abs(vRef).max()
+        assert np.allclose(P[i], PRef, rtol=1e-6)
+
+
+def test_batch_empty_frame():
+    P0 = np.tile(np.eye(2), (2, 1, 1))
+    d, v, P = kf.Integration_KF_Batch(np.empty((2, 0)), TS, Q, R, 0.0, 0.0, P0)
+    assert d.shape == v.shape == (2, 0)
+    assert np.array_equal(P, P0)
@@ -0,0 +1,86 @@
+"""
+Regression tests of the channel-set assembly: the missing channels by the missing policy, and
+the late frames of a step already processed.
+"""
+import struct
+import numpy as np
+import pytest
+import cpsns_Assembler as assembler
+import cpsns_HPF as hpf
+import cpsns_Integrate as integrate
+import cpsns_Sequence as sequence
+import cpsns_Streams as streams
+
+KEYS = [f"cpsens/d1/m1/{i}/acc/raw" for i in range(3)]
+FRAMES = np.random.default_rng(0).standard_normal((len(KEYS), 10, 100))
+
+
+@pytest.fixture
+def run(harness, metadata, frame):
+    # Every step is processed once all the channels came, or at the end of the step (the wait is
+    # over); the late frames come after that. Returns the published frames and the host.
+    def run(missing_policy, skip=(), late=()):
+        service = harness([hpf.HPFBlock(), integrate.IntegrateBlock()], missing_policy=missing_policy)
+        for key in KEYS:
+            service.send(key + "/metadata", metadata(strType="double"))
+        for t in range(FRAMES.shape[1]):
+            for c in range(len(KEYS)):
+                if (c, t) not in skip:
+                    service.send(KEYS[c] + "/data", frame(t, FRAMES[c, t]))
+            service.host.flush_pending(0, True)
+            for c, tLate in late:
+                if tLate == t:
+                    service.send(KEYS[c] + "/data", frame(t, FRAMES[c, t]))
+                    service.host.flush_pending(0, True)
+        outputs = {}
+        for topic, payload in service.data():
+            outputs.setdefault(topic, []).append((struct.unpack_from('=Q', payload, 20)[0], np.frombuffer(payload[28:])))
+        return outputs, service.host
+    return run
+
+
+@pytest.mark.parametrize("missing_policy", assembler.MISSING_POLICIES)
+def test_late_frame_dropped(run, missing_policy):
+    # The frame of channel 1 at step 4 comes after its step was processed: it is dropped, the
+    # output is the same as if it had never come
+    expected, expectedHost = run(missing_policy, skip=[(1, 4)])
+    outputs, host = run(missing_policy, skip=[(1, 4)], late=[(1, 4)])
+    assert outputs.keys() == expected.keys()
+    for topic, frames in expected.items():
+        assert [n for n, _ in outputs[topic]] == [n for n, _ in frames]
+        assert all(np.array_equal(x, y) for (_, x), (_, y) in zip(outputs[topic], frames))
+    # (with zero and hold the filled samples have moved the stream on: a duplicate for its sequence)
+    nDropped = sum(host.gatherer.nDropped) - sum(expectedHost.gatherer.nDropped)
+    nDuplicates = host.sequence_stats()["duplicates"] + host.sequence_stats()["late"]
+    assert (nDropped, nDuplicates) == ((0, 1) if missing_policy in ("zero", "hold") else (1, 0))
+
+
+def test_partial_processes_the_others(run):
+    reference, _ = run("partial")
+    outputs, _ = run("partial", skip=[(1, 4)])
+    topic = KEYS[1].replace("/acc/raw", "/displ/hpf") + "/data"
+    assert [n for n, _ in outputs[topic]] == [t * 100 for t in range(10) if t != 4]
+    for c in (0, 2):
+        topic = KEYS[c].replace("/acc/raw", "/displ/hpf") + "/data"
+        assert all(np.array_equal(x, y) for (_, x), (_, y) in zip(outputs[topic], reference[topic]))
+
+
+def test_gatherer_on_its_own(frame):
+    gatherer = assembler.Gatherer(0.1, assembler.ChannelSets(), "zero")
+    members = []
+    for key in KEYS:
+        myKey = tuple(key.split('/'))
+        stream = streams.StreamState(myKey, myKey[:3], 100, 'd', [], [])
+        stream.sequence = sequence.SequenceTracker(8)
+        gatherer.add_stream(stream)
+        members.append(stream)
+    assert gatherer.gather(members[2], frame(0, FRAMES[2, 0]), 0.0) == []
+    assert gatherer.gather(members[0], frame(0, FRAMES[0, 0]), 0.0) == []
+    assert gatherer.expire(0.05) == []
+    # channel 1 is missing after the wait: filled (zero), in the order of the set
+    (frames, assembly), = gatherer.expire(0.1)
+    assert list(frames) == members and frames[members[1]] is None and assembly.members == members
+    assert gatherer.nMissingChannels[0] == 1
+    # and its frame is dropped when it comes
+    assert gatherer.gather(members[1], frame(0, FRAMES[1, 0]), 0.2) == []
+    assert gatherer.nDropped[0] == 1 and not gatherer.pendingFrames[0]
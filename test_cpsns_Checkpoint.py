@@ -0,0 +1,81 @@
+"""
+Regression tests of the checkpoints: the file format round trip, and a service restarted from a
+checkpoint producing the same output as one that ran through.
+"""
+import numpy as np
+import pytest
+import cpsns_Checkpoint as checkpoint
+import cpsns_Detrend as detrend
+import cpsns_HPF as hpf
+import cpsns_Integrate as integrate
+
+KEYS = [f"cpsens/d/m/{i}/acc/raw" for i in range(3)]
+
+
+def test_file_round_trip(tmp_path, metadata):
+    strFile = str(tmp_path / "checkpoint.bin")
+    states = [{"zi": np.arange(10.0).reshape(5, 1, 2), "K": np.array(7, dtype=np.int64)}, None,
+              {"history": np.arange(3, dtype=np.float32)}]
+    checkpoint.write(strFile, [checkpoint.encode_stream(KEYS[0], metadata(), 1234, states),
+                               checkpoint.encode_stream(KEYS[1], metadata().decode(), None, [])])
+    streams = checkpoint.read(strFile)
+    assert [(key, meta, nextSample) for key, meta, nextSample, _, _ in streams] == [(KEYS[0], metadata(), 1234), (KEYS[1], metadata(), None)]
+    blockStates = streams[0][3]
+    assert blockStates[1] is None and streams[1][3] == []
+    for saved, restored in ((states[0], blockStates[0]), (states[2], blockStates[2])):
+        assert saved.keys() == restored.keys()
+        for name in saved:
+            assert restored[name].dtype == saved[name].dtype and np.array_equal(restored[name], saved[name])
+
+
+def test_corrupt_file(tmp_path, metadata):
+    strFile = str(tmp_path / "checkpoint.bin")
+    checkpoint.write(strFile, [checkpoint.encode_stream(KEYS[0], metadata(), 0, [{"x": np.zeros(4)}])])
+    content = bytearray(open(strFile, 'rb').read())
+    content[20] ^= 1
+    open(strFile, 'wb').write(content)
+    with pytest.raises(ValueError):
+        checkpoint.read(strFile)
+
+
+def test_newest_record_wins(tmp_path, metadata):
+    # The file of an earlier run with more workers (never written again) against the current one
+    strStale, strFresh = str(tmp_path / "checkpoint.bin.10"), str(tmp_path / "checkpoint.bin.2")
+    checkpoint.write(strStale, [checkpoint.encode_stream(KEYS[0], metadata(), 100, [], savedAt=1000.0),
+                                checkpoint.encode_stream(KEYS[1], metadata(), 100, [], savedAt=1000.0)])
+    checkpoint.write(strFresh, [checkpoint.encode_stream(KEYS[0], metadata(), 500, [], savedAt=2000.0)])
+    for strFiles in ([strStale, strFresh], [strFresh, strStale]):
+        newest = checkpoint.read_newest(strFiles + [str(tmp_path / "missing")])
+        assert {key: record[2] for key, record in newest.items()} == {KEYS[0]: 500, KEYS[1]: 100}
+
+
+@pytest.mark.parametrize("create_blocks", [
+    lambda: [hpf.HPFBlock(), integrate.IntegrateBlock(outputs=["displ", "vel"])],
+    lambda: [detrend.DetrendBlock("window", 0.15)],
+    lambda: [detrend.DetrendBlock()],
+])
+def test_restart_from_checkpoint(tmp_path, harness, metadata, frame, create_blocks):
+    strFile = str(tmp_path / "checkpoint.bin")
+    frames = (np.random.default_rng(0).standard_normal((len(KEYS), 20, 100)) + 1).astype(np.float32)
+
+    def feed(run, steps):
+        # (a restored stream is kept if its metadata comes again unchanged)
+        for key in KEYS:
+            run.send(key + "/metadata", metadata())
+        for t in steps:
+            for i, key in enumerate(KEYS):
+                run.send(key + "/data", frame(t, frames[i, t]))
+        run.host.flush_pending(0, True)
+        run.host.outbound.flush_all()
+        return sorted(run.data())
+
+    reference = feed(harness(create_blocks()), range(20))
+    first = harness(create_blocks(), checkpoint_file=strFile)
+    first.host.restore_checkpoint()
+    outputs = feed(first, range(10))
+    first.host.write_checkpoint()
+    second = harness(create_blocks(), checkpoint_file=strFile)
+    second.host.restore_checkpoint()
+    outputs += feed(second, range(10, 20))
+    assert sorted(outputs) == reference
+    assert second.host.sequence_stats()["gaps"] == 0
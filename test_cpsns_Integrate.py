@@ -0,0 +1,41 @@
+"""
+Regression test of the batched integration: the streams of a node integrated together (one
+process_batch call per time step) give the same output as every stream integrated on its own.
+"""
+import numpy as np
+import cpsns_Integrate as integrate
+
+KEYS = [f"cpsens/d1/m1/{i}/acc/raw" for i in range(4)]
+FRAMES = np.random.default_rng(0).standard_normal((len(KEYS), 20, 100))
+REBUILT = 2        # this stream gets new metadata...
+REBUILT_STEP = 10  # ...before this time step
+
+
+def run(service, keys, metadata, frame):
+    # Returns the published data frames per topic
+    for key in keys:
+        service.send(key + "/metadata", metadata(strType="double"))
+    for t in range(FRAMES.shape[1]):
+        if t == REBUILT_STEP and KEYS[REBUILT] in keys:
+            # (another sampling frequency: the stream starts again, with another Ts)
+            service.send(KEYS[REBUILT] + "/metadata", metadata(strType="double", Fs=500))
+        for key in keys:
+            service.send(key + "/data", frame(t, FRAMES[KEYS.index(key), t]))
+    outputs = {}
+    for topic, payload in service.data():
+        outputs.setdefault(topic, []).append(payload)
+    return outputs
+
+
+def test_node_batch_matches_single_streams(harness, metadata, frame):
+    batched = run(harness([integrate.IntegrateBlock()]), KEYS, metadata, frame)
+    assert len(batched) == len(KEYS)
+    for key in KEYS:
+        single = run(harness([integrate.IntegrateBlock()]), [key], metadata, frame)
+        topic, = single.keys()
+        assert len(batched[topic]) == FRAMES.shape[1]
+        for payload, expected in zip(batched[topic], single[topic]):
+            assert payload[:28] == expected[:28]
+            d, dExpected = np.frombuffer(payload[28:]), np.frombuffer(expected[28:])
+            # (as Integration_KF_Batch against the single channel: the same up to the rounding)
+            assert np.abs(d - dExpected).max() <= 1e-9 * np.abs(dExpected).max()
@@ -0,0 +1,82 @@
+"""
+Regression test of the offline mode: a capture processed offline gives the same samples, bit for
+bit, as the same messages processed by a streaming host.
+"""
+import os
+import numpy as np
+import pytest
+import cpsns_Capture as capture
+import cpsns_Detrend as detrend
+import cpsns_Framework as fw
+import cpsns_HPF as hpf
+import cpsns_Integrate as integrate
+import cpsns_Offline as offline
+
+KEYS = [f"cpsens/d1/m{i // 3}/{i % 3}/acc/raw" for i in range(6)]
+
+
+def create_blocks():
+    return [detrend.DetrendBlock(), integrate.IntegrateBlock(), hpf.HPFBlock()]
+
+
+@pytest.mark.parametrize("nProcesses", [1, 3])
+def test_offline_matches_streaming(tmp_path, harness, metadata, frame, nProcesses):
+    frames = np.random.default_rng(0).standard_normal((len(KEYS), 30, 100)).astype(np.float32)
+    msgs = [(key + "/metadata", metadata()) for key in KEYS]
+    for t in range(30):
+        for i, key in enumerate(KEYS):
+            msgs.append((key + "/data", frame(t, frames[i, t])))
+    strCapture = str(tmp_path / "capture.bin")
+    with capture.CaptureWriter(strCapture) as writer:
+        for topic, payload in msgs:
+            writer.write(0.0, topic, payload)
+
+    streaming = harness(create_blocks())
+    for topic, payload in msgs:
+        streaming.send(topic, payload)
+    streaming.host.outbound.flush_all()
+    streamed = {}
+    for topic, payload in streaming.data():
+        streamed.setdefault(topic, []).append(np.frombuffer(payload[28:], np.float32))
+
+    strDir = str(tmp_path / "out")
+    offline.run(strCapture, strDir, lambda: fw.Host(create_blocks(), nWorkerThreads=0, stream_ttl=0), nProcesses=nProcesses)
+    assert len(streamed) == len(KEYS)
+    for topic, samples in streamed.items():
+        strBase = os.path.join(strDir, topic.rsplit('/', 1)[0].replace('/', '.'))
+        assert np.array_equal(np.load(strBase + ".npy"), np.concatenate(samples))
+        assert len(np.load(strBase + ".frames.npy")) == len(samples)
+
+
+def test_gather_timeout_on_capture_time(tmp_path, metadata, frame):
+    # One sensor of node m0 stops delivering after step 5: its steps are processed without it
+    # after gather_timeout of capture time (0.1 s a step), they do not pile up to the end
+    frames = np.random.default_rng(0).standard_normal((len(KEYS), 30, 100)).astype(np.float32)
+    strCapture = str(tmp_path / "capture.bin")
+    with capture.CaptureWriter(strCapture) as writer:
+        for key in KEYS:
+            writer.write(0.0, key + "/metadata", metadata())
+        for t in range(30):
+            for i, key in enumerate(KEYS):
+                if i != 2 or t <= 5:
+                    writer.write(0.1 * t, key + "/data", frame(t, frames[i, t]))
+
+    nPending = []
+
+    def create_host():
+        host = fw.Host(create_blocks(), 0.3, 0, stream_ttl=0)
+        handle_message = host.handle_message
+
+        def spy(msg):
+            nPending.append(len(host.gatherer.pendingFrames[0]))
+            handle_message(msg)
+        host.handle_message = spy
+        return host
+
+    strDir = str(tmp_path / "out")
+    offline.run(strCapture, strDir, create_host, nProcesses=1)
+    # (at most the steps of gather_timeout and one tick, not the 24 steps without it)
+    assert max(nPending) <= 8
+    for i, key in enumerate(KEYS):
+        strBase = os.path.join(strDir, key.replace("/acc/raw", "/displ/hpf").replace('/', '.'))
+        assert len(np.load(strBase + ".frames.npy")) == (6 if i == 2 else 30)
@@ -0,0 +1,134 @@
+"""
+Regression tests of the sequence tracking: reordered, repeated, late and lost frames, by the
+tracker itself and through the host with the gap policies.
+"""
+import struct
+import numpy as np
+import pytest
+import cpsns_HPF as hpf
+import cpsns_Integrate as integrate
+import cpsns_Sequence as sequence
+
+KEY = "cpsens/d/m/1/acc/raw"
+FRAMES = (np.random.default_rng(0).standard_normal((20, 100)) + 1).astype(np.float32)
+
+
+def start_of(payload):
+    return struct.unpack_from('=Q', payload, 20)[0]
+
+
+@pytest.fixture
+def push_all(frame):
+    # Pushes the frames (by their index) and returns the indices of the frames to process
+    def push_all(tracker, order, **kwargs):
+        return [start_of(payload) // 100 for t in order for payload in tracker.push(frame(t, FRAMES[t]), **kwargs)]
+    return push_all
+
+
+def test_in_order(push_all):
+    tracker = sequence.SequenceTracker(4)
+    assert push_all(tracker, range(5)) == list(range(5))
+    assert tracker.expected == 500 and tracker.nGaps == 0
+
+
+def test_duplicate_dropped(push_all):
+    tracker = sequence.SequenceTracker(4)
+    assert push_all(tracker, [0, 1, 2, 2, 1, 3]) == [0, 1, 2, 3]
+    assert tracker.nDuplicates == 2 and tracker.nGaps == 0
+
+
+def test_reordered_within_buffer(push_all):
+    tracker = sequence.SequenceTracker(4)
+    assert push_all(tracker, [0, 2, 3, 1, 4], reorder_frames=2) == [0, 1, 2, 3, 4]
+    assert tracker.nReordered == 2 and tracker.nGaps == 0
+
+
+def test_gap_when_buffer_full(push_all):
+    tracker = sequence.SequenceTracker(4, bRecordGaps=True)
+    assert push_all(tracker, [0, 2, 3, 4], reorder_frames=2) == [0, 2, 3, 4]
+    assert (tracker.nGaps, tracker.nGapSamples) == (1, 100)
+    assert tracker.gaps == {200: 100}
+    # frame 1 comes after it was given up on: late, not a duplicate
+    assert push_all(tracker, [1]) == []
+    assert tracker.nLate == 1 and tracker.nDuplicates == 0
+
+
+def test_gap_without_reordering(push_all):
+    tracker = sequence.SequenceTracker(4)
+    assert push_all(tracker, [0, 1, 3, 2]) == [0, 1, 3]
+    assert (tracker.nGaps, tracker.nLate) == (1, 1)
+
+
+def test_expire_and_flush(push_all):
+    tracker = sequence.SequenceTracker(4)
+    assert push_all(tracker, [0, 2, 3], reorder_frames=4, now=10.0) == [0]
+    assert tracker.expire(10.01, 0.05) == []
+    assert [start_of(payload) // 100 for payload in tracker.expire(10.1, 0.05)] == [2, 3]
+    push_all(tracker, [5], reorder_frames=4)
+    assert [start_of(payload) // 100 for payload in tracker.flush()] == [5]
+    assert tracker.nGaps == 2
+
+
+def test_restart(push_all):
+    tracker = sequence.SequenceTracker(4, bRecordGaps=True)
+    push_all(tracker, range(sequence.RESTART_FRAMES + 2))
+    assert push_all(tracker, [0]) == [0]
+    assert tracker.nRestarts == 1 and tracker.gaps == {0: sequence.RESET}
+
+
+def test_without_position():
+    # metadataVer 1: processed as they come
+    tracker = sequence.SequenceTracker(4)
+    payload = struct.pack('=HHQQ', 20, 1, 1000, 0) + FRAMES[0].tobytes()
+    assert tracker.push(payload) == [payload] and tracker.push(payload) == [payload]
+
+
+@pytest.fixture
+def run(harness, metadata, frame):
+    # Returns the published frames (start, samples) and the sequence statistics
+    def run(order, frames=FRAMES, **kwargs):
+        service = harness([hpf.HPFBlock(), integrate.IntegrateBlock()], **kwargs)
+        service.send(KEY + "/metadata", metadata())
+        for t in order:
+            service.send(KEY + "/data", frame(t, frames[t]))
+        service.host.flush_reordered(0, True)
+        service.host.flush_pending(0, True)
+        service.host.outbound.flush_all()
+        outputs = [(start_of(payload), np.frombuffer(payload[28:], np.float32)) for _, payload in service.data()]
+        return outputs, service.host.sequence_stats()
+    return run
+
+
+def joined(outputs):
+    return np.concatenate([samples for _, samples in outputs])
+
+
+def test_host_reordered(run):
+    outputs, stats = run([0, 1, 2, 4, 3] + list(range(5, 20)), reorder_frames=2)
+    assert np.array_equal(joined(outputs), joined(run(range(20))[0]))
+    assert stats["reordered"] == 1 and stats["gaps"] == 0
+
+
+def test_host_duplicate(run):
+    outputs, stats = run([0, 1, 2, 3, 3] + list(range(4, 20)))
+    assert np.array_equal(joined(outputs), joined(run(range(20))[0]))
+    assert stats["duplicates"] == 1
+
+
+@pytest.mark.parametrize("policy, fill", [("zero", lambda previous: 0.0), ("extrapolate", lambda previous: previous[-1])])
+def test_host_gap_filled(run, policy, fill):
+    # Frame 5 is lost: the same as the frame filled in, which is not published
+    filled = FRAMES.copy()
+    filled[5] = fill(FRAMES[4])
+    expected = [output for output in run(range(20), filled)[0] if output[0] != 500]
+    outputs, stats = run([t for t in range(20) if t != 5], gap_policy=policy)
+    assert np.array_equal(joined(outputs), joined(expected))
+    assert (stats["gaps"], stats["gap_samples"]) == (1, 100)
+
+
+@pytest.mark.parametrize("kwargs", [{"gap_policy": "reset"}, {"gap_policy": "zero", "gap_fill_max": 50}])
+def test_host_gap_reset(run, kwargs):
+    # After the gap the states start again: the same as a stream starting at frame 6
+    outputs, _ = run([t for t in range(20) if t != 5], **kwargs)
+    assert np.array_equal(joined(outputs[:5]), joined(run(range(5))[0]))
+    assert np.array_equal(joined(outputs[5:]), joined(run(range(6, 20))[0]))
@@ -0,0 +1,60 @@
+"""
+Regression tests of the streaming polyphase decimator against upsampling + FIR filtering +
+downsampling of the whole signal (scipy.signal.upfirdn with the filter of resample_poly).
+"""
+import numpy as np
+import pytest
+import scipy.signal
+import simpleDecimate as decimate
+
+
+def reference(x, factor):
+    up, down = decimate.parse_factor(factor)
+    halfLength = decimate.HALF_LENGTH_FACTOR * max(up, down)
+    h = scipy.signal.firwin(2 * halfLength + 1, 1.0 / max(up, down), window=('kaiser', decimate.KAISER_BETA)) * up
+    return scipy.signal.upfirdn(h, x, up, down)
+
+
+@pytest.mark.parametrize("factor", ["10", "3", "5/2", "7/3", "2.5"])
+@pytest.mark.parametrize("nFrame", [1, 7, 128, 999])
+def test_matches_upfirdn(factor, nFrame):
+    up, down = decimate.parse_factor(factor)
+    x = np.random.default_rng(0).standard_normal(5000)
+    # (the decimator starts as if the first sample had been there forever, upfirdn from zeros)
+    x[0] = 0.0
+    decimator = decimate.RealTimeDecimator(factor)
+    out = np.concatenate([decimator.apply_filter(x[start:start + nFrame]) for start in range(0, len(x), nFrame)])
+    assert len(out) == -(-len(x) * up // down)
+    assert np.abs(out - reference(x, factor)[:len(out)]).max() < 1e-12
+
+
+@pytest.mark.parametrize("factor", ["10", "5/2"])
+def test_batch_matches_single(factor):
+    x = np.random.default_rng(1).standard_normal((8, 1000))
+    batched = [decimate.RealTimeDecimator(factor) for _ in x]
+    single = [decimate.RealTimeDecimator(factor) for _ in x]
+    for start in range(0, 1000, 100):
+        outs = decimate.apply_filter_batch(batched, [row[start:start + 100] for row in x])
+        for out, decimator, row in zip(outs, single, x):
+            assert np.array_equal(out, decimator.apply_filter(row[start:start + 100]))
+
+
+def test_output_positions():
+    # The outputs sit at fixed input positions whatever frame the stream starts with
+    x = np.random.default_rng(2).standard_normal(3000)
+    decimator = decimate.RealTimeDecimator("5/2")
+    assert decimator.output_sample(0) == 0
+    first = decimator.apply_filter(x[:1000])
+    assert decimator.output_sample(1000) == len(first) == 400
+    late = decimate.RealTimeDecimator("5/2")
+    assert late.output_sample(1001) == 401
+
+
+def test_state_round_trip():
+    x = np.random.default_rng(3).standard_normal(1000)
+    decimator = decimate.RealTimeDecimator("7/3")
+    decimator.apply_filter(x[:333])
+    restored = decimate.RealTimeDecimator("7/3")
+    assert restored.set_state(decimator.get_state())
+    assert np.array_equal(restored.apply_filter(x[333:]), decimator.apply_filter(x[333:]))
+    assert not decimate.RealTimeDecimator("10").set_state(decimator.get_state())
@@ -0,0 +1,77 @@
+"""
+Regression tests of the streaming detrender against the original per-sample loop of cpsns_Detrend.
+"""
+import numpy as np
+import pytest
+import simpleDetrend as detrend
+
+
+def detrend_loop(frames):
+    # The original running mean, sample by sample (K and the mean carried over the frames; the
+    # first frame needs 2 samples at least)
+    K_minus_1 = np.int64(0)
+    xMean_K = 0.0
+    outputs = []
+    for frame in frames:
+        data = np.array(frame, dtype=float)
+        if K_minus_1 == 0:
+            xMean_K_minus_1 = data[0]
+            K = np.int64(2)
+            startFrom = 1
+        else:
+            xMean_K_minus_1 = xMean_K
+            K = K_minus_1 + 1
+            startFrom = 0
+        for i in range(startFrom, len(data)):
+            xMean_K = xMean_K_minus_1 + (data[i] - xMean_K_minus_1) / K
+            data[i] -= xMean_K
+            xMean_K_minus_1 = xMean_K
+            K += 1
+        K_minus_1 = K - 1
+        outputs.append(data)
+    return np.concatenate(outputs)
+
+
+def frames_of(x, nFrame):
+    return [x[start:start + nFrame] for start in range(0, len(x), nFrame)]
+
+
+@pytest.mark.parametrize("nFrame", [2, 7, 100, 4000])
+def test_cumulative_matches_loop(nFrame):
+    x = np.random.default_rng(0).standard_normal(4000) + 3.0
+    detrender = detrend.RealTimeDetrender()
+    out = np.concatenate([detrender.apply_filter(frame) for frame in frames_of(x, nFrame)])
+    assert np.allclose(out, detrend_loop(frames_of(x, nFrame)), rtol=0, atol=1e-12)
+
+
+def test_exponential_matches_loop():
+    x = np.random.default_rng(1).standard_normal(3000) + 3.0
+    alpha = 0.01
+    xMean = x[0]
+    ref = np.empty_like(x)
+    for i, sample in enumerate(x):
+        xMean += alpha * (sample - xMean)
+        ref[i] = sample - xMean
+    detrender = detrend.RealTimeDetrender("exponential", alpha=alpha)
+    out = np.concatenate([detrender.apply_filter(frame) for frame in frames_of(x, 64)])
+    assert np.allclose(out, ref, rtol=0, atol=1e-12)
+
+
+def test_window_matches_loop():
+    x = np.random.default_rng(2).standard_normal(3000) + 3.0
+    window = 250
+    ref = np.array([x[i] - x[max(0, i + 1 - window):i + 1].mean() for i in range(len(x))])
+    detrender = detrend.RealTimeDetrender("window", window=window)
+    out = np.concatenate([detrender.apply_filter(frame) for frame in frames_of(x, 64)])
+    assert np.allclose(out, ref, rtol=0, atol=1e-12)
+
+
+def test_state_round_trip():
+    x = np.random.default_rng(3).standard_normal(2000)
+    for kwargs in ({}, {"mode": "exponential", "alpha": 0.05}, {"mode": "window", "window": 100}):
+        detrender = detrend.RealTimeDetrender(**kwargs)
+        detrender.apply_filter(x[:700])
+        restored = detrend.RealTimeDetrender(**kwargs)
+        assert restored.set_state(detrender.get_state())
+        assert np.array_equal(restored.apply_filter(x[700:]), detrender.apply_filter(x[700:]))
+    assert not detrend.RealTimeDetrender("window", window=10).set_state(detrender.get_state())
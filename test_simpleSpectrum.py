@@ -0,0 +1,53 @@
+"""
+Regression tests of the streaming Welch spectra against scipy.signal.welch of the same samples.
+"""
+import numpy as np
+import pytest
+import scipy.signal
+import simpleSpectrum as spectrum
+
+FS = 1000.0
+
+
+@pytest.mark.parametrize("scaling", ["density", "spectrum"])
+@pytest.mark.parametrize("nFrame", [1, 100, 333])
+def test_matches_scipy_welch(scaling, nFrame):
+    nperseg, noverlap, nAverages, hop = 256, 128, 4, 3
+    step = nperseg - noverlap
+    x = np.random.default_rng(0).standard_normal(6000)
+    welch = spectrum.RealTimeSpectrum(FS, nperseg, noverlap, nAverages, hop, "hann", scaling)
+    welch.output_sample(0)
+    out = np.concatenate([welch.apply_filter(x[start:start + nFrame]) for start in range(0, len(x), nFrame)])
+    spectra = out.reshape(-1, welch.nbins())
+    # Spectrum i is that of segment (i + 1) * hop, ending at the input sample (i + 1) * hop * step
+    nLength = nperseg + (nAverages - 1) * step
+    nCompared = 0
+    for i, spectrumI in enumerate(spectra):
+        end = (i + 1) * hop * step
+        if end < nLength:
+            continue  # the first spectra average the periodograms there are so far
+        f, ref = scipy.signal.welch(x[end - nLength:end], FS, "hann", nperseg, noverlap, scaling=scaling)
+        assert np.allclose(spectrumI, ref, rtol=1e-10, atol=0)
+        nCompared += 1
+    assert nCompared == len(spectra) - 1  # (only the first one is short of samples)
+    assert np.array_equal(welch.frequencies(FS), f)
+
+
+def test_batch_matches_single():
+    x = np.random.default_rng(1).standard_normal((4, 2000))
+    batched = [spectrum.RealTimeSpectrum(FS, 128, 64, 2, 1) for _ in x]
+    single = [spectrum.RealTimeSpectrum(FS, 128, 64, 2, 1) for _ in x]
+    for start in range(0, 2000, 200):
+        outs = spectrum.apply_filter_batch(batched, [row[start:start + 200] for row in x])
+        for out, welch, row in zip(outs, single, x):
+            assert np.allclose(out, welch.apply_filter(row[start:start + 200]), rtol=1e-12, atol=0)
+
+
+def test_state_round_trip():
+    x = np.random.default_rng(2).standard_normal(3000)
+    welch = spectrum.RealTimeSpectrum(FS, 256, 128, 4, 2)
+    welch.apply_filter(x[:1111])
+    restored = spectrum.RealTimeSpectrum(FS, 256, 128, 4, 2)
+    assert restored.set_state(welch.get_state())
+    assert np.array_equal(restored.apply_filter(x[1111:]), welch.apply_filter(x[1111:]))
+    assert not spectrum.RealTimeSpectrum(FS, 512, 128, 4, 2).set_state(welch.get_state())